@@ -0,0 +1,5 @@
+'''
+Benchmarks of the customers API, they run offline against SQLite or
+a local Postgres database. Please refer to the README.md file on how
+to launch them.
+'''
@@ -0,0 +1,78 @@
+'''
+Measure the deletion of customers by batches with a single DELETE
+statement each, compared to the former ORM path which loaded each
+customer before deleting it.
+
+Usage::
+
+    python -m benchmarks.bench_delete --customers 100000 --batch-size 1000
+'''
+
+import time
+import argparse
+from customers.utils import db
+from customers.common.models.customer import Customer
+from customers.common.models.customer_data import CustomerData
+from customers.common.services import CustomerService
+from benchmarks.utils import default_database, setup_database, seed_customers
+
+def orm_delete(customer_ids):
+    '''
+    Delete customers one by one the way delete_customer_by_id did:
+    load, delete with the ORM, commit
+
+    :param customer_ids:
+        The ids of the customers to delete
+    '''
+    for customer_id in customer_ids:
+        customer = db.session.query(Customer).get(customer_id)
+        db.session.delete(customer)
+        db.session.commit()
+
+def main():
+    '''
+    Seed the database, delete all the customers and print the rates
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument(
+        '--orm-sample',
+        type=int,
+        default=1000,
+        help='Number of customers deleted with the ORM path'
+    )
+    args = parser.parse_args()
+
+    setup_database(args.database or default_database())
+    seed_customers(args.customers)
+
+    customer_ids = list(range(1, args.customers + 1))
+    sample = customer_ids[:args.orm_sample]
+    rest = customer_ids[args.orm_sample:]
+
+    start = time.time()
+    orm_delete(sample)
+    orm_elapsed = max(time.time() - start, 0.001)
+
+    start = time.time()
+    for index in range(0, len(rest), args.batch_size):
+        CustomerService.delete_customers_by_ids(
+            rest[index:index + args.batch_size],
+            soft=False
+        )
+    batch_elapsed = max(time.time() - start, 0.001)
+
+    orphans = db.session.query(CustomerData.id).count()
+
+    print('orm: %d customers in %.2f s, %.0f customers/s' % (
+        len(sample), orm_elapsed, len(sample) / orm_elapsed
+    ))
+    print('batch of %d: %d customers in %.2f s, %.0f customers/s' % (
+        args.batch_size, len(rest), batch_elapsed, len(rest) / batch_elapsed
+    ))
+    print('customer_data rows left: %d' % orphans)
+
+if __name__ == '__main__':
+    main()
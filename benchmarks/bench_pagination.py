@@ -0,0 +1,61 @@
+'''
+Compare the cost of the first and of a deep page of customers, with
+the OFFSET/LIMIT pagination and with the keyset pagination.
+
+Usage::
+
+    python -m benchmarks.bench_pagination --customers 100000 --page 10000
+'''
+
+import argparse
+from customers.utils import db
+from customers.common.services import CustomerService
+from benchmarks.utils import (
+    default_database,
+    setup_database,
+    seed_customers,
+    measure
+)
+
+def main():
+    '''
+    Seed the database and print the median duration of each page
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--page', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    per_page = CustomerService.RESULTS_PER_PAGE
+    setup_database(args.database or default_database())
+    seed_customers(args.customers)
+
+    def offset_page(page):
+        start = page * per_page
+        return lambda: CustomerService.get_customers(
+            start,
+            start + per_page
+        )
+
+    def keyset_page(page):
+        #Id of the last customer of the previous page, the seeded ids
+        # run from 1 without gaps
+        last_id = page * per_page if page > 0 else None
+        return lambda: CustomerService.get_customers_after(
+            last_id,
+            per_page
+        )
+
+    for label, page_func in (('offset', offset_page),
+                             ('keyset', keyset_page)):
+        first = measure(page_func(0), args.repeat)
+        deep = measure(page_func(args.page), args.repeat)
+        print('%s: page 0 %.3f ms, page %d %.3f ms (x%.1f)' % (
+            label, first, args.page, deep, deep / first
+        ))
+        db.session.expunge_all()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Measure the admin search on a prefix of an email, a substring of a
+last name and a substring of a cellphone, first page and deep page.
+
+Usage::
+
+    python -m benchmarks.bench_search --customers 5000000
+'''
+
+import argparse
+from customers.utils import db
+from customers.common.services import CustomerService
+from benchmarks.utils import (
+    default_database,
+    setup_database,
+    seed_customers,
+    measure
+)
+
+def main():
+    '''
+    Seed the database and print the median duration of each search
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--customers', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    per_page = CustomerService.SEARCH_RESULTS_PER_PAGE
+    setup_database(args.database or default_database())
+    seed_customers(args.customers)
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute('ANALYZE')
+        db.session.commit()
+
+    #Seeded customers: customer<id>@example.org, Last<id>, <id> padded
+    middle = args.customers // 2
+    searches = (
+        ('email prefix', 'customer%d@' % middle),
+        ('last name substring', 'ast%d' % middle),
+        ('cellphone substring', '%d' % middle),
+        ('many matches', 'last1'),
+    )
+
+    for label, text in searches:
+        rows = CustomerService.search_customers(text, limit=per_page + 1)
+        first = measure(
+            lambda: CustomerService.search_customers(text, limit=per_page),
+            args.repeat
+        )
+        line = '%s %r: %d+ results, first page %.3f ms' % (
+            label, text, len(rows), first
+        )
+        if len(rows) > per_page:
+            after = tuple(rows[per_page - 1][:2])
+            second = measure(
+                lambda: CustomerService.search_customers(
+                    text,
+                    after=after,
+                    limit=per_page
+                ),
+                args.repeat
+            )
+            line += ', second page %.3f ms' % second
+        print(line)
+        db.session.expunge_all()
+
+if __name__ == '__main__':
+    main()
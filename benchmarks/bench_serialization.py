@@ -0,0 +1,74 @@
+'''
+Compare the cost of rendering a list of customers with the ORM and
+flask.jsonify, and with row tuples and the fast JSON serializer.
+The serializer in use (orjson, ujson or json) is printed first.
+
+Usage::
+
+    python -m benchmarks.bench_serialization --customers 1000
+'''
+
+import argparse
+from flask import jsonify
+from customers.utils import db
+from customers.common.services import CustomerService
+from customers.common.serializers import (
+    ENCODER,
+    json_response,
+    customer_row_json
+)
+from benchmarks.utils import (
+    app,
+    default_database,
+    setup_database,
+    seed_customers,
+    measure
+)
+
+def main():
+    '''
+    Seed the database and print the median duration of each way of
+    rendering the list, with and without the query
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_database(args.database or default_database())
+    seed_customers(args.customers)
+
+    def orm_query():
+        db.session.expunge_all()
+        return CustomerService.get_customers(0, args.customers)
+
+    def rows_query():
+        return CustomerService.get_customer_rows(0, args.customers)
+
+    def orm_render(raw_customers):
+        return jsonify(
+            customers=[customer.json for customer in raw_customers]
+        ).get_data()
+
+    def rows_render(rows):
+        return json_response(
+            customers=[customer_row_json(row) for row in rows]
+        ).get_data()
+
+    raw_customers = orm_query()
+    rows = rows_query()
+
+    print('encoder: %s' % ENCODER)
+    with app.test_request_context():
+        for label, query, render, loaded in (
+                ('orm + jsonify', orm_query, orm_render, raw_customers),
+                ('rows + serializer', rows_query, rows_render, rows)):
+            size = len(render(loaded))
+            serialize = measure(lambda: render(loaded), args.repeat)
+            total = measure(lambda: render(query()), args.repeat)
+            print('%s: %d bytes, serialize %.3f ms, query + serialize'
+                  ' %.3f ms' % (label, size, serialize, total))
+
+if __name__ == '__main__':
+    main()
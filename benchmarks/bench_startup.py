@@ -0,0 +1,85 @@
+'''
+Measure the startup of a worker, each run in a fresh interpreter:
+the import of the package, create_app, the first request (which
+creates the engine and connects) and, for comparison, the import of
+the command line tools which the workers no longer load.
+
+Usage::
+
+    python -m benchmarks.bench_startup --runs 10
+'''
+
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+def child(database):
+    '''
+    Start the application once and print the durations as JSON
+
+    :param database:
+        SQLAlchemy URI of the database to use
+    '''
+    start = time.time()
+    import customers
+    imported = time.time()
+    app = customers.create_app(dict(SQLALCHEMY_DATABASE_URI=database))
+    created = time.time()
+    response = app.test_client().get('/admin/customer/1')
+    answered = time.time()
+    import customers.cli
+    tooling = time.time()
+
+    print(json.dumps(dict(
+        import_ms=(imported - start) * 1000,
+        create_app_ms=(created - imported) * 1000,
+        first_request_ms=(answered - created) * 1000,
+        cli_import_ms=(tooling - answered) * 1000,
+        status=response.status_code
+    )))
+
+def main():
+    '''
+    Seed a customer, start the application several times and print
+    the median durations
+    '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.database)
+        return
+
+    #Imported here, so that the children start from scratch
+    from benchmarks.utils import default_database, setup_database, \
+        seed_customers
+
+    database = args.database or default_database()
+    setup_database(database)
+    seed_customers(1, rounds=4)
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([
+            sys.executable, '-m', 'benchmarks.bench_startup',
+            '--child', '--database', database
+        ])
+        runs.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+
+    for name in ('import_ms', 'create_app_ms', 'first_request_ms',
+                 'cli_import_ms'):
+        values = sorted(run[name] for run in runs)
+        print('%-18s median %8.1f ms  max %8.1f ms' % (
+            name, values[len(values) // 2], values[-1]
+        ))
+    print('first request status: %s' % ', '.join(
+        sorted(set(str(run['status']) for run in runs))
+    ))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+'''
+Run every API scenario against a seeded database and save the
+throughput and latency percentiles as JSON. Passing a previous result
+file with --compare flags the scenarios which got slower than the
+tolerance, and exits with status 1 if there is any.
+
+The requests go through the Flask test client, there is no server
+nor network involved. Each scenario works on its own range of seeded
+customers, so that they do not depend on each other.
+
+Usage::
+
+    python -m benchmarks.suite --customers 10000 --requests 200 \\
+        --output results.json --compare baseline.json
+'''
+
+import sys
+import json
+import time
+import base64
+import platform
+import argparse
+from datetime import datetime
+from customers.utils import db, hasher
+from customers.common.services import CustomerService
+from benchmarks.utils import (
+    SEED_PASSWORD,
+    app,
+    default_database,
+    setup_database,
+    seed_customers
+)
+
+#Compared with the baseline, lower is better except for the throughput
+COMPARED = ('throughput', 'p50_ms', 'p90_ms', 'p99_ms')
+
+def _auth_headers(customer_id, password=SEED_PASSWORD):
+    '''
+    Return the basic auth headers of a seeded customer
+
+    :param customer_id:
+        The id of the customer
+
+    :param password:
+        Its clear password
+    '''
+    credentials = 'customer%d@example.org:%s' % (customer_id, password)
+    return {
+        'Authorization': 'Basic %s' % base64.b64encode(
+            credentials.encode('utf-8')
+        ).decode('ascii')
+    }
+
+def _scenarios(client, requests, customers_count):
+    '''
+    Return the scenarios as (name, function called with the index of
+    the request and returning the response, function called with the
+    json payload of a 200 response and returning true if the request
+    succeeded) tuples
+
+    :param client:
+        A Flask test client
+
+    :param requests:
+        Number of requests per scenario
+
+    :param customers_count:
+        Number of seeded customers
+    '''
+    per_page = CustomerService.RESULTS_PER_PAGE
+    last_page = (customers_count - 1) // per_page
+
+    def send(method, url, data=None, headers=None):
+        return client.open(
+            url,
+            method=method,
+            headers=headers,
+            data=None if data is None else json.dumps(data),
+            content_type=None if data is None else 'application/json'
+        )
+
+    def register(index):
+        return send('POST', '/customer/register', dict(
+            email='bench%d@example.org' % index,
+            password=SEED_PASSWORD
+        ))
+
+    def profile_get(index):
+        return send(
+            'GET',
+            '/customer/profile',
+            headers=_auth_headers(index + 1)
+        )
+
+    def profile_put(index):
+        return send('PUT', '/customer/profile', dict(
+            first_name='First',
+            last_name='Last',
+            cellphone='0123456789',
+            newsletter=True
+        ), _auth_headers(index + 1))
+
+    def password(index):
+        return send('PATCH', '/customer/password', dict(
+            old_password=SEED_PASSWORD,
+            password='changed',
+            confirm='changed'
+        ), _auth_headers(requests + index + 1))
+
+    def admin_get(index):
+        return send('GET', '/admin/customer/%d' % (index + 1))
+
+    def admin_list_shallow(index):
+        return send('GET', '/admin/customer/', dict(page=0))
+
+    def admin_list_deep(index):
+        return send('GET', '/admin/customer/', dict(page=last_page))
+
+    def delete(index):
+        return send(
+            'DELETE',
+            '/admin/customer/%d' % (2 * requests + index + 1)
+        )
+
+    def has(key):
+        return lambda payload: key in payload
+
+    def listed(payload):
+        return bool(payload.get('customers'))
+
+    def done(payload):
+        return payload.get('msg') == 'OK'
+
+    def deleted(payload):
+        return payload.get('result') is True
+
+    return (
+        ('register', register, has('id')),
+        ('profile_get', profile_get, has('customer')),
+        ('profile_put', profile_put, has('customer')),
+        ('password', password, done),
+        ('admin_get', admin_get, has('customer')),
+        ('admin_list_shallow', admin_list_shallow, listed),
+        ('admin_list_deep', admin_list_deep, listed),
+        ('delete', delete, deleted),
+    )
+
+def _percentile(durations, percent):
+    '''
+    Return a percentile of sorted durations, nearest rank method
+
+    :param durations:
+        Sorted list of durations
+
+    :param percent:
+        The percentile, between 0 and 100
+    '''
+    rank = int(round(percent / 100.0 * len(durations) + 0.5)) - 1
+    return durations[min(max(rank, 0), len(durations) - 1)]
+
+def _failed(response, check):
+    '''
+    Returns true if the request failed: a status other than 200, a
+    response which is not json, or a payload refused by the check of
+    the scenario, e.g. the validation errors or a "Could not find
+    customer" message returned with a 200
+
+    :param response:
+        The response of the test client
+
+    :param check:
+        Function called with the json payload, returns true if the
+        request succeeded
+    '''
+    if response.status_code != 200:
+        return True
+    if response.mimetype != 'application/json':
+        return True
+    return not check(json.loads(response.get_data(as_text=True)))
+
+def run_scenario(func, requests, check):
+    '''
+    Call a scenario and return its statistics
+
+    :param func:
+        The scenario, called with the index of the request
+
+    :param requests:
+        Number of requests
+
+    :param check:
+        Function telling whether a response payload is a success, see
+        _failed
+    '''
+    durations = []
+    errors = 0
+
+    started = time.time()
+    for index in range(requests):
+        start = time.time()
+        response = func(index)
+        durations.append((time.time() - start) * 1000)
+        errors += _failed(response, check)
+    elapsed = max(time.time() - started, 0.000001)
+
+    durations.sort()
+    return dict(
+        requests=requests,
+        errors=errors,
+        seconds=elapsed,
+        throughput=requests / elapsed,
+        p50_ms=_percentile(durations, 50),
+        p90_ms=_percentile(durations, 90),
+        p99_ms=_percentile(durations, 99),
+        max_ms=durations[-1]
+    )
+
+def compare(results, baseline, tolerance):
+    '''
+    Return the regressions of results against a baseline, as
+    (scenario, measure, baseline value, new value) tuples
+
+    :param results:
+        The scenario results of the current run
+
+    :param baseline:
+        The scenario results of the previous run
+
+    :param tolerance:
+        Allowed slow down, 0.2 for 20%
+    '''
+    regressions = []
+    for name, current in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        for measure in COMPARED:
+            old, new = previous[measure], current[measure]
+            if measure == 'throughput':
+                slower = new * (1 + tolerance) < old
+            else:
+                slower = new > old * (1 + tolerance)
+            if slower:
+                regressions.append((name, measure, old, new))
+    return regressions
+
+def main():
+    '''
+    Seed the database, run the scenarios, print and save the results
+    '''
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument('--database', default=None)
+    parser.add_argument('--customers', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument(
+        '--rounds',
+        type=int,
+        default=None,
+        help='bcrypt cost factor, BCRYPT_LOG_ROUNDS by default'
+    )
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.customers < 3 * args.requests:
+        parser.error('--customers must be at least 3 times --requests')
+
+    #Measure the production settings
+    app.debug = False
+    app.config['SLOW_QUERY_MS'] = None
+    if args.rounds is not None:
+        hasher.rounds = args.rounds
+
+    setup_database(args.database or default_database())
+    seed_customers(args.customers, rounds=args.rounds)
+
+    client = app.test_client()
+    results = {}
+    scenarios = _scenarios(client, args.requests, args.customers)
+    for name, func, check in scenarios:
+        results[name] = run_scenario(func, args.requests, check)
+        print('%-20s %8.1f req/s  p50 %7.2f ms  p90 %7.2f ms'
+              '  p99 %7.2f ms  errors %d' % (
+                  name,
+                  results[name]['throughput'],
+                  results[name]['p50_ms'],
+                  results[name]['p90_ms'],
+                  results[name]['p99_ms'],
+                  results[name]['errors']
+              ))
+
+    with open(args.output, 'w') as output:
+        json.dump(dict(
+            meta=dict(
+                date=datetime.now().isoformat(),
+                python=platform.python_version(),
+                database=db.engine.dialect.name,
+                customers=args.customers,
+                requests=args.requests,
+                rounds=hasher.rounds
+            ),
+            results=results
+        ), output, indent=2, sort_keys=True)
+    print('Results saved to %s' % args.output)
+
+    if args.compare is None:
+        return 0
+
+    with open(args.compare) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for name, measure, old, new in regressions:
+        print('REGRESSION %s %s: %.2f -> %.2f' % (name, measure, old, new))
+    if not regressions:
+        print('No regression against %s' % args.compare)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+'''
+Helpers shared by the benchmark scripts
+'''
+
+import os
+import time
+import tempfile
+from datetime import datetime
+from customers import create_app
+from customers.utils import db, bcrypt
+from customers.common.models.customer import Customer
+from customers.common.models.customer_data import CustomerData
+
+#Hashing is not what is measured when seeding, every seeded customer
+# gets the same hash of this password
+SEED_PASSWORD = 'benchmark'
+
+#The application measured, its database is set by setup_database
+app = create_app()
+
+def default_database():
+    '''
+    Return the URI of a throwaway SQLite database
+    '''
+    handle, path = tempfile.mkstemp(suffix='.db', prefix='customers-')
+    os.close(handle)
+    return 'sqlite:///%s' % path
+
+def setup_database(uri):
+    '''
+    Point the application to the benchmark database and create
+    the tables
+
+    :param uri:
+        SQLAlchemy URI of the database to use
+    '''
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    db.drop_all()
+    db.create_all()
+
+def seed_customers(count, batch_size=10000, rounds=None):
+    '''
+    Insert customers with executemany, skipping the ORM and bcrypt
+
+    :param count:
+        Number of customers to insert
+
+    :param batch_size:
+        Number of rows per INSERT statement
+
+    :param rounds:
+        Cost factor of the hash of SEED_PASSWORD, BCRYPT_LOG_ROUNDS
+        by default
+    '''
+    password = bcrypt.generate_password_hash(SEED_PASSWORD, rounds)
+    created = datetime.now()
+
+    for start in range(1, count + 1, batch_size):
+        ids = range(start, min(start + batch_size, count + 1))
+        db.session.execute(Customer.__table__.insert(), [
+            dict(
+                id=customer_id,
+                email='customer%d@example.org' % customer_id,
+                email_domain='example.org',
+                password=password,
+                active=True
+            )
+            for customer_id in ids
+        ])
+        db.session.execute(CustomerData.__table__.insert(), [
+            dict(
+                customer_id=customer_id,
+                first_name='First%d' % customer_id,
+                last_name='Last%d' % customer_id,
+                cellphone='%010d' % customer_id,
+                newsletter=customer_id % 2 == 0,
+                created=created
+            )
+            for customer_id in ids
+        ])
+
+    #The ids were given explicitly, move the sequence past them
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            "SELECT setval('customer_id_seq', :count)",
+            dict(count=count)
+        )
+    db.session.commit()
+
+def measure(func, repeat=20):
+    '''
+    Call a function several times and return the median duration in
+    milliseconds
+
+    :param func:
+        The function to measure, called without parameters
+
+    :param repeat:
+        Number of calls
+    '''
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        durations.append((time.time() - start) * 1000)
+    durations.sort()
+    return durations[len(durations) // 2]
@@ -0,0 +1,17 @@
+'''
+Gunicorn settings: the application is created once in the master
+(preload_app) and the workers drop the database connections they
+inherit, see customers.reset_after_fork.
+
+Usage: gunicorn -c conf/gunicorn.py customers.wsgi:app
+'''
+
+bind = '127.0.0.1:8000'
+preload_app = True
+
+def post_fork(server, worker):
+    '''
+    Called in each worker once forked
+    '''
+    from customers import reset_after_fork
+    reset_after_fork()
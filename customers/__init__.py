@@ -1,39 +1,103 @@
 '''
-Initialize the application, please refer to the README.md file on how
+Create the application, please refer to the README.md file on how
 to launch it.
 '''
 
 from flask import Flask
-from flask.ext.script import Manager
-from flask.ext.migrate import Migrate, MigrateCommand
 import wtforms_json
-from customers.utils import db, bcrypt
-from customers.errors import bp as errors_module
-from customers.front import bp as front_module
-from customers.back import bp as back_module
+from customers.utils import(
+    db,
+    router,
+    shards,
+    group_commit,
+    bcrypt,
+    hasher,
+    login_limiter,
+    auth_cache,
+    count_cache,
+    customer_cache,
+    metrics,
+    query_monitor
+)
 
-app = Flask(__name__)
-app.config.from_pyfile('../conf/config.cfg')
-app.config.from_envvar('CUSTOMERS_PROD_CONFIG', silent=True)
+#WTForm json extension
+wtforms_json.init()
 
-#Database
-db.app = app
-db.init_app(app)
+def create_app(config=None):
+    '''
+    Create the application: read conf/config.cfg, then the file named
+    by CUSTOMERS_PROD_CONFIG, then config, initialize the extensions
+    and register the blueprints. The database engines are created on
+    first use, not here.
 
-#Migration
-migrate = Migrate(app, db)
+    The extensions of customers.utils are shared by the whole
+    process, they follow the last application created.
 
-#Flask script manager
-manager = Manager(app)
-manager.add_command('db', MigrateCommand)
+    :param config:
+        A dict of settings, or the path of a config file relative to
+        the customers package (e.g. '../conf/config_test.cfg')
+    '''
+    #The blueprints import the views, forms and services
+    from customers.errors import bp as errors_module
+    from customers.front import bp as front_module
+    from customers.back import bp as back_module
 
-#Bcrypt
-bcrypt.init_app(app)
+    app = Flask(__name__)
+    app.config.from_pyfile('../conf/config.cfg')
+    app.config.from_envvar('CUSTOMERS_PROD_CONFIG', silent=True)
 
-#WTForm json extension
-wtforms_json.init()
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_pyfile(config)
+
+    #Database
+    db.app = app
+    db.init_app(app)
+    router.init_app(app)
+    shards.init_app(app)
+    group_commit.init_app(app)
+
+    #Bcrypt
+    bcrypt.init_app(app)
+    hasher.init_app(app)
+
+    #Failed logins rate limits
+    login_limiter.init_app(app)
+
+    #Password verification cache
+    auth_cache.init_app(app)
+
+    #Customer count strategy
+    count_cache.init_app(app)
+
+    #Customer cache
+    customer_cache.init_app(app)
+
+    #Request metrics
+    metrics.init_app(app)
+
+    #Slow query log and N+1 detector
+    query_monitor.init_app(app)
+
+    #Register the blueprints
+    app.register_blueprint(errors_module)
+    app.register_blueprint(front_module)
+    app.register_blueprint(back_module)
+
+    return app
+
+def reset_after_fork():
+    '''
+    Drop the database connections inherited from the parent process,
+    to call in each worker when the application was created before
+    forking (gunicorn --preload, see conf/gunicorn.py). The replica
+    and shard engines are created again on first use.
+    '''
+    state = db.get_app().extensions['sqlalchemy']
+
+    for connector in list(state.connectors.values()):
+        connector.get_engine().dispose()
 
-#Register the blueprints
-app.register_blueprint(errors_module)
-app.register_blueprint(front_module)
-app.register_blueprint(back_module)
+    router.reset()
+    shards.reset()
@@ -13,6 +13,26 @@ bp.add_url_rule(
     view_func=AdminCustomerAPI.AdminCustomerList.as_view('get_all')
 )
 
+bp.add_url_rule(
+    '/batch',
+    view_func=AdminCustomerAPI.AdminCustomerBatch.as_view('batch')
+)
+
+bp.add_url_rule(
+    '/search',
+    view_func=AdminCustomerAPI.AdminCustomerSearch.as_view('search')
+)
+
+bp.add_url_rule(
+    '/export',
+    view_func=AdminCustomerAPI.AdminCustomerExport.as_view('export')
+)
+
+bp.add_url_rule(
+    '/metrics',
+    view_func=AdminCustomerAPI.AdminMetrics.as_view('metrics')
+)
+
 bp.add_url_rule(
     '/<int:customer_id>',
     view_func=AdminCustomerAPI.AdminCustomer.as_view('get')
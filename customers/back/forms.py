@@ -2,15 +2,32 @@
 Collection of forms for the back end customer API
 '''
 
+from datetime import datetime, time
+from flask import current_app
 from flask.ext.wtf import Form
 from wtforms import(
+    Form as BaseForm,
     StringField,
     BooleanField,
     IntegerField,
+    DateField,
+    FieldList,
+    FormField,
     ValidationError
 )
-from wtforms.validators import DataRequired, Email
+from wtforms.validators import(
+    DataRequired,
+    Email,
+    Optional,
+    AnyOf,
+    Length
+)
 from customers.common.services import CustomerService
+from customers.common.pagination import(
+    decode_cursor,
+    parse_cursor_datetime
+)
+from customers.common.export import EXPORT_FORMATS
 
 class CustomerForm(Form):
     '''
@@ -35,27 +52,276 @@ class CreateCustomerForm(CustomerForm):
         :param field:
             Field object, the email string is in field.data
         '''
-        customer = CustomerService.get_customer_by_email(field.data)
-
-        if customer is not None:
+        #The email addresses of the soft deleted customers are taken
+        if CustomerService.get_taken_emails([(field.data or '').lower()]):
             raise ValidationError(
                 'Email address already taken.'
             )
 
+def _validate_batch_size(form, field):
+    '''
+    Make sure that a batch is not empty and not larger than the
+    BATCH_MAX_SIZE setting
+
+    :param form:
+        The form of the field
+
+    :param field:
+        Field object, the list is in field.data
+    '''
+    max_size = current_app.config.get('BATCH_MAX_SIZE', 100)
+
+    if not field.data:
+        raise ValidationError('The batch is empty.')
+
+    if len(field.data) > max_size:
+        raise ValidationError(
+            'A batch is limited to %d customers.' % max_size
+        )
+
+class CustomerIdsForm(Form):
+    '''
+    Form for the batch actions taking a list of customer ids.
+    '''
+    ids = FieldList(IntegerField('id'), validators=[_validate_batch_size])
+
+class CustomerUpdateForm(BaseForm):
+    '''
+    One customer of a batch update, it is not a flask-wtf form since
+    it is only used nested in CustomerBatchUpdateForm.
+    '''
+    id = IntegerField('id', [DataRequired()])
+    first_name = StringField('first_name')
+    last_name = StringField('last_name')
+    cellphone = StringField('cellphone')
+    newsletter = BooleanField('newsletter')
+
+class CustomerBatchUpdateForm(Form):
+    '''
+    Form for the batch update of customers.
+    '''
+    customers = FieldList(
+        FormField(CustomerUpdateForm),
+        validators=[_validate_batch_size]
+    )
+
+def _to_flag(value):
+    '''
+    Return the boolean of a JSON boolean or of a 'true'/'false'
+    string, None if it is not set. Raises ValueError otherwise.
+
+    :param value:
+        The data of a field
+    '''
+    if value is None or value == '':
+        return None
+    if value is True or value == 'true':
+        return True
+    if value is False or value == 'false':
+        return False
+    raise ValueError(value)
+
+def _validate_flag(form, field):
+    '''
+    Make sure that a field is a boolean, or not set
+
+    :param form:
+        The form
+
+    :param field:
+        The field to validate
+    '''
+    try:
+        _to_flag(field.data)
+    except ValueError:
+        raise ValidationError('Use true or false.')
+
 class CustomerListForm(Form):
     '''
-    Form for the view rendering a customer list.
+    Form for the view rendering a customer list. Without a page
+    number, the list is paginated with a cursor. The filters and the
+    sort key must be one of the combinations of
+    CustomerService.LIST_INDEXES.
     '''
     page = IntegerField('page')
+    cursor = StringField('cursor')
+    newsletter = StringField('newsletter', [_validate_flag])
+    active = StringField('active', [_validate_flag])
+    email_domain = StringField('email_domain')
+    created_from = DateField('created_from', [Optional()])
+    created_to = DateField('created_to', [Optional()])
+    sort = StringField('sort', default='id')
+
+    @property
+    def sort_key(self):
+        '''
+        Return the sort key, 'id' by default
+        '''
+        return self.sort.data or 'id'
+
+    @property
+    def filters(self):
+        '''
+        Return the filters for CustomerService.get_customers, the
+        dates are turned into datetimes at midnight
+        '''
+        def to_datetime(date):
+            if date is None:
+                return None
+            return datetime.combine(date, time())
+
+        try:
+            newsletter = _to_flag(self.newsletter.data)
+            active = _to_flag(self.active.data)
+        except ValueError:
+            newsletter = active = None
+
+        return dict(
+            newsletter=newsletter,
+            active=active,
+            email_domain=self.email_domain.data or None,
+            created_from=to_datetime(self.created_from.data),
+            created_to=to_datetime(self.created_to.data)
+        )
+
+    def validate_sort(self, field):
+        '''
+        Make sure that the sort key exists, and that it is served by
+        an index along with the filters. It is checked even when the
+        sort key is not set.
+
+        :param field:
+            Field object, the sort key is in field.data
+        '''
+        if self.sort_key.lstrip('-') not in CustomerService.LIST_SORTS:
+            raise ValidationError(
+                'Unknown sort key, use: %s, prefixed with - for the '
+                'descending order.' % ', '.join(
+                    sorted(CustomerService.LIST_SORTS)
+                )
+            )
+
+        try:
+            CustomerService.check_list_options(self.filters, self.sort_key)
+        except ValueError as error:
+            raise ValidationError(str(error))
 
     def validate_page(self, field):
         '''
         Make sure that the page number is a positive number
 
         :param field:
-            Field object, the email string is in field.data
+            Field object, the page number is in field.data
         '''
-        if field.data < 0:
+        if field.data is not None and field.data < 0:
             raise ValidationError(
                 'Page number has to be positive.'
             )
+
+    def validate_cursor(self, field):
+        '''
+        Make sure that the cursor has been built by the server
+
+        :param field:
+            Field object, the cursor string is in field.data
+        '''
+        if field.data:
+            try:
+                values = decode_cursor(field.data)
+            except ValueError as error:
+                raise ValidationError(str(error))
+
+            #The id of the last customer, preceded by its sorted value
+            # unless sorted by id
+            sort_key = self.sort_key.lstrip('-')
+            size = 1 if sort_key == 'id' else 2
+            if len(values) != size or not isinstance(values[-1], int):
+                raise ValidationError('Invalid cursor')
+
+            if sort_key == 'created':
+                try:
+                    parse_cursor_datetime(values[0])
+                except ValueError as error:
+                    raise ValidationError(str(error))
+            elif sort_key != 'id' and not isinstance(values[0], type(u'')):
+                raise ValidationError('Invalid cursor')
+
+class CustomerSearchForm(Form):
+    '''
+    Form for the customer search, filled from the query string.
+    '''
+    q = StringField(
+        'q',
+        [DataRequired(), Length(min=CustomerService.SEARCH_MIN_LENGTH)]
+    )
+    cursor = StringField('cursor')
+
+    def validate_cursor(self, field):
+        '''
+        Make sure that the cursor has been built by the server, it
+        holds the rank and the id of the last customer
+
+        :param field:
+            Field object, the cursor string is in field.data
+        '''
+        if field.data:
+            try:
+                values = decode_cursor(field.data)
+            except ValueError as error:
+                raise ValidationError(str(error))
+
+            if len(values) != 2 or \
+                    not all(isinstance(value, int) for value in values):
+                raise ValidationError('Invalid cursor')
+
+class CustomerExportForm(Form):
+    '''
+    Form for the customer export, filled from the query string.
+    '''
+    format = StringField(
+        'format',
+        [Optional(), AnyOf(list(EXPORT_FORMATS))],
+        default='ndjson'
+    )
+    columns = StringField('columns')
+    newsletter = StringField(
+        'newsletter',
+        [Optional(), AnyOf(['true', 'false'])]
+    )
+    created_from = DateField('created_from', [Optional()])
+    created_to = DateField('created_to', [Optional()])
+
+    def validate_columns(self, field):
+        '''
+        Make sure that the comma separated columns can be exported
+
+        :param field:
+            Field object, the columns string is in field.data
+        '''
+        available = [name for name, _ in CustomerService.EXPORT_COLUMNS]
+        for column in self.column_list or []:
+            if column not in available:
+                raise ValidationError(
+                    'Unknown column %s, use: %s.' % (
+                        column,
+                        ', '.join(available)
+                    )
+                )
+
+    @property
+    def column_list(self):
+        '''
+        Return the list of columns to export, None for all of them
+        '''
+        if not self.columns.data:
+            return None
+        return [column.strip() for column in self.columns.data.split(',')]
+
+    @property
+    def newsletter_filter(self):
+        '''
+        Return the newsletter flag to filter on, None for no filter
+        '''
+        if not self.newsletter.data:
+            return None
+        return self.newsletter.data == 'true'
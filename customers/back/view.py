@@ -5,16 +5,38 @@ Contains the classes for manipulating customers on the backend side.
 import string
 import random
 from math import ceil
-from flask import jsonify, request
+from datetime import datetime, time
+from flask import request, abort, Response, stream_with_context
 from flask.views import MethodView
-from customers.common.services import CustomerService
+from customers.common.services import CustomerService, VersionConflict
+from customers.utils import metrics
 from customers.common.models.customer import Customer
+from customers.common.pagination import(
+    encode_cursor,
+    decode_cursor,
+    parse_cursor_datetime
+)
+from customers.common.serializers import json_response, customer_row_json
+from customers.common.export import EXPORT_FORMATS, iter_export
+from customers.common.conditional import(
+    customer_etag,
+    not_modified,
+    expected_version,
+    with_etag
+)
 from customers.back.forms import(
     CustomerForm,
     CreateCustomerForm,
-    CustomerListForm
+    CustomerListForm,
+    CustomerExportForm,
+    CustomerSearchForm,
+    CustomerIdsForm,
+    CustomerBatchUpdateForm
 )
 
+#Names of the columns of the customer rows
+_ROW_COLUMNS = [name for name, _ in CustomerService.EXPORT_COLUMNS]
+
 class AdminCustomer(MethodView):
     '''
     View for CRUD actions on the customers from the backend.
@@ -39,22 +61,62 @@ class AdminCustomer(MethodView):
         '''
         return ''.join(random.choice(chars) for _ in range(size))
 
+    @staticmethod
+    def _patch(customer_id, changes):
+        '''
+        Apply changes to a customer with a single UPDATE per table,
+        checking the version sent in the If-Match header if any.
+
+        :param customer_id:
+            The id of the customer to update
+
+        :param changes:
+            A dict of the customer data to change
+
+        Returns a json representation of a customer.
+        '''
+        try:
+            record = CustomerService.patch_customer(
+                customer_id,
+                changes,
+                expected_version(customer_id)
+            )
+        except VersionConflict:
+            abort(412)
+
+        if record is None:
+            return json_response(msg="Could not find customer")
+
+        return with_etag(
+            json_response(customer=record['customer']),
+            customer_etag(customer_id, record['version'])
+        )
+
     def get(self, customer_id):
         '''
-        Returns one customer
+        Returns one customer, with its ETag. Answers 304 without
+        loading the customer data if the If-None-Match header matches.
 
         :param customer_id:
             The ID of the customer to retrieve.
         '''
-        customer = CustomerService.get_customer_by_id(customer_id)
+        if request.if_none_match:
+            version = CustomerService.get_customer_version(customer_id)
+            if version is not None:
+                response = not_modified(customer_etag(customer_id, version))
+                if response is not None:
+                    return response
+
+        record = CustomerService.get_customer_record(customer_id)
 
-        if customer is None:
-            return jsonify(
+        if record is None:
+            return json_response(
                 msg="Could not find customer"
             )
 
-        return jsonify(
-            customer=customer.json
+        return with_etag(
+            json_response(customer=record['customer']),
+            customer_etag(customer_id, record['version'])
         )
 
     def post(self):
@@ -66,7 +128,7 @@ class AdminCustomer(MethodView):
         form = CreateCustomerForm.from_json(request.get_json())
 
         if not form.validate_on_submit():
-            return jsonify(errors=form.errors)
+            return json_response(errors=form.errors)
 
         customer = Customer(
             email=form.email.data,
@@ -79,15 +141,14 @@ class AdminCustomer(MethodView):
 
         CustomerService.add_customer(customer)
 
-        return jsonify(customer=customer.json)
+        return json_response(customer=customer.json)
 
     def put(self, customer_id):
         '''
         Update an existing customer.
         It is not possible to update the email address or the
-        password using this service.
-
-        TODO: Use patch when wtf-forms will be ready
+        password using this service. With an If-Match header, the
+        update is refused with a 412 if the customer has changed.
 
         :param customer_id:
             The id of the customer to update
@@ -97,21 +158,30 @@ class AdminCustomer(MethodView):
         form = CustomerForm.from_json(request.get_json())
 
         if not form.validate_on_submit():
-            return jsonify(errors=form.errors)
+            return json_response(errors=form.errors)
 
-        customer = CustomerService.get_customer_by_id(customer_id)
+        return AdminCustomer._patch(customer_id, form.data)
 
-        if customer is None:
-            return jsonify(msg="Could not find customer")
+    def patch(self, customer_id):
+        '''
+        Update some fields of an existing customer, the fields
+        missing from the json are left untouched. With an If-Match
+        header, the update is refused with a 412 if the customer has
+        changed.
 
-        customer.data.cellphone = form.cellphone.data
-        customer.data.first_name = form.first_name.data
-        customer.data.last_name = form.last_name.data
-        customer.data.newsletter = form.newsletter.data
+        :param customer_id:
+            The id of the customer to update
 
-        CustomerService.update_customer(customer)
+        Returns a json representation of a customer.
+        '''
+        form = CustomerForm.from_json(request.get_json())
+
+        #Here we are not using form.validate_on_submit because it
+        # will only work for PUT and POST request methods.
+        if not form.validate():
+            return json_response(errors=form.errors)
 
-        return jsonify(customer=customer.json)
+        return AdminCustomer._patch(customer_id, form.patch_data)
 
     def delete(self, customer_id):
         '''
@@ -124,7 +194,7 @@ class AdminCustomer(MethodView):
         '''
         result = CustomerService.delete_customer_by_id(customer_id)
 
-        return jsonify(
+        return json_response(
             result=result
         )
 
@@ -135,29 +205,303 @@ class AdminCustomerList(MethodView):
 
     def get(self):
         '''
-        Support pagination style: 'page' json parameter.
+        Support two pagination styles:
+
+         * 'page' json parameter, returns the page number and the
+           total number of pages. The total is counted with the
+           strategy set in CUSTOMERS_COUNT_MODE, which is returned as
+           'count_mode' with 'approximate' true when estimated.
+         * 'cursor' json parameter (or no parameter at all), returns
+           the cursor of the next page, which is null on the last
+           page. Deep pages are as fast as the first one.
 
         Returns a list of customers and pagination data.
         '''
         form = CustomerListForm.from_json(request.get_json())
 
         if not form.validate():
-            return jsonify(errors=form.errors)
+            return json_response(errors=form.errors)
+
+        if form.page.data is None:
+            return AdminCustomerList._get_by_cursor(
+                form.cursor.data,
+                form.filters,
+                form.sort_key
+            )
 
         page = form.page.data
 
-        total = CustomerService.get_count_customers()
-        total_pages = ceil(total / CustomerService.RESULTS_PER_PAGE)
+        total, count_mode = CustomerService.count_customers(form.filters)
+        total_pages = ceil(total / float(CustomerService.RESULTS_PER_PAGE))
         start = page * CustomerService.RESULTS_PER_PAGE
         stop = start + CustomerService.RESULTS_PER_PAGE
 
-        raw_customers = CustomerService.get_customers(
+        rows = CustomerService.get_customer_rows(
             start=start,
-            stop=stop
+            stop=stop,
+            filters=form.filters,
+            sort=form.sort_key
         )
 
-        return jsonify(
+        return json_response(
             current_page=page,
             total_pages=int(total_pages),
-            customers=[customer.json for customer in raw_customers]
+            count_mode=count_mode,
+            approximate=count_mode == 'estimated',
+            customers=[customer_row_json(row) for row in rows]
         )
+
+    @staticmethod
+    def _get_by_cursor(cursor, filters, sort):
+        '''
+        Render a page of customers using keyset pagination
+
+        :param cursor:
+            The cursor returned with the previous page, empty for the
+            first page
+
+        :param filters:
+            The filters of the list
+
+        :param sort:
+            The sort key of the list
+        '''
+        sort_key = sort.lstrip('-')
+        last_id = last_value = None
+        if cursor:
+            values = decode_cursor(cursor)
+            last_id = values[-1]
+            if sort_key == 'created':
+                last_value = parse_cursor_datetime(values[0])
+            elif sort_key != 'id':
+                last_value = values[0]
+
+        #Fetch one more customer to know if there is a next page
+        raw_rows = CustomerService.get_customer_rows_after(
+            last_id=last_id,
+            limit=CustomerService.RESULTS_PER_PAGE + 1,
+            filters=filters,
+            sort=sort,
+            last_value=last_value
+        )
+        rows = raw_rows[:CustomerService.RESULTS_PER_PAGE]
+
+        next_cursor = None
+        if len(raw_rows) > len(rows):
+            #The id is the first column of the rows
+            last = rows[-1]
+            if sort_key == 'id':
+                next_cursor = encode_cursor(last[0])
+            else:
+                next_cursor = encode_cursor(
+                    last[_ROW_COLUMNS.index(sort_key)],
+                    last[0]
+                )
+
+        return json_response(
+            next_cursor=next_cursor,
+            customers=[customer_row_json(row) for row in rows]
+        )
+
+class AdminCustomerBatch(MethodView):
+    '''
+    View for actions on several customers at once, limited to
+    BATCH_MAX_SIZE customers. Each one runs a few SQL statements and
+    a single commit per shard. The batch update sends one statement
+    for the data on Postgres, an executemany elsewhere.
+    '''
+
+    @staticmethod
+    def _not_found(customer_id):
+        '''
+        Result of a customer which could not be found
+
+        :param customer_id:
+            The id of the customer
+        '''
+        return dict(id=customer_id, msg="Could not find customer")
+
+    def get(self):
+        '''
+        Returns several customers, 'ids' json parameter.
+
+        Returns a result per id, in the same order.
+        '''
+        form = CustomerIdsForm.from_json(request.get_json())
+
+        if not form.validate():
+            return json_response(errors=form.errors)
+
+        customers = dict(
+            (customer.id, customer)
+            for customer in CustomerService.get_customers_by_ids(
+                form.ids.data
+            )
+        )
+
+        return json_response(results=[
+            dict(id=customer_id, customer=customers[customer_id].json)
+            if customer_id in customers
+            else AdminCustomerBatch._not_found(customer_id)
+            for customer_id in form.ids.data
+        ])
+
+    def put(self):
+        '''
+        Update several customers, 'customers' json parameter: a list
+        of objects with the 'id' of a customer and the same fields as
+        a single customer update.
+
+        Returns a result per customer, in the same order.
+        '''
+        form = CustomerBatchUpdateForm.from_json(request.get_json())
+
+        if not form.validate_on_submit():
+            return json_response(errors=form.errors)
+
+        updates = [
+            dict(
+                customer_id=item['id'],
+                first_name=item['first_name'],
+                last_name=item['last_name'],
+                cellphone=item['cellphone'],
+                newsletter=item['newsletter']
+            )
+            for item in form.customers.data
+        ]
+        updated = CustomerService.update_customers_data(updates)
+
+        return json_response(results=[
+            dict(id=update['customer_id'], result=True)
+            if update['customer_id'] in updated
+            else AdminCustomerBatch._not_found(update['customer_id'])
+            for update in updates
+        ])
+
+    def delete(self):
+        '''
+        Delete several customers, 'ids' json parameter.
+
+        Returns a result per id, in the same order.
+        '''
+        form = CustomerIdsForm.from_json(request.get_json())
+
+        if not form.validate():
+            return json_response(errors=form.errors)
+
+        deleted = CustomerService.delete_customers_by_ids(form.ids.data)
+
+        return json_response(results=[
+            dict(id=customer_id, result=customer_id in deleted)
+            for customer_id in form.ids.data
+        ])
+
+class AdminCustomerSearch(MethodView):
+    '''
+    View searching the customers by email, name or cellphone.
+    '''
+
+    def get(self):
+        '''
+        Query string parameters:
+
+         * q: the text to search, at least 3 characters, matched
+           anywhere in the email, first name, last name and cellphone
+         * cursor: the next_cursor of the previous page, optional
+
+        Returns the customers ranked by relevance (exact email, then
+        prefix, then substring) and the cursor of the next page, which
+        is null on the last page.
+        '''
+        form = CustomerSearchForm(request.args)
+
+        if not form.validate():
+            return json_response(errors=form.errors)
+
+        after = decode_cursor(form.cursor.data) if form.cursor.data else None
+
+        #Fetch one more customer to know if there is a next page
+        raw_rows = CustomerService.search_customers(
+            form.q.data,
+            after=after,
+            limit=CustomerService.SEARCH_RESULTS_PER_PAGE + 1
+        )
+        rows = raw_rows[:CustomerService.SEARCH_RESULTS_PER_PAGE]
+
+        next_cursor = None
+        if len(raw_rows) > len(rows):
+            #The rank and the id are the first columns of the rows
+            next_cursor = encode_cursor(rows[-1][0], rows[-1][1])
+
+        return json_response(
+            next_cursor=next_cursor,
+            customers=[customer_row_json(row[1:]) for row in rows]
+        )
+
+class AdminCustomerExport(MethodView):
+    '''
+    View streaming all the customers, as NDJSON or CSV.
+    '''
+
+    def get(self):
+        '''
+        Query string parameters, all optional:
+
+         * format: 'ndjson' (default) or 'csv'
+         * columns: comma separated list of columns
+         * newsletter: 'true' or 'false'
+         * created_from, created_to: dates as YYYY-MM-DD, the range
+           includes created_from and excludes created_to
+
+        The rows are written as soon as they are read from the
+        database, the response is not buffered.
+        '''
+        form = CustomerExportForm(request.args)
+
+        if not form.validate():
+            return json_response(errors=form.errors)
+
+        columns = form.column_list or [
+            name for name, _ in CustomerService.EXPORT_COLUMNS
+        ]
+        rows = CustomerService.iter_customer_rows(
+            columns=columns,
+            newsletter=form.newsletter_filter,
+            created_from=_to_datetime(form.created_from.data),
+            created_to=_to_datetime(form.created_to.data)
+        )
+        export_format = form.format.data or 'ndjson'
+
+        return Response(
+            stream_with_context(iter_export(rows, columns, export_format)),
+            mimetype=EXPORT_FORMATS[export_format]
+        )
+
+class AdminMetrics(MethodView):
+    '''
+    View exposing the request metrics to Prometheus.
+    '''
+
+    def get(self):
+        '''
+        Returns the metrics in the Prometheus text format, 404 if
+        METRICS_ENABLED is False.
+        '''
+        if not metrics.enabled:
+            abort(404)
+
+        return Response(
+            metrics.render(),
+            mimetype='text/plain; version=0.0.4'
+        )
+
+def _to_datetime(date):
+    '''
+    Return the datetime at midnight of a date, None if not set
+
+    :param date:
+        A date or None
+    '''
+    if date is None:
+        return None
+    return datetime.combine(date, time())
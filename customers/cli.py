@@ -0,0 +1,36 @@
+'''
+Contains the command line tools: the Flask-Script manager with the
+migrations and the import, export and rebalance commands. Only
+manage.py imports this module, the web workers do not load
+Flask-Script nor Flask-Migrate.
+'''
+
+from flask.ext.script import Manager
+from flask.ext.migrate import Migrate, MigrateCommand
+from customers import create_app
+from customers.utils import db
+from customers.commands.import_customers import ImportCustomers
+from customers.commands.export_customers import ExportCustomers
+from customers.commands.rebalance_shards import RebalanceShards
+
+def create_manager(app=None):
+    '''
+    Return the Flask-Script manager of an application
+
+    :param app:
+        A Flask application, created by create_app by default
+    '''
+    if app is None:
+        app = create_app()
+
+    #Migration
+    Migrate(app, db)
+
+    #Flask script manager
+    manager = Manager(app)
+    manager.add_command('db', MigrateCommand)
+    manager.add_command('import', ImportCustomers())
+    manager.add_command('export', ExportCustomers())
+    manager.add_command('rebalance', RebalanceShards())
+
+    return manager
@@ -0,0 +1,4 @@
+'''
+This package contains the Flask-Script commands registered on the
+manager, run them with `python manage.py <command>`.
+'''
@@ -0,0 +1,107 @@
+'''
+Contains the command exporting customers to a file
+'''
+
+import sys
+from datetime import datetime
+from flask.ext.script import Command, Option
+from customers.common.services import CustomerService
+from customers.common.export import EXPORT_FORMATS, iter_export
+
+def parse_date(value):
+    '''
+    Parse a date written as YYYY-MM-DD
+
+    :param value:
+        The date string
+    '''
+    return datetime.strptime(value, '%Y-%m-%d')
+
+def parse_bool(value):
+    '''
+    Parse a boolean written as true or false
+
+    :param value:
+        The boolean string
+    '''
+    return value.lower() == 'true'
+
+class ExportCustomers(Command):
+    '''
+    Export the customers as NDJSON or CSV, streaming the rows from a
+    server side cursor so that the memory used stays flat.
+    '''
+
+    option_list = (
+        Option(
+            '-o', '--output',
+            dest='output',
+            default=None,
+            help='File to write, the standard output by default'
+        ),
+        Option(
+            '-f', '--format',
+            dest='export_format',
+            choices=list(EXPORT_FORMATS),
+            default='ndjson'
+        ),
+        Option(
+            '-c', '--columns',
+            dest='columns',
+            default=None,
+            help='Comma separated list of columns, all by default'
+        ),
+        Option(
+            '--newsletter',
+            dest='newsletter',
+            type=parse_bool,
+            default=None,
+            help='true or false'
+        ),
+        Option(
+            '--created-from',
+            dest='created_from',
+            type=parse_date,
+            default=None,
+            help='YYYY-MM-DD, included'
+        ),
+        Option(
+            '--created-to',
+            dest='created_to',
+            type=parse_date,
+            default=None,
+            help='YYYY-MM-DD, excluded'
+        ),
+    )
+
+    def run(
+        self,
+        output=None,
+        export_format='ndjson',
+        columns=None,
+        newsletter=None,
+        created_from=None,
+        created_to=None
+    ):
+        '''
+        Write the export to the output file
+        '''
+        if columns is None:
+            columns = [name for name, _ in CustomerService.EXPORT_COLUMNS]
+        else:
+            columns = [column.strip() for column in columns.split(',')]
+
+        rows = CustomerService.iter_customer_rows(
+            columns=columns,
+            newsletter=newsletter,
+            created_from=created_from,
+            created_to=created_to
+        )
+
+        target = open(output, 'w') if output else sys.stdout
+        try:
+            for chunk in iter_export(rows, columns, export_format):
+                target.write(chunk)
+        finally:
+            if output:
+                target.close()
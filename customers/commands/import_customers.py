@@ -0,0 +1,262 @@
+'''
+Contains the command importing customers from a file
+'''
+
+import re
+import csv
+import json
+import time
+import multiprocessing
+import bcrypt as py_bcrypt
+from flask.ext.script import Command, Option
+from customers.utils import hasher
+from customers.common.services import CustomerService
+
+#Same rule as the wtforms Email validator
+EMAIL_REGEX = re.compile(r'^.+@([^.@][^@]+)$', re.IGNORECASE)
+
+def hash_password(args):
+    '''
+    Hash a password with bcrypt, the same way as Flask-Bcrypt. It is
+    a module function so that it can run in a process pool.
+
+    :param args:
+        Tuple of the clear password and the bcrypt log rounds
+    '''
+    password, rounds = args
+    if not isinstance(password, bytes):
+        password = password.encode('utf-8')
+
+    hashed = py_bcrypt.hashpw(password, py_bcrypt.gensalt(rounds))
+    if not isinstance(hashed, str):
+        hashed = hashed.decode('ascii')
+    return hashed
+
+def read_rows(path, file_format):
+    '''
+    Stream the rows of a CSV (with a header line) or NDJSON file
+
+    :param path:
+        Path of the file
+
+    :param file_format:
+        'csv' or 'ndjson'
+
+    Yields tuples of the line number and the row as a dict, or None
+    if the line could not be parsed.
+    '''
+    with open(path) as source:
+        if file_format == 'csv':
+            for index, row in enumerate(csv.DictReader(source)):
+                yield index + 2, row
+            return
+
+        for index, line in enumerate(source):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield index + 1, row if isinstance(row, dict) else None
+
+def to_bool(value):
+    '''
+    Read a boolean written as a JSON boolean or as a CSV string
+
+    :param value:
+        The value to read
+    '''
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+class ImportCustomers(Command):
+    '''
+    Import customers from a CSV or NDJSON file. Each row needs an
+    email and a clear password, and may have first_name, last_name,
+    cellphone and newsletter. Rejected rows are written to an error
+    file as NDJSON, along with the reason.
+    '''
+
+    option_list = (
+        Option('path', help='CSV or NDJSON file to import'),
+        Option(
+            '-f', '--format',
+            dest='file_format',
+            choices=('csv', 'ndjson'),
+            help='Format of the file, guessed from its extension'
+        ),
+        Option(
+            '-b', '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=5000,
+            help='Number of customers inserted per transaction'
+        ),
+        Option(
+            '-w', '--workers',
+            dest='workers',
+            type=int,
+            default=None,
+            help='Number of processes hashing the passwords'
+        ),
+        Option(
+            '-e', '--errors',
+            dest='errors_path',
+            default=None,
+            help='File receiving the rejected rows, <path>.errors'
+        ),
+    )
+
+    def run(
+        self,
+        path,
+        file_format=None,
+        batch_size=5000,
+        workers=None,
+        errors_path=None
+    ):
+        '''
+        Import the file by batches, print the progress and return the
+        number of imported and rejected rows.
+        '''
+        if file_format is None:
+            file_format = 'csv' if path.endswith('.csv') else 'ndjson'
+
+        self.rounds = hasher.rounds
+        self.seen = set()
+        self.imported = 0
+        self.rejected = 0
+        start = time.time()
+
+        #Create the pool before any database connection is opened,
+        # so that the workers do not inherit them
+        pool = multiprocessing.Pool(workers)
+
+        try:
+            with open(errors_path or path + '.errors', 'w') as errors:
+                batch = []
+                for line, row in read_rows(path, file_format):
+                    batch.append((line, row))
+                    if len(batch) >= batch_size:
+                        self._import_batch(batch, pool, errors)
+                        self._print_progress(start)
+                        batch = []
+
+                self._import_batch(batch, pool, errors)
+        finally:
+            pool.close()
+            pool.join()
+
+        self._print_progress(start)
+
+        return self.imported, self.rejected
+
+    def _print_progress(self, start):
+        '''
+        Print the number of rows processed so far and the rate
+
+        :param start:
+            Timestamp of the beginning of the import
+        '''
+        elapsed = max(time.time() - start, 0.001)
+        print('%d imported, %d rejected, %.0f rows/s' % (
+            self.imported,
+            self.rejected,
+            (self.imported + self.rejected) / elapsed
+        ))
+
+    def _import_batch(self, batch, pool, errors):
+        '''
+        Validate, hash and insert a batch of rows
+
+        :param batch:
+            A list of tuples of the line number and the row
+
+        :param pool:
+            The process pool hashing the passwords
+
+        :param errors:
+            The error file
+        '''
+        valid = []
+        for line, row in batch:
+            error = self._validate(row)
+            if error is None:
+                valid.append((line, row))
+            else:
+                self._reject(errors, line, row, error)
+
+        #De-duplicate against the database with a single query
+        taken = CustomerService.get_taken_emails(
+            [row['email'].lower() for _, row in valid]
+        )
+        records = []
+        for line, row in valid:
+            if row['email'].lower() in taken:
+                self._reject(errors, line, row, 'Email address already taken.')
+            else:
+                records.append(row)
+
+        hashes = pool.map(
+            hash_password,
+            [(row['password'], self.rounds) for row in records],
+            chunksize=64
+        )
+
+        for row, hashed in zip(records, hashes):
+            row['password'] = hashed
+            row['newsletter'] = to_bool(row.get('newsletter', False))
+
+        self.imported += CustomerService.add_customers(records)
+
+    def _validate(self, row):
+        '''
+        Check a row, return the reason of its rejection or None
+
+        :param row:
+            The row as a dict, None if it could not be parsed
+        '''
+        if row is None:
+            return 'Invalid line.'
+
+        email = (row.get('email') or '').strip()
+        if not EMAIL_REGEX.match(email):
+            return 'Invalid email address.'
+
+        if not row.get('password'):
+            return 'Missing password.'
+
+        #Duplicates within the file
+        if email.lower() in self.seen:
+            return 'Duplicated email address.'
+
+        self.seen.add(email.lower())
+        row['email'] = email
+
+        return None
+
+    def _reject(self, errors, line, row, error):
+        '''
+        Write a rejected row to the error file, without its password
+
+        :param errors:
+            The error file
+
+        :param line:
+            The line number of the row
+
+        :param row:
+            The row as a dict, None if it could not be parsed
+
+        :param error:
+            The reason of the rejection
+        '''
+        if row is not None:
+            row = dict(row)
+            row.pop('password', None)
+
+        errors.write(json.dumps(dict(line=line, error=error, row=row)))
+        errors.write('\n')
+        self.rejected += 1
@@ -0,0 +1,48 @@
+'''
+Contains the command moving the customers to the shard owning them
+'''
+
+from flask.ext.script import Command, Option
+from customers.common.services import CustomerService
+
+class RebalanceShards(Command):
+    '''
+    Move the customers stored on a shard which does not own their
+    slot any more, after a change of SQLALCHEMY_SHARDS. The writes
+    must be stopped while it runs.
+    '''
+
+    option_list = (
+        Option(
+            '-b', '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=1000,
+            help='Number of customers moved per transaction'
+        ),
+        Option(
+            '--dry-run',
+            dest='dry_run',
+            action='store_true',
+            default=False,
+            help='Only count the customers to move'
+        ),
+    )
+
+    def run(self, batch_size=1000, dry_run=False):
+        '''
+        Move the customers and print how many went from which shard
+        to which one
+        '''
+        moved = CustomerService.rebalance_shards(batch_size, dry_run)
+
+        for (source, target), count in sorted(moved.items()):
+            print('%s -> %s: %d customers' % (
+                source or 'default',
+                target or 'default',
+                count
+            ))
+        print('%d customers %s' % (
+            sum(moved.values()),
+            'to move' if dry_run else 'moved'
+        ))
@@ -0,0 +1,617 @@
+'''
+Contains the in-process caches used by the application
+'''
+
+import hmac
+import json
+import hashlib
+import time
+from collections import OrderedDict
+from threading import Lock
+from werkzeug.utils import import_string
+
+def _to_bytes(value):
+    '''
+    Encode a string to utf-8 unless it is already encoded
+
+    :param value:
+        A byte or unicode string
+    '''
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    return value
+
+class TTLCache(object):
+    '''
+    Bounded mapping whose entries expire after a fixed time to live.
+    Once the cache is full, the least recently used entry is evicted.
+    It is safe to share an instance between threads.
+    '''
+
+    def __init__(self, max_size=1024, ttl=300):
+        '''
+        Constructor for the TTLCache class
+
+        :param max_size:
+            Maximum number of entries to keep
+
+        :param ttl:
+            Number of seconds an entry stays valid
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        '''
+        Return the value stored for a key, or the default value if the
+        key is unknown or expired.
+
+        :param key:
+            The key to look up
+
+        :param default:
+            Value returned when there is no valid entry
+        '''
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.time():
+                return default
+
+            #Re-insert the entry to mark it as the most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        '''
+        Store a value for a key, evicting the least recently used
+        entry if the cache is full.
+
+        :param key:
+            The key to store the value under
+
+        :param value:
+            The value to store
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self._entries[key] = (time.time() + self.ttl, value)
+
+    def delete(self, key):
+        '''
+        Remove the entry of a key, if any
+
+        :param key:
+            The key to remove
+        '''
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        '''
+        Remove all the entries
+        '''
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class VerificationCache(object):
+    '''
+    Remember the successful password verifications, so that a
+    customer sending the same credentials again does not pay for
+    another bcrypt round.
+
+    There is one entry per email address, holding a HMAC digest of
+    the email, the clear password and the stored hash. The clear
+    password is never kept in memory, and a new stored hash can never
+    match an entry computed with the previous one.
+    '''
+
+    def __init__(self, app=None):
+        '''
+        Constructor for the VerificationCache class. The cache stays
+        disabled until it is initialized with an application.
+
+        :param app:
+            An optional Flask application
+        '''
+        self.enabled = False
+        self.hits = 0
+        self.misses = 0
+        self._secret = b''
+        self._entries = TTLCache()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Read the settings of the cache from the application config:
+        AUTH_CACHE_ENABLED, AUTH_CACHE_SIZE and AUTH_CACHE_TTL.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('AUTH_CACHE_ENABLED', False)
+        app.config.setdefault('AUTH_CACHE_SIZE', 10000)
+        app.config.setdefault('AUTH_CACHE_TTL', 300)
+
+        self.enabled = app.config['AUTH_CACHE_ENABLED']
+        self._secret = _to_bytes(app.config.get('SECRET_KEY') or '')
+        self._entries = TTLCache(
+            max_size=app.config['AUTH_CACHE_SIZE'],
+            ttl=app.config['AUTH_CACHE_TTL']
+        )
+
+    def _digest(self, email, password, password_hash):
+        '''
+        Compute the keyed digest of a set of credentials
+
+        :param email:
+            The email address of the customer
+
+        :param password:
+            Clear password
+
+        :param password_hash:
+            The hash currently stored for the customer
+        '''
+        message = b'\0'.join([
+            _to_bytes(email),
+            _to_bytes(password),
+            _to_bytes(password_hash)
+        ])
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def is_verified(self, email, password, password_hash):
+        '''
+        Check if these credentials have been verified recently
+
+        :param email:
+            The email address of the customer
+
+        :param password:
+            Clear password
+
+        :param password_hash:
+            The hash currently stored for the customer
+
+        Returns True on a cache hit, False otherwise
+        '''
+        if not self.enabled:
+            return False
+
+        digest = self._entries.get(email)
+        verified = digest is not None and hmac.compare_digest(
+            digest,
+            self._digest(email, password, password_hash)
+        )
+
+        with self._lock:
+            if verified:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return verified
+
+    def remember(self, email, password, password_hash):
+        '''
+        Store credentials which have just been verified with bcrypt
+
+        :param email:
+            The email address of the customer
+
+        :param password:
+            Clear password
+
+        :param password_hash:
+            The hash currently stored for the customer
+        '''
+        if self.enabled:
+            self._entries.set(
+                email,
+                self._digest(email, password, password_hash)
+            )
+
+    def invalidate(self, email):
+        '''
+        Forget the verified credentials of a customer, must be called
+        whenever its password changes.
+
+        :param email:
+            The email address of the customer
+        '''
+        self._entries.delete(email)
+
+    def reset_stats(self):
+        '''
+        Reset the hit/miss counters
+        '''
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''
+        Return the counters of the cache, each hit is a bcrypt round
+        which has been saved.
+        '''
+        return dict(
+            enabled=self.enabled,
+            hits=self.hits,
+            misses=self.misses,
+            size=len(self._entries),
+            evictions=self._entries.evictions
+        )
+
+class CountCache(object):
+    '''
+    Holds the strategy used to count the customers, and the total
+    remembered by the 'cached' strategy:
+
+     * exact: run a COUNT on every call
+     * cached: run a COUNT at most once every CUSTOMERS_COUNT_TTL
+       seconds, or after a customer has been added or deleted
+     * estimated: read the planner statistics of the database, falls
+       back to exact when the database has none
+    '''
+
+    MODES = ('exact', 'cached', 'estimated')
+
+    def __init__(self, app=None):
+        '''
+        Constructor for the CountCache class, it uses the exact
+        strategy until it is initialized with an application.
+
+        :param app:
+            An optional Flask application
+        '''
+        self.mode = 'exact'
+        self.ttl = 60
+        self._total = None
+        self._expires = 0
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Read the settings from the application config:
+        CUSTOMERS_COUNT_MODE and CUSTOMERS_COUNT_TTL.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('CUSTOMERS_COUNT_MODE', 'exact')
+        app.config.setdefault('CUSTOMERS_COUNT_TTL', 60)
+
+        if app.config['CUSTOMERS_COUNT_MODE'] not in self.MODES:
+            raise ValueError(
+                'CUSTOMERS_COUNT_MODE must be one of: %s' %
+                ', '.join(self.MODES)
+            )
+
+        self.mode = app.config['CUSTOMERS_COUNT_MODE']
+        self.ttl = app.config['CUSTOMERS_COUNT_TTL']
+        self.invalidate()
+
+    def get(self):
+        '''
+        Return the remembered total, None if it expired
+        '''
+        with self._lock:
+            if self._expires < time.time():
+                return None
+            return self._total
+
+    def set(self, total):
+        '''
+        Remember a total for the next CUSTOMERS_COUNT_TTL seconds
+
+        :param total:
+            The number of customers
+        '''
+        with self._lock:
+            self._total = total
+            self._expires = time.time() + self.ttl
+
+    def invalidate(self):
+        '''
+        Forget the remembered total
+        '''
+        with self._lock:
+            self._total = None
+            self._expires = 0
+
+class CacheBackend(object):
+    '''
+    Interface of the storage behind CustomerCache
+    '''
+
+    def get(self, key):
+        '''
+        Return the value stored for a key, None if there is none
+
+        :param key:
+            A string key
+        '''
+        raise NotImplementedError()
+
+    def set(self, key, value):
+        '''
+        Store a value which can be serialized to JSON
+
+        :param key:
+            A string key
+
+        :param value:
+            The value to store
+        '''
+        raise NotImplementedError()
+
+    def delete(self, key):
+        '''
+        Remove the value of a key, if any
+
+        :param key:
+            A string key
+        '''
+        raise NotImplementedError()
+
+    def stats(self):
+        '''
+        Return the counters specific to the backend
+        '''
+        return dict()
+
+class LocalCacheBackend(CacheBackend):
+    '''
+    In-process LRU backend, each worker has its own copy of the
+    records.
+    '''
+
+    def __init__(self, max_size=10000, ttl=30):
+        '''
+        Constructor for the LocalCacheBackend class
+
+        :param max_size:
+            Maximum number of entries to keep
+
+        :param ttl:
+            Number of seconds an entry stays valid
+        '''
+        self._entries = TTLCache(max_size=max_size, ttl=ttl)
+
+    def get(self, key):
+        return self._entries.get(key)
+
+    def set(self, key, value):
+        self._entries.set(key, value)
+
+    def delete(self, key):
+        self._entries.delete(key)
+
+    def stats(self):
+        return dict(
+            size=len(self._entries),
+            evictions=self._entries.evictions
+        )
+
+class SharedCacheBackend(CacheBackend):
+    '''
+    Backend shared between the workers, on top of a client with the
+    python-memcached interface: get(key), set(key, value, time) and
+    delete(key). Values are stored as JSON strings.
+    '''
+
+    def __init__(self, client, ttl=30, prefix='customers:'):
+        '''
+        Constructor for the SharedCacheBackend class
+
+        :param client:
+            A memcached-like client
+
+        :param ttl:
+            Number of seconds an entry stays valid
+
+        :param prefix:
+            Prefix of all the keys, to share a server between apps
+        '''
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, json.dumps(value), self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+class LocalSharedClient(object):
+    '''
+    Stand-in for a memcached client, keeping the values in a dict of
+    the current process. For tests and local development.
+    '''
+
+    def __init__(self, app=None):
+        '''
+        Constructor for the LocalSharedClient class
+
+        :param app:
+            The Flask application, unused
+        '''
+        self._values = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            expires, value = self._values.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=0):
+        with self._lock:
+            expires = time.time() + ttl if ttl else None
+            self._values[key] = (expires, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._values.pop(key, None)
+
+class CustomerCache(object):
+    '''
+    Read-through cache of the serialized customers, used by
+    CustomerService. A record, stored under the id of a customer,
+    holds its json representation and its password version.
+
+    Every change to a customer must call invalidate. The local backend
+    is only invalidated in the current process, other workers may
+    serve a stale record for up to CUSTOMER_CACHE_TTL seconds: use the
+    shared backend when that matters.
+    '''
+
+    def __init__(self, app=None):
+        '''
+        Constructor for the CustomerCache class. The cache stays
+        disabled until it is initialized with an application.
+
+        :param app:
+            An optional Flask application
+        '''
+        self.enabled = False
+        self.backend = LocalCacheBackend()
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Read the settings from the application config:
+        CUSTOMER_CACHE_ENABLED, CUSTOMER_CACHE_BACKEND ('local' or
+        'shared'), CUSTOMER_CACHE_SIZE, CUSTOMER_CACHE_TTL, and
+        CUSTOMER_CACHE_CLIENT, the import path of a factory taking the
+        application and returning a client for the shared backend.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('CUSTOMER_CACHE_ENABLED', False)
+        app.config.setdefault('CUSTOMER_CACHE_BACKEND', 'local')
+        app.config.setdefault('CUSTOMER_CACHE_SIZE', 10000)
+        app.config.setdefault('CUSTOMER_CACHE_TTL', 30)
+        app.config.setdefault(
+            'CUSTOMER_CACHE_CLIENT',
+            'customers.common.cache:LocalSharedClient'
+        )
+
+        self.enabled = app.config['CUSTOMER_CACHE_ENABLED']
+        ttl = app.config['CUSTOMER_CACHE_TTL']
+
+        if app.config['CUSTOMER_CACHE_BACKEND'] == 'shared':
+            factory = import_string(app.config['CUSTOMER_CACHE_CLIENT'])
+            self.backend = SharedCacheBackend(factory(app), ttl)
+        else:
+            self.backend = LocalCacheBackend(
+                app.config['CUSTOMER_CACHE_SIZE'],
+                ttl
+            )
+
+    def _get(self, key):
+        '''
+        Return the value of a key from the backend, counting the hits
+        and misses
+
+        :param key:
+            A string key
+        '''
+        if not self.enabled:
+            return None
+
+        value = self.backend.get(key)
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def get_record(self, customer_id):
+        '''
+        Return the record of a customer, None on a miss
+
+        :param customer_id:
+            The id of the customer
+        '''
+        return self._get('id:%s' % customer_id)
+
+    def set_record(self, customer_id, record):
+        '''
+        Store the record of a customer
+
+        :param customer_id:
+            The id of the customer
+
+        :param record:
+            A dict which can be serialized to JSON
+        '''
+        if self.enabled:
+            self.backend.set('id:%s' % customer_id, record)
+
+    def invalidate(self, customer_id):
+        '''
+        Forget the record of a customer
+
+        :param customer_id:
+            The id of the customer
+        '''
+        if self.enabled and customer_id is not None:
+            self.backend.delete('id:%s' % customer_id)
+
+    def reset_stats(self):
+        '''
+        Reset the hit/miss counters
+        '''
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''
+        Return the counters of the cache
+        '''
+        lookups = self.hits + self.misses
+        stats = dict(
+            enabled=self.enabled,
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=float(self.hits) / lookups if lookups else 0.0
+        )
+        stats.update(self.backend.stats())
+        return stats
@@ -0,0 +1,67 @@
+'''
+Contains the helpers for conditional requests, based on the version
+of the customers
+'''
+
+from flask import request, current_app, abort
+
+def customer_etag(customer_id, version):
+    '''
+    Return the strong entity tag of a customer representation, it
+    changes every time the customer is updated
+
+    :param customer_id:
+        The id of the customer
+
+    :param version:
+        The version of the customer
+    '''
+    return '%s-%s' % (customer_id, version)
+
+def not_modified(etag):
+    '''
+    Return a 304 response if the If-None-Match header of the request
+    matches an entity tag, None otherwise
+
+    :param etag:
+        The current entity tag, None if the resource does not exist
+    '''
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+def expected_version(customer_id):
+    '''
+    Return the version of a customer expected by the If-Match header
+    of the request, so that a client cannot overwrite changes it has
+    not seen. None without the header or with '*'. Aborts with a 412
+    if the header holds no entity tag of this customer.
+
+    :param customer_id:
+        The id of the customer
+    '''
+    if not request.if_match or request.if_match.star_tag:
+        return None
+
+    prefix = '%s-' % customer_id
+    for etag in request.if_match.as_set():
+        if etag.startswith(prefix) and etag[len(prefix):].isdigit():
+            return int(etag[len(prefix):])
+
+    abort(412)
+
+def with_etag(response, etag):
+    '''
+    Set the ETag header of a response and return it
+
+    :param response:
+        A response object
+
+    :param etag:
+        The entity tag
+    '''
+    response.set_etag(etag)
+    return response
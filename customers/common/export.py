@@ -0,0 +1,102 @@
+'''
+Contains the serializers streaming customer rows as NDJSON or CSV
+'''
+
+import csv
+import json
+from datetime import datetime
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+#Mimetype of each export format
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+def encode_csv_value(value):
+    '''
+    The python 2 csv module only writes byte strings, encode the
+    unicode ones to utf-8
+
+    :param value:
+        A column value
+    '''
+    if not isinstance(value, (str, bytes)) and hasattr(value, 'encode'):
+        return value.encode('utf-8')
+    return value
+
+def _format_value(value):
+    '''
+    Return a column value which can be serialized
+
+    :param value:
+        A column value
+    '''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def iter_ndjson(rows, columns):
+    '''
+    Serialize rows as JSON documents, one per line
+
+    :param rows:
+        An iterable of row tuples
+
+    :param columns:
+        The names of the columns of the rows
+    '''
+    for row in rows:
+        yield json.dumps(dict(
+            (column, _format_value(value))
+            for column, value in zip(columns, row)
+        )) + '\n'
+
+def iter_csv(rows, columns, flush_every=500):
+    '''
+    Serialize rows as CSV, with a header line
+
+    :param rows:
+        An iterable of row tuples
+
+    :param columns:
+        The names of the columns of the rows
+
+    :param flush_every:
+        Number of rows per yielded chunk
+    '''
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+
+    for index, row in enumerate(rows):
+        writer.writerow([
+            encode_csv_value(_format_value(value)) for value in row
+        ])
+        if index % flush_every == flush_every - 1:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+    yield buf.getvalue()
+
+def iter_export(rows, columns, export_format):
+    '''
+    Serialize rows in the given format, chunk by chunk
+
+    :param rows:
+        An iterable of row tuples
+
+    :param columns:
+        The names of the columns of the rows
+
+    :param export_format:
+        One of EXPORT_FORMATS
+    '''
+    if export_format == 'csv':
+        return iter_csv(rows, columns)
+    return iter_ndjson(rows, columns)
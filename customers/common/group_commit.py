@@ -0,0 +1,231 @@
+'''
+Contains the GroupCommitWriter class, which inserts the customers
+registered by concurrent requests in shared transactions.
+'''
+
+import os
+import time
+from threading import Thread, Lock, Condition, Event
+from sqlalchemy.orm import Session
+
+class PendingInsert(object):
+    '''
+    A customer waiting for the writer, and the outcome of its insert
+    '''
+
+    def __init__(self, shard, customer):
+        '''
+        Constructor for the PendingInsert class
+
+        :param shard:
+            The Shard of the customer
+
+        :param customer:
+            A new Customer instance
+        '''
+        self.shard = shard
+        self.customer = customer
+        self.error = None
+        self.done = Event()
+
+class GroupCommitWriter(object):
+    '''
+    Inserts the new customers submitted by the request threads of a
+    process in batches. A writer thread waits at most
+    GROUP_COMMIT_MAX_DELAY_MS milliseconds after the first pending
+    customer, or until GROUP_COMMIT_MAX_ROWS are pending, then inserts
+    them in one transaction per shard: the concurrent registrations
+    share a single commit, and its fsync.
+
+    When a transaction fails, its customers are inserted again in a
+    transaction each, so that each request gets its own error (e.g.
+    an email address registered in the meantime).
+
+    The thread is started on first use in each process, since threads
+    do not survive a fork.
+    '''
+
+    def __init__(self, app=None):
+        '''
+        Constructor for the GroupCommitWriter class
+
+        :param app:
+            An optional Flask application
+        '''
+        self.enabled = False
+        self.max_delay = 0.005
+        self.max_rows = 100
+        self.batches = 0
+        self.rows = 0
+        self.retries = 0
+        self._pending = []
+        self._condition = None
+        self._thread = None
+        self._pid = None
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Read the settings from the application config:
+        GROUP_COMMIT_ENABLED, GROUP_COMMIT_MAX_DELAY_MS and
+        GROUP_COMMIT_MAX_ROWS.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('GROUP_COMMIT_ENABLED', False)
+        app.config.setdefault('GROUP_COMMIT_MAX_DELAY_MS', 5)
+        app.config.setdefault('GROUP_COMMIT_MAX_ROWS', 100)
+
+        self.enabled = app.config['GROUP_COMMIT_ENABLED']
+        self.max_delay = app.config['GROUP_COMMIT_MAX_DELAY_MS'] / 1000.0
+        self.max_rows = app.config['GROUP_COMMIT_MAX_ROWS']
+
+    def submit(self, shard, customer):
+        '''
+        Insert a customer with the next batch and wait for it to be
+        committed. Its id is set once this returns, the error of its
+        insert is raised otherwise.
+
+        :param shard:
+            The Shard of the customer
+
+        :param customer:
+            A new Customer instance, which must not be used by the
+            calling thread until this returns
+        '''
+        pending = PendingInsert(shard, customer)
+        condition = self._get_condition()
+
+        with condition:
+            self._pending.append(pending)
+            condition.notify()
+
+        pending.done.wait()
+
+        if pending.error is not None:
+            raise pending.error
+
+    def _get_condition(self):
+        '''
+        Return the condition shared with the writer thread, which is
+        started on first use in each process
+        '''
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._condition = Condition()
+                self._pending = []
+                self._thread = Thread(
+                    target=self._run,
+                    name='group-commit-writer'
+                )
+                self._thread.daemon = True
+                self._thread.start()
+                self._pid = os.getpid()
+            return self._condition
+
+    def _run(self):
+        '''
+        Loop of the writer thread: wait for a batch and write it
+        '''
+        condition = self._condition
+
+        while True:
+            with condition:
+                while not self._pending:
+                    condition.wait()
+
+                deadline = time.time() + self.max_delay
+                while len(self._pending) < self.max_rows:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    condition.wait(remaining)
+
+                batch = self._pending[:self.max_rows]
+                del self._pending[:self.max_rows]
+
+            self._write(batch)
+
+    def _write(self, batch):
+        '''
+        Insert a batch in one transaction per shard and wake the
+        requests waiting for it
+
+        :param batch:
+            A list of PendingInsert
+        '''
+        groups = {}
+        for pending in batch:
+            groups.setdefault(pending.shard.bind, []).append(pending)
+
+        with self._lock:
+            self.batches += 1
+            self.rows += len(batch)
+
+        for group in groups.values():
+            try:
+                self._insert(group)
+            except Exception as error:
+                if len(group) == 1:
+                    group[0].error = error
+                else:
+                    self._retry(group)
+            finally:
+                for pending in group:
+                    pending.done.set()
+
+    def _retry(self, group):
+        '''
+        Insert the customers of a failed transaction one by one,
+        keeping the error of each one
+
+        :param group:
+            A list of PendingInsert of the same shard
+        '''
+        with self._lock:
+            self.retries += len(group)
+
+        for pending in group:
+            try:
+                self._insert([pending])
+            except Exception as error:
+                pending.error = error
+
+    @staticmethod
+    def _insert(group):
+        '''
+        Insert customers in one transaction, their attributes stay
+        loaded once the session is closed
+
+        :param group:
+            A list of PendingInsert of the same shard
+        '''
+        session = Session(
+            bind=group[0].shard.engine,
+            expire_on_commit=False
+        )
+        try:
+            session.add_all([pending.customer for pending in group])
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def stats(self):
+        '''
+        Return the counters of the writer: batches written, rows
+        inserted and rows inserted again alone after a failure
+        '''
+        with self._lock:
+            return dict(
+                batches=self.batches,
+                rows=self.rows,
+                retries=self.retries,
+                average_rows=self.rows / float(max(self.batches, 1))
+            )
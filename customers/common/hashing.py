@@ -0,0 +1,267 @@
+'''
+Contains the PasswordHasher class
+'''
+
+import os
+import time
+from threading import Lock, BoundedSemaphore
+from multiprocessing.pool import ThreadPool
+
+class HashingQueueFull(RuntimeError):
+    '''
+    Raised when a password operation waited too long for a slot in
+    the hashing queue. The request is answered with a 503, the client
+    should retry after retry_after seconds.
+    '''
+
+    def __init__(self, message, retry_after=1):
+        '''
+        Constructor for the HashingQueueFull class
+
+        :param message:
+            The error message
+
+        :param retry_after:
+            Number of seconds before the client should retry
+        '''
+        RuntimeError.__init__(self, message)
+        self.retry_after = retry_after
+
+class PasswordHasher(object):
+    '''
+    Runs the bcrypt operations of Flask-Bcrypt on a bounded pool of
+    threads (bcrypt releases the GIL while hashing), so that the
+    number of concurrent hashes is capped per process whatever the
+    number of request threads.
+
+    The cost factor comes from BCRYPT_LOG_ROUNDS, or is calibrated at
+    startup to the largest one whose hash time stays under
+    BCRYPT_TARGET_MS when BCRYPT_CALIBRATE is set.
+    '''
+
+    def __init__(self, bcrypt, app=None):
+        '''
+        Constructor for the PasswordHasher class
+
+        :param bcrypt:
+            The Flask-Bcrypt extension doing the actual hashing
+
+        :param app:
+            An optional Flask application
+        '''
+        self.bcrypt = bcrypt
+        self.rounds = 12
+        self.pool_size = 4
+        self.queue_size = 32
+        self.timeout = None
+        self.retry_after = 1
+        self.allowed = 0
+        self.shed = 0
+        self.operations = 0
+        self.busy_seconds = 0.0
+        self.waiting_seconds = 0.0
+        self.queue_depth = 0
+        self.active = 0
+        self._pool = None
+        self._pid = None
+        self._slots = None
+        self._lock = Lock()
+        #Functions called with the duration in seconds of each
+        # operation, queueing included, from the calling thread
+        self.listeners = []
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Read the settings from the application config:
+        BCRYPT_LOG_ROUNDS, BCRYPT_CALIBRATE, BCRYPT_TARGET_MS,
+        BCRYPT_MIN_LOG_ROUNDS, HASH_POOL_SIZE, HASH_POOL_QUEUE,
+        HASH_POOL_TIMEOUT and HASH_POOL_RETRY_AFTER.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('BCRYPT_CALIBRATE', False)
+        app.config.setdefault('BCRYPT_TARGET_MS', 250)
+        app.config.setdefault('BCRYPT_MIN_LOG_ROUNDS', 10)
+        app.config.setdefault('HASH_POOL_SIZE', 4)
+        app.config.setdefault('HASH_POOL_QUEUE', 32)
+        app.config.setdefault('HASH_POOL_TIMEOUT', None)
+        app.config.setdefault('HASH_POOL_RETRY_AFTER', 1)
+
+        self.pool_size = app.config['HASH_POOL_SIZE']
+        self.queue_size = app.config['HASH_POOL_QUEUE']
+        self.timeout = app.config['HASH_POOL_TIMEOUT']
+        self.retry_after = app.config['HASH_POOL_RETRY_AFTER']
+        self._slots = BoundedSemaphore(self.pool_size + self.queue_size)
+
+        if app.config['BCRYPT_CALIBRATE']:
+            self.rounds = self.calibrate(
+                app.config['BCRYPT_TARGET_MS'],
+                app.config['BCRYPT_MIN_LOG_ROUNDS']
+            )
+        else:
+            self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+    def calibrate(self, target_ms, min_rounds=10, sample_rounds=8):
+        '''
+        Return the largest cost factor whose hash time stays under a
+        target, each additional round doubling the time.
+
+        :param target_ms:
+            Target hash time in milliseconds
+
+        :param min_rounds:
+            Cost factor returned if the machine is too slow to reach
+            the target with it
+
+        :param sample_rounds:
+            Cost factor actually measured
+        '''
+        start = time.time()
+        self.bcrypt.generate_password_hash('calibration', sample_rounds)
+        sample_ms = max((time.time() - start) * 1000, 0.001)
+
+        rounds = sample_rounds
+        while rounds < 31:
+            if sample_ms * 2 ** (rounds + 1 - sample_rounds) > target_ms:
+                break
+            rounds += 1
+
+        return max(rounds, min_rounds)
+
+    def _get_pool(self):
+        '''
+        Return the thread pool, created on first use in each process
+        since threads do not survive a fork
+        '''
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = ThreadPool(self.pool_size)
+                self._pid = os.getpid()
+            return self._pool
+
+    def _run(self, func, *args):
+        '''
+        Run a bcrypt operation on the pool and wait for its result
+
+        :param func:
+            The operation
+
+        :param args:
+            Its parameters
+        '''
+        if self._slots is None:
+            self._slots = BoundedSemaphore(self.pool_size + self.queue_size)
+
+        if not self._acquire_slot():
+            with self._lock:
+                self.shed += 1
+            raise HashingQueueFull(
+                'More than %d password operations are pending' %
+                (self.pool_size + self.queue_size),
+                self.retry_after
+            )
+
+        submitted = time.time()
+        with self._lock:
+            self.allowed += 1
+            self.queue_depth += 1
+
+        def task():
+            started = time.time()
+            with self._lock:
+                self.queue_depth -= 1
+                self.active += 1
+                self.waiting_seconds += started - submitted
+            try:
+                return func(*args)
+            finally:
+                with self._lock:
+                    self.active -= 1
+                    self.operations += 1
+                    self.busy_seconds += time.time() - started
+
+        try:
+            return self._get_pool().apply_async(task).get()
+        finally:
+            self._slots.release()
+            for listener in self.listeners:
+                listener(time.time() - submitted)
+
+    def _acquire_slot(self):
+        '''
+        Wait for a slot in the queue, at most HASH_POOL_TIMEOUT
+        seconds if it is set (0 to shed the operation at once when
+        the queue is full). Returns False on timeout.
+        '''
+        if self.timeout is None:
+            return self._slots.acquire()
+
+        deadline = time.time() + self.timeout
+        while not self._slots.acquire(False):
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.001)
+        return True
+
+    def generate_password_hash(self, password):
+        '''
+        Hash a password with the current cost factor
+
+        :param password:
+            Clear password
+        '''
+        return self._run(
+            self.bcrypt.generate_password_hash,
+            password,
+            self.rounds
+        )
+
+    def check_password_hash(self, pw_hash, password):
+        '''
+        Check a password against a hash
+
+        :param pw_hash:
+            The stored hash
+
+        :param password:
+            Clear password
+        '''
+        return self._run(self.bcrypt.check_password_hash, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        '''
+        Check if a hash was computed with a lower cost factor than the
+        current one
+
+        :param pw_hash:
+            A bcrypt hash, as $2a$<rounds>$<salt and hash>
+        '''
+        try:
+            return int(pw_hash.split('$')[2]) < self.rounds
+        except (AttributeError, IndexError, ValueError):
+            return False
+
+    def stats(self):
+        '''
+        Return the counters of the pool, to size the workers
+        '''
+        with self._lock:
+            operations = max(self.operations, 1)
+            return dict(
+                rounds=self.rounds,
+                pool_size=self.pool_size,
+                queue_size=self.queue_size,
+                queue_depth=self.queue_depth,
+                active=self.active,
+                operations=self.operations,
+                allowed=self.allowed,
+                shed=self.shed,
+                busy_seconds=self.busy_seconds,
+                waiting_seconds=self.waiting_seconds,
+                average_ms=self.busy_seconds * 1000 / operations
+            )
@@ -0,0 +1,240 @@
+'''
+Contains the LoginLimiter class, which limits the failed logins per
+email address and per client address.
+'''
+
+import math
+import time
+from threading import Lock
+from flask import current_app
+from werkzeug.utils import import_string
+from customers.common.cache import LocalCacheBackend, SharedCacheBackend
+
+class LoginRateLimited(Exception):
+    '''
+    Raised when an email address or a client address has no failed
+    login left. The request is answered with a 429, the client should
+    retry after retry_after seconds.
+    '''
+
+    def __init__(self, retry_after):
+        '''
+        Constructor for the LoginRateLimited class
+
+        :param retry_after:
+            Number of seconds before a login may be attempted again
+        '''
+        Exception.__init__(self, 'Too many failed logins')
+        self.retry_after = retry_after
+
+class LoginLimiter(object):
+    '''
+    Token buckets of the failed logins: one per email address holding
+    LOGIN_LIMIT_PER_EMAIL tokens, and one per client address holding
+    LOGIN_LIMIT_PER_ADDRESS tokens. Each failed login takes a token
+    from both, an empty bucket refills completely in
+    LOGIN_LIMIT_PERIOD seconds. While a bucket is empty the logins are
+    rejected before running bcrypt, and a successful login refills the
+    bucket of its email address.
+
+    The buckets are stored in a cache backend: 'local' (per worker,
+    so the limits apply per worker) or 'shared' (client built by the
+    LOGIN_LIMIT_CLIENT factory, see CustomerCache). Two failures at
+    the same time may read the same bucket, the limits are
+    approximate by a few attempts.
+
+    The limits are read from the config of the current application
+    on every login, so that a test config loaded after startup
+    applies.
+    '''
+
+    def __init__(self, app=None):
+        '''
+        Constructor for the LoginLimiter class
+
+        :param app:
+            An optional Flask application
+        '''
+        self.backend = LocalCacheBackend()
+        self.allowed = 0
+        self.shed = 0
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Read the settings from the application config:
+        LOGIN_LIMIT_ENABLED, LOGIN_LIMIT_PER_EMAIL,
+        LOGIN_LIMIT_PER_ADDRESS, LOGIN_LIMIT_PERIOD,
+        LOGIN_LIMIT_PROXY_HEADER, and for the store
+        LOGIN_LIMIT_BACKEND ('local' or 'shared'), LOGIN_LIMIT_SIZE
+        and LOGIN_LIMIT_CLIENT.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('LOGIN_LIMIT_ENABLED', False)
+        app.config.setdefault('LOGIN_LIMIT_PER_EMAIL', 5)
+        app.config.setdefault('LOGIN_LIMIT_PER_ADDRESS', 50)
+        app.config.setdefault('LOGIN_LIMIT_PERIOD', 300)
+        app.config.setdefault('LOGIN_LIMIT_PROXY_HEADER', None)
+        app.config.setdefault('LOGIN_LIMIT_BACKEND', 'local')
+        app.config.setdefault('LOGIN_LIMIT_SIZE', 100000)
+        app.config.setdefault(
+            'LOGIN_LIMIT_CLIENT',
+            'customers.common.cache:LocalSharedClient'
+        )
+
+        #A full bucket does not need to be stored
+        ttl = app.config['LOGIN_LIMIT_PERIOD']
+
+        if app.config['LOGIN_LIMIT_BACKEND'] == 'shared':
+            factory = import_string(app.config['LOGIN_LIMIT_CLIENT'])
+            self.backend = SharedCacheBackend(
+                factory(app),
+                ttl,
+                prefix='customers:login:'
+            )
+        else:
+            self.backend = LocalCacheBackend(
+                app.config['LOGIN_LIMIT_SIZE'],
+                ttl
+            )
+
+    def client_address(self, request):
+        '''
+        Return the address of the client of a request, from the
+        LOGIN_LIMIT_PROXY_HEADER header (e.g. X-Real-IP) when the
+        application runs behind a proxy setting it
+
+        :param request:
+            The current request
+        '''
+        header = current_app.config['LOGIN_LIMIT_PROXY_HEADER']
+        if header and request.headers.get(header):
+            return request.headers[header].strip()
+        return request.remote_addr
+
+    def _buckets(self, email, address):
+        '''
+        Return the (key, capacity) of the buckets of a login
+
+        :param email:
+            The email address of the login
+
+        :param address:
+            The client address, or None
+        '''
+        config = current_app.config
+        buckets = [
+            ('email:%s' % (email or '').lower(),
+             config['LOGIN_LIMIT_PER_EMAIL'])
+        ]
+        if address:
+            buckets.append((
+                'address:%s' % address,
+                config['LOGIN_LIMIT_PER_ADDRESS']
+            ))
+        return buckets
+
+    def _tokens(self, key, capacity, now):
+        '''
+        Return the number of tokens of a bucket
+
+        :param key:
+            The key of the bucket
+
+        :param capacity:
+            The number of tokens of a full bucket
+
+        :param now:
+            The current timestamp
+        '''
+        state = self.backend.get(key)
+        if state is None:
+            return float(capacity)
+
+        tokens, updated = state
+        refill = (now - updated) * capacity / current_app.config[
+            'LOGIN_LIMIT_PERIOD'
+        ]
+        return min(float(capacity), tokens + refill)
+
+    def check(self, email, address):
+        '''
+        Make sure that a login may be attempted, raises
+        LoginRateLimited otherwise
+
+        :param email:
+            The email address of the login
+
+        :param address:
+            The client address, or None
+        '''
+        if not current_app.config['LOGIN_LIMIT_ENABLED']:
+            return
+
+        period = current_app.config['LOGIN_LIMIT_PERIOD']
+        now = time.time()
+        retry_after = 0
+
+        for key, capacity in self._buckets(email, address):
+            tokens = self._tokens(key, capacity, now)
+            if tokens < 1:
+                retry_after = max(
+                    retry_after,
+                    (1 - tokens) * period / float(capacity)
+                )
+
+        with self._lock:
+            if retry_after:
+                self.shed += 1
+            else:
+                self.allowed += 1
+
+        if retry_after:
+            raise LoginRateLimited(int(math.ceil(retry_after)))
+
+    def record_failure(self, email, address):
+        '''
+        Take a token from the buckets of a failed login
+
+        :param email:
+            The email address of the login
+
+        :param address:
+            The client address, or None
+        '''
+        if not current_app.config['LOGIN_LIMIT_ENABLED']:
+            return
+
+        now = time.time()
+        for key, capacity in self._buckets(email, address):
+            tokens = self._tokens(key, capacity, now)
+            self.backend.set(key, [max(tokens - 1, 0.0), now])
+
+    def record_success(self, email):
+        '''
+        Refill the bucket of the email address of a successful login
+
+        :param email:
+            The email address of the login
+        '''
+        if current_app.config['LOGIN_LIMIT_ENABLED']:
+            self.backend.delete('email:%s' % (email or '').lower())
+
+    def reset_stats(self):
+        '''
+        Reset the allowed/shed counters
+        '''
+        with self._lock:
+            self.allowed = 0
+            self.shed = 0
+
+    def stats(self):
+        '''
+        Return the counters of the limiter
+        '''
+        return dict(allowed=self.allowed, shed=self.shed)
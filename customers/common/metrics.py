@@ -0,0 +1,326 @@
+'''
+Contains the Metrics class, which records per endpoint measures and
+renders them in the Prometheus text format.
+'''
+
+import time
+from threading import Lock
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#Upper bounds of the buckets of the latency histogram, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+#Upper bounds of the buckets of the statements per request histogram
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+class Histogram(object):
+    '''
+    Cumulative histogram, as exposed by Prometheus
+    '''
+
+    def __init__(self, buckets):
+        '''
+        Constructor for the Histogram class
+
+        :param buckets:
+            Sorted upper bounds of the buckets, +Inf is implicit
+        '''
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        '''
+        Record a value
+
+        :param value:
+            The measure
+        '''
+        self.count += 1
+        self.total += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+class EndpointMetrics(object):
+    '''
+    Measures of the requests of one endpoint
+    '''
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.statuses = {}
+        self.sql_seconds = 0.0
+        self.bcrypt_seconds = 0.0
+        self.bcrypt_operations = 0
+        self.response_bytes = 0
+
+class Metrics(object):
+    '''
+    Records, per endpoint (front.profile, back.get_all...): the
+    latency, the number and duration of the SQL statements, the time
+    spent in bcrypt and the size of the responses.
+
+    The password operations and the logins allowed or shed by the
+    PasswordHasher and the LoginLimiter are rendered from their own
+    counters.
+
+    When METRICS_ENABLED is False, no SQLAlchemy or hasher listener
+    is installed and the request hooks return straight away.
+    '''
+
+    def __init__(self, hasher, login_limiter, app=None):
+        '''
+        Constructor for the Metrics class
+
+        :param hasher:
+            The PasswordHasher whose operations are timed
+
+        :param login_limiter:
+            The LoginLimiter of the failed logins
+
+        :param app:
+            An optional Flask application
+        '''
+        self.hasher = hasher
+        self.login_limiter = login_limiter
+        self.enabled = False
+        self._endpoints = {}
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Install the request hooks and read the settings from the
+        application config: METRICS_ENABLED.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('METRICS_ENABLED', False)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+        if app.config['METRICS_ENABLED']:
+            self.enable()
+        else:
+            self.disable()
+
+    def enable(self):
+        '''
+        Start recording
+        '''
+        if self.enabled:
+            return
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        self.hasher.listeners.append(self._record_bcrypt)
+        self.enabled = True
+
+    def disable(self):
+        '''
+        Stop recording, the measures already recorded are kept
+        '''
+        if not self.enabled:
+            return
+        event.remove(Engine, 'before_cursor_execute', self._before_execute)
+        event.remove(Engine, 'after_cursor_execute', self._after_execute)
+        self.hasher.listeners.remove(self._record_bcrypt)
+        self.enabled = False
+
+    def reset(self):
+        '''
+        Forget all the measures
+        '''
+        with self._lock:
+            self._endpoints = {}
+
+    def _before_request(self):
+        if not self.enabled:
+            return
+        g.metrics_started = time.time()
+        g.metrics_statements = 0
+        g.metrics_sql_seconds = 0.0
+        g.metrics_bcrypt_seconds = 0.0
+        g.metrics_bcrypt_operations = 0
+
+    def _after_request(self, response):
+        started = g.get('metrics_started')
+        if started is None:
+            return response
+
+        #Streamed responses have no length until they are consumed
+        size = response.calculate_content_length() or 0
+        endpoint = request.endpoint or 'unknown'
+
+        with self._lock:
+            metrics = self._endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self._endpoints[endpoint] = EndpointMetrics()
+            metrics.latency.observe(time.time() - started)
+            metrics.statements.observe(g.metrics_statements)
+            metrics.statuses[response.status_code] = \
+                metrics.statuses.get(response.status_code, 0) + 1
+            metrics.sql_seconds += g.metrics_sql_seconds
+            metrics.bcrypt_seconds += g.metrics_bcrypt_seconds
+            metrics.bcrypt_operations += g.metrics_bcrypt_operations
+            metrics.response_bytes += size
+
+        return response
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany):
+        conn.info.setdefault('metrics_started', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        stack = conn.info.get('metrics_started')
+        if not stack:
+            return
+        started = stack.pop()
+        if not has_request_context() or g.get('metrics_started') is None:
+            return
+        g.metrics_statements += 1
+        g.metrics_sql_seconds += time.time() - started
+
+    def _record_bcrypt(self, seconds):
+        if not has_request_context() or g.get('metrics_started') is None:
+            return
+        g.metrics_bcrypt_operations += 1
+        g.metrics_bcrypt_seconds += seconds
+
+    def render(self):
+        '''
+        Return the measures in the Prometheus text format
+        '''
+        families = (
+            ('customers_request_duration_seconds', 'histogram',
+             'Latency of the requests'),
+            ('customers_requests_total', 'counter',
+             'Requests by status code'),
+            ('customers_sql_statements', 'histogram',
+             'SQL statements run per request'),
+            ('customers_sql_duration_seconds_total', 'counter',
+             'Time spent running SQL statements'),
+            ('customers_bcrypt_operations_total', 'counter',
+             'Password hashes and checks'),
+            ('customers_bcrypt_duration_seconds_total', 'counter',
+             'Time spent waiting for bcrypt, queueing included'),
+            ('customers_response_bytes_total', 'counter',
+             'Size of the response bodies, streamed ones excluded'),
+        )
+
+        with self._lock:
+            endpoints = sorted(self._endpoints.items())
+            lines = []
+            for name, kind, description in families:
+                lines.append('# HELP %s %s' % (name, description))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for endpoint, metrics in endpoints:
+                    lines.extend(
+                        _render_family(name, endpoint, metrics)
+                    )
+
+        lines.extend(_render_admission(dict(
+            password=self.hasher.stats(),
+            login=self.login_limiter.stats()
+        )))
+
+        return '\n'.join(lines) + '\n'
+
+def _render_family(name, endpoint, metrics):
+    '''
+    Return the lines of a metric family for an endpoint
+
+    :param name:
+        The name of the family
+
+    :param endpoint:
+        The name of the endpoint
+
+    :param metrics:
+        Its EndpointMetrics
+    '''
+    label = 'endpoint="%s"' % endpoint
+
+    if name == 'customers_request_duration_seconds':
+        return _render_histogram(name, label, metrics.latency)
+    if name == 'customers_sql_statements':
+        return _render_histogram(name, label, metrics.statements)
+    if name == 'customers_requests_total':
+        return [
+            '%s{%s,status="%d"} %d' % (name, label, status, count)
+            for status, count in sorted(metrics.statuses.items())
+        ]
+
+    value = {
+        'customers_sql_duration_seconds_total': metrics.sql_seconds,
+        'customers_bcrypt_operations_total': metrics.bcrypt_operations,
+        'customers_bcrypt_duration_seconds_total': metrics.bcrypt_seconds,
+        'customers_response_bytes_total': metrics.response_bytes,
+    }[name]
+    return ['%s{%s} %s' % (name, label, _format_number(value))]
+
+def _render_admission(limiters):
+    '''
+    Return the lines of the requests allowed or shed by the limiters
+
+    :param limiters:
+        Dictionary of the stats of each limiter, by name
+    '''
+    name = 'customers_admission_total'
+    lines = [
+        '# HELP %s Operations allowed or shed by the limiters' % name,
+        '# TYPE %s counter' % name,
+    ]
+    for limiter, stats in sorted(limiters.items()):
+        for outcome in ('allowed', 'shed'):
+            lines.append('%s{limiter="%s",outcome="%s"} %d' % (
+                name, limiter, outcome, stats[outcome]
+            ))
+    return lines
+
+def _render_histogram(name, label, histogram):
+    '''
+    Return the lines of a histogram
+
+    :param name:
+        The name of the family
+
+    :param label:
+        The label of the endpoint
+
+    :param histogram:
+        The Histogram to render
+    '''
+    lines = [
+        '%s_bucket{%s,le="%s"} %d' % (
+            name, label, _format_number(bound), count
+        )
+        for bound, count in zip(histogram.buckets, histogram.counts)
+    ]
+    lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+        name, label, histogram.count
+    ))
+    lines.append('%s_sum{%s} %s' % (
+        name, label, _format_number(histogram.total)
+    ))
+    lines.append('%s_count{%s} %d' % (name, label, histogram.count))
+    return lines
+
+def _format_number(value):
+    '''
+    Format a number the way Prometheus expects it
+
+    :param value:
+        An int or a float
+    '''
+    return repr(float(value)) if isinstance(value, float) else str(value)
@@ -2,8 +2,11 @@
 Contains the Customer class
 '''
 
+import sqlite3
+import hashlib
+from sqlalchemy import func, event, DDL
 from sqlalchemy.orm import relationship
-from customers.utils import db, bcrypt
+from customers.utils import db, hasher, auth_cache, customer_cache
 from customers.common.models.customer_data import CustomerData
 
 class Customer(db.Model):
@@ -11,22 +14,39 @@ class Customer(db.Model):
     A customer represents a set of email/bcrypt hashed password,
     required to access authorized parts of the application.
     It has a 1-1 relationship with CustomerData which holds more
-    information.
+    information. Its version is incremented by CustomerService on
+    every update of the customer or of its data.
     '''
 
     __tablename__ = 'customer'
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String)
+    #Lower case part of the email after the @, to filter on
+    email_domain = db.Column(db.String)
     password = db.Column(db.String)
+    #False once soft deleted, see CustomerService.delete_customers_by_ids
     active = db.Column(db.Boolean)
-    data = relationship('CustomerData', uselist=False, backref='customer')
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1'
+    )
+    #The data is deleted by the database with the customer
+    data = relationship(
+        'CustomerData',
+        uselist=False,
+        backref='customer',
+        cascade='all, delete-orphan',
+        passive_deletes=True
+    )
 
     def __init__(self, email='', password=''):
         '''
         Constructor for the Customer class, it will initialize a
         customer with an email and a CLEAR password, which will be
-        encrypted. This customer will be disabled by default, and
-        its data will be initialized empty.
+        encrypted. This customer will be active until it is soft
+        deleted, and its data will be initialized empty.
 
         :param email:
             The email address of the customer
@@ -35,30 +55,36 @@ class Customer(db.Model):
             Clear password of the customer
         '''
         self.email = email
+        self.email_domain = Customer.domain_of(email)
         self.set_password(password)
-        self.active = False
+        self.active = True
+        self.version = 1
         self.data = CustomerData()
 
     def set_password(self, password):
         '''
-        Hash a password using bcrypt
+        Hash a password using bcrypt, the previously verified
+        credentials and the cached record of this customer are
+        forgotten.
 
         :param password:
             Clear password to set
         '''
         self.password = self.hash_password(password)
+        auth_cache.invalidate(self.email)
+        customer_cache.invalidate(self.id)
 
     @staticmethod
     def hash_password(password):
         '''
-        Generate a hash for the given password
+        Generate a hash for the given password, on the hashing pool
 
         :param password:
             Clear password
 
         Returns a hashed password
         '''
-        return bcrypt.generate_password_hash(password)
+        return hasher.generate_password_hash(password)
 
     def check_password(self, other_password):
         '''
@@ -69,18 +95,151 @@ class Customer(db.Model):
 
         Returns true if the password matches, false otherwise
         '''
-        return bcrypt.check_password_hash(
+        if auth_cache.is_verified(self.email, other_password, self.password):
+            return True
+
+        result = hasher.check_password_hash(
             self.password,
             other_password
         )
 
+        if result:
+            auth_cache.remember(self.email, other_password, self.password)
+
+        return result
+
+    def needs_rehash(self):
+        '''
+        Returns true if the password hash was computed with a lower
+        cost factor than the current one
+        '''
+        return hasher.needs_rehash(self.password)
+
+    @property
+    def password_version(self):
+        '''
+        Return a short fingerprint of the stored hash, which changes
+        every time the password is changed.
+        '''
+        return Customer.fingerprint(self.password)
+
+    @staticmethod
+    def fingerprint(password):
+        '''
+        Return the password version of a stored hash, see
+        password_version
+
+        :param password:
+            A password hash
+        '''
+        if not isinstance(password, bytes):
+            password = password.encode('utf-8')
+        return hashlib.sha1(password).hexdigest()[:16]
+
+    @staticmethod
+    def domain_of(email):
+        '''
+        Return the lower case domain of an email address
+
+        :param email:
+            The email address
+        '''
+        return (email or '').rpartition('@')[2].lower()
+
+    @staticmethod
+    def to_json(customer_id, email, data):
+        '''
+        Return a json representation of a customer from the column
+        values, e.g. a row returned by a query
+
+        :param customer_id:
+            The id of the customer
+
+        :param email:
+            The email address of the customer
+
+        :param data:
+            The json representation of its CustomerData
+        '''
+        return dict(
+            id=customer_id,
+            email=email,
+            data=data
+        )
+
     @property
     def json(self):
         '''
         Return a json representation of a customer
         '''
-        return dict(
-            id=self.id,
-            email=self.email,
-            data=self.data.json
+        return Customer.to_json(self.id, self.email, self.data.json)
+
+#Case insensitive lookups and uniqueness of the email addresses
+db.Index('ix_customer_email_lower', func.lower(Customer.email), unique=True)
+
+#Filters and sort keys of the customer list, see
+# CustomerService.LIST_INDEXES
+db.Index('ix_customer_active_id', Customer.active, Customer.id)
+db.Index('ix_customer_email_domain_id', Customer.email_domain, Customer.id)
+
+#Substring search on the email, names and cellphone, see
+# CustomerService.search_customers: trigram indexes on Postgres, a
+# trigram FTS5 table kept up to date by triggers on SQLite (3.34+),
+# older SQLite versions fall back on LIKE without an index
+SQLITE_TRIGRAM = sqlite3.sqlite_version_info >= (3, 34)
+
+SEARCH_DDL = dict(
+    postgresql=(
+        'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+        'CREATE INDEX ix_customer_email_trgm ON customer '
+        'USING gin (lower(email) gin_trgm_ops)',
+        'CREATE INDEX ix_customer_data_first_name_trgm ON customer_data '
+        'USING gin (lower(first_name) gin_trgm_ops)',
+        'CREATE INDEX ix_customer_data_last_name_trgm ON customer_data '
+        'USING gin (lower(last_name) gin_trgm_ops)',
+        'CREATE INDEX ix_customer_data_cellphone_trgm ON customer_data '
+        'USING gin (cellphone gin_trgm_ops)',
+    ),
+    sqlite=(
+        "CREATE VIRTUAL TABLE customer_search USING fts5("
+        "email, first_name, last_name, cellphone, tokenize='trigram')",
+        'CREATE TRIGGER customer_search_insert AFTER INSERT '
+        'ON customer_data BEGIN '
+        'INSERT INTO customer_search '
+        '(rowid, email, first_name, last_name, cellphone) '
+        'SELECT new.customer_id, email, new.first_name, new.last_name, '
+        'new.cellphone FROM customer WHERE id = new.customer_id; END',
+        'CREATE TRIGGER customer_search_update AFTER UPDATE '
+        'ON customer_data BEGIN '
+        'DELETE FROM customer_search WHERE rowid = old.customer_id; '
+        'INSERT INTO customer_search '
+        '(rowid, email, first_name, last_name, cellphone) '
+        'SELECT new.customer_id, email, new.first_name, new.last_name, '
+        'new.cellphone FROM customer WHERE id = new.customer_id; END',
+        'CREATE TRIGGER customer_search_delete AFTER DELETE '
+        'ON customer_data BEGIN '
+        'DELETE FROM customer_search WHERE rowid = old.customer_id; END',
+        'CREATE TRIGGER customer_search_email AFTER UPDATE OF email '
+        'ON customer BEGIN '
+        'UPDATE customer_search SET email = new.email '
+        'WHERE rowid = new.id; END',
+    )
+)
+
+for _dialect, _statements in SEARCH_DDL.items():
+    if _dialect == 'sqlite' and not SQLITE_TRIGRAM:
+        continue
+    for _statement in _statements:
+        event.listen(
+            CustomerData.__table__,
+            'after_create',
+            DDL(_statement).execute_if(dialect=_dialect)
         )
+
+event.listen(
+    CustomerData.__table__,
+    'before_drop',
+    DDL('DROP TABLE IF EXISTS customer_search').execute_if(
+        dialect='sqlite'
+    )
+)
@@ -4,6 +4,7 @@ Contains the CustomerData class
 
 from datetime import datetime
 from customers.utils import db
+from customers.common.serializers import format_date
 
 class CustomerData(db.Model):
     '''
@@ -17,7 +18,12 @@ class CustomerData(db.Model):
 
     #I dont like the idea of a separate PK for this
     id = db.Column(db.Integer, primary_key=True)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'))
+    customer_id = db.Column(
+        db.Integer,
+        db.ForeignKey('customer.id', ondelete='CASCADE'),
+        unique=True,
+        index=True
+    )
     first_name = db.Column(db.String)
     last_name = db.Column(db.String)
     cellphone = db.Column(db.String)
@@ -55,15 +61,72 @@ class CustomerData(db.Model):
         self.newsletter = newsletter
         self.created = datetime.now()
 
+    #Columns which can be changed by the customers and the admins
+    EDITABLE_COLUMNS = ('first_name', 'last_name', 'cellphone', 'newsletter')
+
+    @staticmethod
+    def to_json(first_name, last_name, cellphone, newsletter, created):
+        '''
+        Return a json representation of customer data from the column
+        values, e.g. a row returned by a query
+
+        :param first_name:
+            The first name of the customer
+
+        :param last_name:
+            The last name of the customer
+
+        :param cellphone:
+            The cellphone number of the customer
+
+        :param newsletter:
+            The newsletter flag of the customer
+
+        :param created:
+            The creation datetime of the customer
+        '''
+        return dict(
+            first_name=first_name,
+            last_name=last_name,
+            cellphone=cellphone,
+            newsletter=newsletter,
+            created=format_date(created)
+        )
+
     @property
     def json(self):
         '''
         Return a json representation of customer data
         '''
-        return dict(
-            first_name=self.first_name,
-            last_name=self.last_name,
-            cellphone=self.cellphone,
-            newsletter=self.newsletter,
-            created=self.created.strftime('%Y/%m/%d')
+        return CustomerData.to_json(
+            self.first_name,
+            self.last_name,
+            self.cellphone,
+            self.newsletter,
+            self.created
         )
+
+#Filters and sort keys of the customer list, the customer id breaks
+# the ties. See CustomerService.LIST_INDEXES.
+db.Index(
+    'ix_customer_data_created',
+    CustomerData.created,
+    CustomerData.customer_id
+)
+db.Index(
+    'ix_customer_data_newsletter_created',
+    CustomerData.newsletter,
+    CustomerData.created,
+    CustomerData.customer_id
+)
+db.Index(
+    'ix_customer_data_last_name',
+    CustomerData.last_name,
+    CustomerData.customer_id
+)
+db.Index(
+    'ix_customer_data_newsletter_last_name',
+    CustomerData.newsletter,
+    CustomerData.last_name,
+    CustomerData.customer_id
+)
@@ -0,0 +1,17 @@
+'''
+Contains the CustomerIdSlot class
+'''
+
+from customers.utils import db
+
+class CustomerIdSlot(db.Model):
+    '''
+    Allocates the ids of the customers of a slot when they are
+    sharded: the ids of slot s are seq * SHARD_SLOTS + s, and last_seq
+    is the last seq handed out. The row is stored on the shard owning
+    the slot, see CustomerService.add_customers.
+    '''
+
+    __tablename__ = 'customer_id_slot'
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    last_seq = db.Column(db.BigInteger, nullable=False)
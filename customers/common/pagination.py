@@ -0,0 +1,62 @@
+'''
+Contains the helpers for keyset (cursor) pagination
+'''
+
+import json
+import base64
+import binascii
+from datetime import datetime
+
+#Format of the datetimes in the cursors, microseconds included
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+def encode_cursor(*values):
+    '''
+    Encode the sort key of the last row of a page into an opaque
+    cursor, which the client sends back to get the next page.
+
+    :param values:
+        The values of the sort key, e.g. the id of the last customer.
+        The datetimes are formatted with DATETIME_FORMAT.
+    '''
+    values = [
+        value.strftime(DATETIME_FORMAT) if isinstance(value, datetime)
+        else value
+        for value in values
+    ]
+    payload = json.dumps(values, separators=(',', ':'))
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    '''
+    Decode a cursor built with encode_cursor
+
+    :param cursor:
+        The opaque cursor sent by the client
+
+    Returns the list of values of the sort key, raises a ValueError if
+    the cursor is not valid.
+    '''
+    try:
+        payload = base64.urlsafe_b64decode(str(cursor))
+        values = json.loads(payload.decode('utf-8'))
+    except (TypeError, ValueError, binascii.Error):
+        raise ValueError('Invalid cursor')
+
+    if not isinstance(values, list):
+        raise ValueError('Invalid cursor')
+
+    return values
+
+def parse_cursor_datetime(value):
+    '''
+    Return the datetime of a cursor value, raises a ValueError if it
+    is not a datetime formatted by encode_cursor
+
+    :param value:
+        A value of a decoded cursor
+    '''
+    try:
+        return datetime.strptime(value, DATETIME_FORMAT)
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
@@ -0,0 +1,186 @@
+'''
+Contains the QueryMonitor class, which logs the slow SQL statements
+and detects the statements repeated within a request (N+1 queries).
+'''
+
+import sys
+import time
+import logging
+from flask import g, request, current_app, has_app_context,\
+    has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+#Logger of the statements run outside of an application context,
+# e.g. by the group commit writer
+logger = logging.getLogger(__name__)
+
+class RepeatedQueryError(RuntimeError):
+    '''
+    Raised when QUERY_REPEAT_MODE is 'raise' and a request runs the
+    same statement more than QUERY_REPEAT_LIMIT times
+    '''
+
+class QueryMonitor(object):
+    '''
+    Watches the statements of every engine:
+
+     * the ones lasting at least SLOW_QUERY_MS milliseconds are logged
+       with their parameters, the calling CustomerService method and
+       the endpoint (None disables the log)
+     * within a request, a statement run more than QUERY_REPEAT_LIMIT
+       times is reported according to QUERY_REPEAT_MODE: 'off',
+       'warn' (logged once per request) or 'raise'
+
+    The settings are read from the config of the current application
+    on every statement, so that a test config loaded after startup
+    applies. Outside of an application context, the SLOW_QUERY_MS of
+    the startup config applies. The listeners are only installed when
+    at least one of the checks is enabled at startup.
+    '''
+
+    MODES = ('off', 'warn', 'raise')
+
+    def __init__(self, app=None):
+        '''
+        Constructor for the QueryMonitor class
+
+        :param app:
+            An optional Flask application
+        '''
+        self.enabled = False
+        self.slow_query_ms = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Read the settings from the application config: SLOW_QUERY_MS,
+        QUERY_REPEAT_LIMIT and QUERY_REPEAT_MODE.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('SLOW_QUERY_MS', None)
+        app.config.setdefault('QUERY_REPEAT_LIMIT', 10)
+        app.config.setdefault('QUERY_REPEAT_MODE', 'off')
+
+        if app.config['QUERY_REPEAT_MODE'] not in self.MODES:
+            raise ValueError(
+                'QUERY_REPEAT_MODE must be one of: %s' %
+                ', '.join(self.MODES)
+            )
+
+        self.slow_query_ms = app.config['SLOW_QUERY_MS']
+
+        if app.config['SLOW_QUERY_MS'] is not None or \
+                app.config['QUERY_REPEAT_MODE'] != 'off':
+            self.enable()
+        else:
+            self.disable()
+
+    def enable(self):
+        '''
+        Install the listeners
+        '''
+        if self.enabled:
+            return
+        event.listen(Engine, 'before_cursor_execute', self._before_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_execute)
+        event.listen(Engine, 'handle_error', self._handle_error)
+        self.enabled = True
+
+    def disable(self):
+        '''
+        Remove the listeners
+        '''
+        if not self.enabled:
+            return
+        event.remove(Engine, 'before_cursor_execute', self._before_execute)
+        event.remove(Engine, 'after_cursor_execute', self._after_execute)
+        event.remove(Engine, 'handle_error', self._handle_error)
+        self.enabled = False
+
+    def _before_execute(self, conn, cursor, statement, parameters,
+                        context, executemany):
+        conn.info.setdefault('query_started', []).append(time.time())
+
+    def _after_execute(self, conn, cursor, statement, parameters,
+                       context, executemany):
+        stack = conn.info.get('query_started')
+        if not stack:
+            return
+        duration_ms = (time.time() - stack.pop()) * 1000
+
+        if has_app_context():
+            config = current_app.config
+            threshold = config.get('SLOW_QUERY_MS')
+            log = current_app.logger
+        else:
+            config = {}
+            threshold = self.slow_query_ms
+            log = logger
+
+        if threshold is not None and duration_ms >= threshold:
+            log.warning(
+                'Slow query (%.1f ms) from %s on %s: %s %r',
+                duration_ms, _caller(), _endpoint(), statement, parameters
+            )
+
+        mode = config.get('QUERY_REPEAT_MODE', 'off')
+        if mode == 'off' or not has_request_context():
+            return
+
+        counts = g.get('query_counts')
+        if counts is None:
+            counts = g.query_counts = {}
+        count = counts[statement] = counts.get(statement, 0) + 1
+
+        limit = config.get('QUERY_REPEAT_LIMIT', 10)
+        if count != limit + 1:
+            return
+
+        message = 'Statement run more than %d times from %s on %s: %s' % (
+            limit, _caller(), _endpoint(), statement
+        )
+        if mode == 'raise':
+            raise RepeatedQueryError(message)
+        current_app.logger.warning(message)
+
+    def _handle_error(self, context):
+        '''
+        Forget the start of a failed statement, after_cursor_execute
+        is not called for it
+        '''
+        if context.connection is not None:
+            del context.connection.info.get('query_started', [])[:]
+
+def _endpoint():
+    '''
+    Return the endpoint of the current request, None outside of a
+    request
+    '''
+    if has_request_context():
+        return request.endpoint
+    return None
+
+def _caller():
+    '''
+    Return the CustomerService method running the statement, or the
+    innermost function of the application when it does not come from
+    the service (e.g. a lazy load triggered by a view)
+    '''
+    frame = sys._getframe(1)
+    fallback = None
+
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module == 'customers.common.services':
+            return 'CustomerService.%s' % frame.f_code.co_name
+        if fallback is None and module.startswith('customers.') and \
+                module != __name__:
+            fallback = '%s.%s' % (module, frame.f_code.co_name)
+        frame = frame.f_back
+
+    return fallback
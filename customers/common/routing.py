@@ -0,0 +1,218 @@
+'''
+Contains the ReplicaRouter class, which sends the read-only queries of
+CustomerService to the read replicas of the database.
+'''
+
+import time
+from itertools import count
+from threading import Lock
+from flask import g, has_request_context, _app_ctx_stack
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+def _is_unreachable(error, dbapi):
+    '''
+    Returns true if a database error means that the database cannot
+    be reached, rather than a problem with the query
+
+    :param error:
+        A SQLAlchemy DBAPIError, or an error of the driver itself
+        which is raised when the connection cannot be opened
+
+    :param dbapi:
+        The driver module
+    '''
+    return isinstance(error, (OperationalError, dbapi.OperationalError)) or \
+        getattr(error, 'connection_invalidated', False)
+
+class Replica(object):
+    '''
+    A read replica: its engine, a session per application context and
+    its health.
+    '''
+
+    def __init__(self, bind, engine):
+        '''
+        Constructor for the Replica class
+
+        :param bind:
+            The name of the replica in SQLALCHEMY_BINDS
+
+        :param engine:
+            Its engine
+        '''
+        self.bind = bind
+        self.engine = engine
+        self.session = scoped_session(
+            sessionmaker(bind=engine),
+            scopefunc=_app_ctx_stack.__ident_func__
+        )
+        self.down_until = 0
+
+    def is_healthy(self, now):
+        '''
+        Returns true unless the replica failed recently
+
+        :param now:
+            The current timestamp
+        '''
+        return self.down_until <= now
+
+    def eject(self, seconds):
+        '''
+        Stop sending queries to the replica for a while
+
+        :param seconds:
+            Time before the replica is tried again
+        '''
+        self.down_until = time.time() + seconds
+
+class ReplicaRouter(object):
+    '''
+    Sends the reads to the replicas listed in SQLALCHEMY_REPLICAS
+    (names of SQLALCHEMY_BINDS), round-robin. A replica which cannot
+    be reached is ejected for REPLICA_EJECT_SECONDS and the read is
+    retried on the next one, then on the primary.
+
+    The reads go to the primary when there is no replica, and for the
+    rest of a request once it has written, so that a request always
+    reads its own writes.
+
+    The settings are read from the config of the application of the
+    database, the engines are created on first use.
+    '''
+
+    def __init__(self, db, app=None):
+        '''
+        Constructor for the ReplicaRouter class
+
+        :param db:
+            The Flask-SQLAlchemy extension of the primary database
+
+        :param app:
+            An optional Flask application
+        '''
+        self.db = db
+        self._replicas = {}
+        self._counter = count()
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Set the default settings: SQLALCHEMY_REPLICAS and
+        REPLICA_EJECT_SECONDS, and remove the replica sessions at the
+        end of each application context.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('SQLALCHEMY_REPLICAS', [])
+        app.config.setdefault('REPLICA_EJECT_SECONDS', 30)
+
+        app.teardown_appcontext(self._remove_sessions)
+
+    def reset(self):
+        '''
+        Forget the replicas and close their connections, e.g. after
+        the settings changed
+        '''
+        with self._lock:
+            replicas, self._replicas = self._replicas, {}
+        for replica in replicas.values():
+            replica.session.remove()
+            replica.engine.dispose()
+
+    def mark_write(self):
+        '''
+        Send the reads of the current request to the primary, called
+        by CustomerService after every write
+        '''
+        if has_request_context():
+            g.read_primary = True
+
+    def replicas(self):
+        '''
+        Return the Replica objects, in the order of SQLALCHEMY_REPLICAS
+        '''
+        app = self.db.get_app()
+        binds = app.config['SQLALCHEMY_REPLICAS']
+        replicas = []
+
+        with self._lock:
+            for bind in binds:
+                replica = self._replicas.get(bind)
+                if replica is None:
+                    replica = self._replicas[bind] = Replica(
+                        bind,
+                        self.db.get_engine(app, bind)
+                    )
+                replicas.append(replica)
+
+        return replicas
+
+    def _candidates(self):
+        '''
+        Return the healthy replicas to try for a read, in round-robin
+        order. Empty if the read must go to the primary.
+        '''
+        if has_request_context() and g.get('read_primary'):
+            return []
+
+        replicas = self.replicas()
+        if not replicas:
+            return []
+
+        start = next(self._counter) % len(replicas)
+        now = time.time()
+        return [
+            replica for replica in replicas[start:] + replicas[:start]
+            if replica.is_healthy(now)
+        ]
+
+    def read(self, func):
+        '''
+        Run a read-only function with the session of a replica, or of
+        the primary
+
+        :param func:
+            Function taking a session as parameter
+
+        Example ::
+
+            total = router.read(
+                lambda session: session.query(Customer.id).count()
+            )
+
+        The errors are only caught while the function runs: a query
+        returned by the function and executed later is not retried.
+        '''
+        app = self.db.get_app()
+        eject_seconds = app.config['REPLICA_EJECT_SECONDS']
+
+        for replica in self._candidates():
+            dbapi = replica.engine.dialect.dbapi
+            try:
+                return func(replica.session)
+            except (DBAPIError, dbapi.Error) as error:
+                if not _is_unreachable(error, dbapi):
+                    raise
+                replica.session.remove()
+                replica.eject(eject_seconds)
+                app.logger.warning(
+                    'Replica %s ejected for %s seconds: %s',
+                    replica.bind,
+                    eject_seconds,
+                    error
+                )
+
+        return func(self.db.session)
+
+    def _remove_sessions(self, exception=None):
+        '''
+        Close the replica sessions of the application context
+        '''
+        for replica in list(self._replicas.values()):
+            replica.session.remove()
@@ -0,0 +1,95 @@
+'''
+Contains the JSON serialization layer of the API. It uses the fastest
+encoder installed (orjson, then ujson, then the standard library) and
+writes compact documents unless JSON_COMPACT is disabled.
+'''
+
+import json
+from flask import current_app
+
+try:
+    import orjson
+
+    def _compact_dumps(obj):
+        return orjson.dumps(obj)
+
+    ENCODER = 'orjson'
+except ImportError:
+    try:
+        import ujson
+
+        def _compact_dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False)
+
+        ENCODER = 'ujson'
+    except ImportError:
+        def _compact_dumps(obj):
+            return json.dumps(obj, separators=(',', ':'))
+
+        ENCODER = 'json'
+
+def dumps(obj, compact=True):
+    '''
+    Serialize an object to JSON
+
+    :param obj:
+        A structure of dicts, lists, strings, numbers and booleans
+
+    :param compact:
+        Use the fast encoder without whitespace, otherwise the
+        standard library with an indentation
+    '''
+    if compact:
+        return _compact_dumps(obj)
+    return json.dumps(obj, indent=2, sort_keys=True)
+
+def json_response(*args, **kwargs):
+    '''
+    Drop-in replacement of flask.jsonify using the fast encoder. The
+    output is compact unless JSON_COMPACT is False, which defaults to
+    False in debug mode only.
+
+    Example ::
+
+        return json_response(customer=customer.json)
+    '''
+    compact = current_app.config.get('JSON_COMPACT', not current_app.debug)
+    return current_app.response_class(
+        dumps(dict(*args, **kwargs), compact),
+        mimetype='application/json'
+    )
+
+def format_date(value):
+    '''
+    Format a date as YYYY/MM/DD, the format of the API, faster than
+    strftime
+
+    :param value:
+        A date or datetime
+    '''
+    return '%04d/%02d/%02d' % (value.year, value.month, value.day)
+
+def customer_row_json(row):
+    '''
+    Return the json representation of a customer straight from a row
+    of CustomerService.EXPORT_COLUMNS, as selected by
+    CustomerService._query_customer_rows, without building any model
+    instance
+
+    :param row:
+        Tuple of id, email, first_name, last_name, cellphone,
+        newsletter and created
+    '''
+    customer_id, email, first_name, last_name, cellphone, newsletter,\
+        created = row
+    return {
+        'id': customer_id,
+        'email': email,
+        'data': {
+            'first_name': first_name,
+            'last_name': last_name,
+            'cellphone': cellphone,
+            'newsletter': newsletter,
+            'created': format_date(created),
+        },
+    }
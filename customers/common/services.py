@@ -2,8 +2,59 @@
 Contains the CustomerService class
 '''
 
-from customers.utils import db
-from customers.common.models.customer import Customer
+import csv
+import heapq
+from datetime import datetime
+from functools import partial
+from itertools import chain
+from operator import attrgetter
+from flask import current_app
+from sqlalchemy import func, bindparam, case, or_, and_, union, select, sql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload, contains_eager
+from customers.utils import(
+    count_cache,
+    customer_cache,
+    router,
+    shards,
+    group_commit
+)
+from customers.common.models.customer import Customer, SQLITE_TRIGRAM
+from customers.common.models.customer_data import CustomerData
+from customers.common.models.customer_id_slot import CustomerIdSlot
+from customers.common.export import encode_csv_value
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+def _supports_returning(session):
+    '''
+    Returns true if the database can return the rows changed by an
+    UPDATE or a DELETE
+
+    :param session:
+        The session of the database
+    '''
+    return session.bind.dialect.name == 'postgresql'
+
+def _escape_like(text):
+    '''
+    Escape the wildcards of a LIKE pattern, with a backslash
+
+    :param text:
+        The text to match literally
+    '''
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace(
+        '_', '\\_'
+    )
+
+class VersionConflict(Exception):
+    '''
+    Raised when a customer has been updated since the version the
+    client expects
+    '''
 
 class CustomerService(object):
     '''
@@ -15,54 +66,1063 @@ class CustomerService(object):
 
     RESULTS_PER_PAGE = 5
 
+    #Columns which can be exported, in their default order
+    EXPORT_COLUMNS = (
+        ('id', Customer.id),
+        ('email', Customer.email),
+        ('first_name', CustomerData.first_name),
+        ('last_name', CustomerData.last_name),
+        ('cellphone', CustomerData.cellphone),
+        ('newsletter', CustomerData.newsletter),
+        ('created', CustomerData.created),
+    )
+
+    EXPORT_BATCH_SIZE = 1000
+
+    #Sort keys of the customer list: the sorted column, and the
+    # customer id column of the same table which breaks the ties
+    LIST_SORTS = dict(
+        id=(Customer.id, Customer.id),
+        created=(CustomerData.created, CustomerData.customer_id),
+        last_name=(CustomerData.last_name, CustomerData.customer_id),
+    )
+
+    #Combinations of sort key and filters of the customer list, and
+    # the index serving each one. The others would read the whole
+    # table and are rejected. 'created' stands for created_from and/or
+    # created_to.
+    LIST_INDEXES = {
+        ('id', ()): 'ix_customer_active_id',
+        ('id', ('active',)): 'ix_customer_active_id',
+        ('id', ('email_domain',)): 'ix_customer_email_domain_id',
+        ('created', ()): 'ix_customer_data_created',
+        ('created', ('created',)): 'ix_customer_data_created',
+        ('created', ('newsletter',)): 'ix_customer_data_newsletter_created',
+        ('created', ('created', 'newsletter')):
+            'ix_customer_data_newsletter_created',
+        ('last_name', ()): 'ix_customer_data_last_name',
+        ('last_name', ('newsletter',)):
+            'ix_customer_data_newsletter_last_name',
+    }
+
+    #Shortest search text, trigrams need 3 characters
+    SEARCH_MIN_LENGTH = 3
+    SEARCH_RESULTS_PER_PAGE = 20
+
+    @staticmethod
+    def _query_customers(session, eager=True):
+        '''
+        Return a query on the customers
+
+        :param session:
+            The session of the shard to query
+
+        :param eager:
+            Load the CustomerData of each customer in the same round
+            trip (default), otherwise it is loaded on first access
+        '''
+        query = session.query(Customer)
+
+        if eager:
+            query = query.options(joinedload(Customer.data))
+
+        return query
+
     @staticmethod
     def add_customer(customer):
         '''
-        Add a new customer
+        Add a new customer. With the group commit, it is inserted
+        along with the customers added at the same time by the other
+        threads, and is detached once this returns.
 
         :param customer:
             A new Customer instance
         '''
-        db.session.add(customer)
-        db.session.commit()
+        shard = shards.for_email(customer.email)
+
+        if shards.is_enabled():
+            customer.id = CustomerService._allocate_ids(
+                shard,
+                [customer.email]
+            )[0]
+
+        if group_commit.enabled:
+            group_commit.submit(shard, customer)
+        else:
+            shard.session.add(customer)
+            shard.session.commit()
+        router.mark_write()
+        count_cache.invalidate()
+
+    @staticmethod
+    def add_customers(records, use_copy=None):
+        '''
+        Insert a batch of customers in one transaction per shard, with
+        one statement per table: executemany, or COPY on Postgres.
+        The email addresses must not be taken already.
+
+        :param records:
+            A list of dicts with the keys email, password (already
+            hashed), first_name, last_name, cellphone and newsletter
+
+        :param use_copy:
+            Use COPY instead of executemany, defaults to True on
+            Postgres
+
+        Returns the number of customers inserted
+        '''
+        if not records:
+            return 0
+
+        groups = shards.group(
+            records,
+            lambda record: shards.slot_of_email(record['email'])
+        )
+        for shard, shard_records in groups:
+            CustomerService._add_customers(shard, shard_records, use_copy)
+
+        router.mark_write()
+        count_cache.invalidate()
+
+        return len(records)
+
+    @staticmethod
+    def _add_customers(shard, records, use_copy):
+        '''
+        Insert the customers of a shard in one transaction, see
+        add_customers
+
+        :param shard:
+            The Shard of the customers
+
+        :param records:
+            A list of dicts, see add_customers
+
+        :param use_copy:
+            Use COPY instead of executemany, defaults to True on
+            Postgres
+        '''
+        session = shard.session
+
+        if use_copy is None:
+            use_copy = session.bind.dialect.name == 'postgresql'
+
+        customer_rows = [
+            dict(email=record['email'], password=record['password'],
+                 email_domain=Customer.domain_of(record['email']),
+                 active=True)
+            for record in records
+        ]
+        columns = ('email', 'email_domain', 'password', 'active')
+
+        if shards.is_enabled():
+            customer_ids = CustomerService._allocate_ids(
+                shard,
+                [record['email'] for record in records]
+            )
+            for row, customer_id in zip(customer_rows, customer_ids):
+                row['id'] = customer_id
+            columns = ('id',) + columns
+
+        CustomerService._insert_rows(
+            session,
+            Customer.__table__,
+            columns,
+            customer_rows,
+            use_copy
+        )
+
+        if shards.is_enabled():
+            ids = dict(
+                (row['email'].lower(), row['id']) for row in customer_rows
+            )
+        else:
+            #Map the new ids back to the records through their email
+            emails = [record['email'].lower() for record in records]
+            ids = dict(
+                session.query(
+                    func.lower(Customer.email),
+                    Customer.id
+                ).filter(func.lower(Customer.email).in_(emails))
+            )
+
+        created = datetime.now()
+        data_rows = [
+            dict(
+                customer_id=ids[record['email'].lower()],
+                first_name=record.get('first_name') or '',
+                last_name=record.get('last_name') or '',
+                cellphone=record.get('cellphone') or '',
+                newsletter=bool(record.get('newsletter')),
+                created=created
+            )
+            for record in records
+        ]
+        CustomerService._insert_rows(
+            session,
+            CustomerData.__table__,
+            ('customer_id', 'first_name', 'last_name', 'cellphone',
+             'newsletter', 'created'),
+            data_rows,
+            use_copy
+        )
+
+        session.commit()
+
+    @staticmethod
+    def _allocate_ids(shard, emails):
+        '''
+        Allocate the ids of new customers of a shard, when the
+        customers are sharded: seq * SHARD_SLOTS + the slot of their
+        email, the seqs of a slot being handed out by its row in
+        customer_id_slot.
+
+        :param shard:
+            The Shard of the customers
+
+        :param emails:
+            The email addresses of the customers
+
+        Returns the ids, in the order of the emails.
+        '''
+        slots = [shards.slot_of_email(email) for email in emails]
+        counts = {}
+        for slot in slots:
+            counts[slot] = counts.get(slot, 0) + 1
+
+        seqs = dict(
+            (slot, iter(CustomerService._allocate_seqs(shard, slot, count)))
+            for slot, count in counts.items()
+        )
+        slot_count = shards.slot_count()
+
+        return [next(seqs[slot]) * slot_count + slot for slot in slots]
+
+    @staticmethod
+    def _allocate_seqs(shard, slot, count):
+        '''
+        Reserve the next seqs of a slot, in a short transaction of its
+        own so that the row of the slot is not locked while the
+        customers are inserted. An insert which fails leaves a gap.
+
+        :param shard:
+            The Shard owning the slot
+
+        :param slot:
+            The slot
+
+        :param count:
+            Number of seqs to reserve
+
+        Returns the list of the seqs.
+        '''
+        table = CustomerIdSlot.__table__
+        increment = table.update().where(table.c.slot == slot).values(
+            last_seq=table.c.last_seq + count
+        )
+
+        while True:
+            with shard.engine.begin() as connection:
+                if connection.execute(increment).rowcount:
+                    last_seq = connection.execute(
+                        select([table.c.last_seq]).where(
+                            table.c.slot == slot
+                        )
+                    ).scalar()
+                    return list(range(last_seq - count + 1, last_seq + 1))
+
+            #First ids of the slot, unless another worker was quicker
+            try:
+                with shard.engine.begin() as connection:
+                    connection.execute(
+                        table.insert(),
+                        dict(slot=slot, last_seq=count)
+                    )
+                return list(range(1, count + 1))
+            except IntegrityError:
+                pass
+
+    @staticmethod
+    def _insert_rows(session, table, columns, rows, use_copy):
+        '''
+        Insert rows in a table within the current transaction
+
+        :param session:
+            The session of the shard
+
+        :param table:
+            The Table object
+
+        :param columns:
+            The names of the columns to fill
+
+        :param rows:
+            A list of dicts, one per row
+
+        :param use_copy:
+            Stream the rows with the Postgres COPY command instead of
+            an executemany
+        '''
+        if not use_copy:
+            session.execute(table.insert(), rows)
+            return
+
+        #Unquoted empty fields are NULLs, strings are always quoted
+        buf = StringIO()
+        writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)
+        for row in rows:
+            writer.writerow([
+                encode_csv_value(row[column]) for column in columns
+            ])
+        buf.seek(0)
+
+        cursor = session.connection().connection.cursor()
+        cursor.copy_expert(
+            'COPY %s (%s) FROM STDIN WITH CSV' % (
+                table.name,
+                ', '.join(columns)
+            ),
+            buf
+        )
 
     @staticmethod
     def update_customer(customer):
         '''
-        Update an existing customer
+        Update an existing customer, and increment its version
 
         :param customer:
             An existing Customer instance
         '''
-        db.session.merge(customer)
-        db.session.commit()
+        session = shards.for_id(customer.id).session
+        customer.version = Customer.version + 1
+        session.merge(customer)
+        session.commit()
+        router.mark_write()
+        customer_cache.invalidate(customer.id)
+
+    @staticmethod
+    def patch_customer(customer_id, changes, expected_version=None):
+        '''
+        Update some of the data of a customer without loading it: one
+        UPDATE ... RETURNING on customer increments its version (and
+        checks it), a second one on customer_data only sets the
+        changed columns. The json representation is built from the
+        returned rows.
+
+        :param customer_id:
+            A customer's id
+
+        :param changes:
+            A dict of the CustomerData.EDITABLE_COLUMNS to change,
+            other keys are ignored
+
+        :param expected_version:
+            The version of the customer the changes are based on,
+            None to update whatever the current version
+
+        Returns the record of the updated customer (see
+        get_customer_record, without the password version), None if
+        there is no such active customer. Raises VersionConflict if the
+        customer is not at the expected version.
+        '''
+        session = shards.for_id(customer_id).session
+        changes = dict(
+            (column, value) for column, value in changes.items()
+            if column in CustomerData.EDITABLE_COLUMNS
+        )
+        data_columns = [
+            getattr(CustomerData, column) for column in (
+                'first_name', 'last_name', 'cellphone', 'newsletter',
+                'created'
+            )
+        ]
+
+        customer_update = Customer.__table__.update().where(and_(
+            Customer.id == customer_id,
+            Customer.active == True
+        )).values(version=Customer.version + 1)
+        if expected_version is not None:
+            customer_update = customer_update.where(
+                Customer.version == expected_version
+            )
+
+        data_update = None
+        if changes:
+            data_update = CustomerData.__table__.update().where(
+                CustomerData.customer_id == customer_id
+            ).values(**changes)
+
+        if _supports_returning(session):
+            customer_row = session.execute(customer_update.returning(
+                Customer.id, Customer.email, Customer.version
+            )).first()
+            data_row = None
+            if customer_row is not None and data_update is not None:
+                data_row = session.execute(
+                    data_update.returning(*data_columns)
+                ).first()
+        else:
+            customer_row = None
+            if session.execute(customer_update).rowcount:
+                if data_update is not None:
+                    session.execute(data_update)
+                customer_row = session.query(
+                    Customer.id, Customer.email, Customer.version
+                ).filter(Customer.id == customer_id).first()
+            data_row = None
+
+        if customer_row is None:
+            session.rollback()
+            if expected_version is not None and\
+                    CustomerService._get_existing_ids(
+                        session,
+                        [customer_id],
+                        active_only=True
+                    ):
+                raise VersionConflict(customer_id)
+            return None
+
+        if data_row is None:
+            data_row = session.query(*data_columns).filter(
+                CustomerData.customer_id == customer_id
+            ).first()
+
+        session.commit()
+        router.mark_write()
+        customer_cache.invalidate(customer_id)
+
+        return dict(
+            customer=Customer.to_json(
+                customer_row[0],
+                customer_row[1],
+                CustomerData.to_json(*data_row)
+            ),
+            version=customer_row[2]
+        )
 
     @staticmethod
-    def get_customer_by_email(email):
+    def get_customer_by_email(email, eager=True):
         '''
-        Return a customer by its email address
+        Return an active customer by its email address, the
+        comparison is case insensitive and uses the index on
+        lower(email). The email addresses of the soft deleted
+        customers are still taken, see get_taken_emails.
 
         :param email:
             A customer's email address
+
+        :param eager:
+            Load its CustomerData in the same query
         '''
-        return db.session.query(Customer).filter(
-            Customer.email == email,
+        session = shards.for_email(email).session
+        return CustomerService._query_customers(session, eager).filter(
+            func.lower(Customer.email) == (email or '').lower(),
+            Customer.active == True
         ).first()
 
     @staticmethod
-    def get_customer_by_id(customer_id):
+    def get_customer_record(customer_id):
+        '''
+        Return the serialized record of a customer, read through the
+        customer cache: a dict with its json representation under
+        'customer', its 'version' and its 'password_version'. None if
+        there is no such active customer.
+
+        :param customer_id:
+            A customer's id
+        '''
+        record = customer_cache.get_record(customer_id)
+
+        if record is None:
+            customer = CustomerService.get_customer_by_id(customer_id)
+            if customer is None:
+                return None
+            record = CustomerService._cache_customer(customer)
+
+        return record
+
+    @staticmethod
+    def get_customer_version(customer_id):
+        '''
+        Return the version of a customer, from the customer cache or
+        with a query which does not load its CustomerData. None if
+        there is no such active customer.
+
+        :param customer_id:
+            A customer's id
+        '''
+        record = customer_cache.get_record(customer_id)
+        if record is not None and 'version' in record:
+            return record['version']
+
+        session = shards.for_id(customer_id).session
+        return session.query(Customer.version).filter(
+            Customer.id == customer_id,
+            Customer.active == True
+        ).scalar()
+
+    @staticmethod
+    def get_password_version(customer_id):
         '''
-        Return a customer by its id
+        Return the password version of a customer, from the customer
+        cache or with a query which only reads its password hash. None
+        if there is no such active customer.
 
         :param customer_id:
             A customer's id
         '''
-        return db.session.query(Customer).filter(
+        record = customer_cache.get_record(customer_id)
+        if record is not None and 'password_version' in record:
+            return record['password_version']
+
+        session = shards.for_id(customer_id).session
+        password = session.query(Customer.password).filter(
             Customer.id == customer_id,
+            Customer.active == True
+        ).scalar()
+
+        if password is None:
+            return None
+        return Customer.fingerprint(password)
+
+    @staticmethod
+    def _cache_customer(customer):
+        '''
+        Serialize a customer and store its record in the cache
+
+        :param customer:
+            A Customer instance
+
+        Returns the record
+        '''
+        record = dict(
+            customer=customer.json,
+            version=customer.version,
+            password_version=customer.password_version
+        )
+        customer_cache.set_record(customer.id, record)
+        return record
+
+    @staticmethod
+    def get_taken_emails(emails):
+        '''
+        Return the email addresses of a list which are already taken,
+        with a single query per shard
+
+        :param emails:
+            A list of lower cased email addresses
+        '''
+        if not emails:
+            return set()
+
+        def query_taken(shard_emails, session):
+            rows = session.query(func.lower(Customer.email)).filter(
+                func.lower(Customer.email).in_(shard_emails)
+            )
+            return set(row[0] for row in rows)
+
+        return set(chain.from_iterable(shards.run([
+            (shard, partial(query_taken, shard_emails))
+            for shard, shard_emails in shards.group(
+                emails,
+                shards.slot_of_email
+            )
+        ])))
+
+    @staticmethod
+    def get_customer_by_id(customer_id, eager=True):
+        '''
+        Return an active customer by its id
+
+        :param customer_id:
+            A customer's id
+
+        :param eager:
+            Load its CustomerData in the same query
+        '''
+        session = shards.for_id(customer_id).session
+        return CustomerService._query_customers(session, eager).filter(
+            Customer.id == customer_id,
+            Customer.active == True
         ).first()
 
     @staticmethod
-    def get_customers(start=0, stop=20):
+    def get_customers_by_ids(customer_ids, eager=True):
+        '''
+        Return the active customers of a list of ids with a single IN
+        query per shard, ordered by id. Unknown ids are ignored.
+
+        :param customer_ids:
+            A list of customer ids
+
+        :param eager:
+            Load the CustomerData of the customers in the same query,
+            always when the customers are sharded
+        '''
+        if not customer_ids:
+            return []
+
+        eager = eager or shards.is_enabled()
+
+        def query_customers(shard_ids, session):
+            return CustomerService._query_customers(session, eager).filter(
+                Customer.id.in_(shard_ids),
+                Customer.active == True
+            ).order_by(Customer.id).all()
+
+        return CustomerService._merge(shards.run([
+            (shard, partial(query_customers, shard_ids))
+            for shard, shard_ids in shards.group(
+                customer_ids,
+                shards.slot_of_id
+            )
+        ]), attrgetter('id'))
+
+    @staticmethod
+    def update_customers_data(updates):
+        '''
+        Update the data of several customers and increment their
+        versions with two statements per shard, see
+        _update_customers_data, and commit once per shard.
+
+        :param updates:
+            A list of dicts with the key customer_id, and the
+            first_name, last_name, cellphone and newsletter values
+
+        Returns the set of customer ids which have been updated,
+        unknown or soft deleted ids are ignored.
+        '''
+        found = set()
+        groups = shards.group(
+            updates,
+            lambda update: shards.slot_of_id(update['customer_id'])
+        )
+        for shard, shard_updates in groups:
+            found |= CustomerService._update_customers_data(
+                shard.session,
+                shard_updates
+            )
+
+        if found:
+            router.mark_write()
+
+        for customer_id in found:
+            customer_cache.invalidate(customer_id)
+
+        return found
+
+    @staticmethod
+    def _update_customers_data(session, updates):
+        '''
+        Update the data of the customers of a shard, see
+        update_customers_data. On Postgres, an UPDATE ... RETURNING
+        increments the versions of the active customers and returns
+        their ids, then a single UPDATE ... FROM (VALUES ...) sets
+        their data. Elsewhere the ids are selected first and the data
+        is updated with executemany.
+
+        :param session:
+            The session of the shard
+
+        :param updates:
+            A list of dicts, see update_customers_data
+        '''
+        customer_ids = [update['customer_id'] for update in updates]
+        version_update = Customer.__table__.update().where(and_(
+            Customer.id.in_(customer_ids),
+            Customer.active == True
+        )).values(version=Customer.version + 1)
+
+        if _supports_returning(session):
+            found = set(
+                row[0] for row in
+                session.execute(version_update.returning(Customer.id))
+            )
+            rows = [
+                update for update in updates
+                if update['customer_id'] in found
+            ]
+            if rows:
+                CustomerService._update_data_from_values(session, rows)
+        else:
+            found = CustomerService._get_existing_ids(
+                session,
+                customer_ids,
+                active_only=True
+            )
+            rows = [
+                dict(('b_' + key, value) for key, value in update.items())
+                for update in updates
+                if update['customer_id'] in found
+            ]
+            if rows:
+                table = CustomerData.__table__
+                session.execute(
+                    table.update().where(
+                        table.c.customer_id == bindparam('b_customer_id')
+                    ).values(
+                        first_name=bindparam('b_first_name'),
+                        last_name=bindparam('b_last_name'),
+                        cellphone=bindparam('b_cellphone'),
+                        newsletter=bindparam('b_newsletter')
+                    ),
+                    rows
+                )
+                session.execute(version_update)
+
+        session.commit()
+
+        return found
+
+    @staticmethod
+    def _update_data_from_values(session, updates):
+        '''
+        Set the data of several customers with a single UPDATE ...
+        FROM (VALUES ...) statement, Postgres only
+
+        :param session:
+            The session of the shard
+
+        :param updates:
+            A list of dicts, see update_customers_data
+        '''
+        columns = (
+            'customer_id', 'first_name', 'last_name', 'cellphone',
+            'newsletter'
+        )
+        values = []
+        params = {}
+
+        for index, update in enumerate(updates):
+            names = ['%s_%d' % (column, index) for column in columns]
+            values.append('(%s)' % ', '.join(':' + name for name in names))
+            params.update(
+                (name, update.get(column))
+                for name, column in zip(names, columns)
+            )
+
+        #A column of NULL values would be typed as text
+        session.execute(sql.text(
+            'UPDATE customer_data SET first_name = v.first_name, '
+            'last_name = v.last_name, cellphone = v.cellphone, '
+            'newsletter = CAST(v.newsletter AS BOOLEAN) '
+            'FROM (VALUES %s) AS v (%s) '
+            'WHERE customer_data.customer_id = v.customer_id' % (
+                ', '.join(values),
+                ', '.join(columns)
+            )
+        ), params)
+
+    @staticmethod
+    def delete_customers_by_ids(customer_ids, soft=None):
+        '''
+        Delete several customers with a single DELETE ... RETURNING
+        statement, their data is removed by the ON DELETE CASCADE of
+        the foreign key.
+
+        :param customer_ids:
+            A list of customer ids
+
+        :param soft:
+            Only disable the customers (active column), defaults to
+            the CUSTOMERS_SOFT_DELETE setting. The disabled customers
+            are not returned by the lookups, lists, search and export
+            any more, and cannot log in. A hard delete also removes
+            the disabled customers.
+
+        Returns the set of customer ids which have been deleted,
+        unknown (or already disabled, when soft) ids are ignored.
+        '''
+        if not customer_ids:
+            return set()
+
+        if soft is None:
+            soft = current_app.config.get('CUSTOMERS_SOFT_DELETE', False)
+
+        found = set()
+        for shard, shard_ids in shards.group(customer_ids, shards.slot_of_id):
+            found |= CustomerService._delete_customers(
+                shard.session,
+                shard_ids,
+                soft
+            )
+
+        router.mark_write()
+
+        if found:
+            count_cache.invalidate()
+        for customer_id in found:
+            customer_cache.invalidate(customer_id)
+
+        return found
+
+    @staticmethod
+    def _delete_customers(session, customer_ids, soft):
+        '''
+        Delete the customers of a shard, see delete_customers_by_ids
+
+        :param session:
+            The session of the shard
+
+        :param customer_ids:
+            A list of customer ids
+
+        :param soft:
+            Only disable the customers
+
+        Returns the set of customer ids which have been deleted
+        '''
+        table = Customer.__table__
+        if soft:
+            #A customer already disabled is not deleted again
+            statement = table.update().where(and_(
+                Customer.id.in_(customer_ids),
+                Customer.active == True
+            )).values(active=False, version=Customer.version + 1)
+        else:
+            statement = table.delete().where(Customer.id.in_(customer_ids))
+
+        if _supports_returning(session):
+            found = set(
+                row[0] for row in
+                session.execute(statement.returning(Customer.id))
+            )
+        else:
+            found = CustomerService._get_existing_ids(
+                session,
+                customer_ids,
+                active_only=soft
+            )
+            if found:
+                session.execute(statement)
+
+        session.commit()
+
+        return found
+
+    @staticmethod
+    def _get_existing_ids(session, customer_ids, active_only=False):
+        '''
+        Return the ids of a list which belong to a customer of a
+        shard, with a single IN query
+
+        :param session:
+            The session of the shard
+
+        :param customer_ids:
+            A list of customer ids
+
+        :param active_only:
+            Ignore the soft deleted customers
+        '''
+        if not customer_ids:
+            return set()
+
+        rows = session.query(Customer.id).filter(
+            Customer.id.in_(customer_ids)
+        )
+        if active_only:
+            rows = rows.filter(Customer.active == True)
+        return set(row[0] for row in rows)
+
+    @staticmethod
+    def _read_all(func):
+        '''
+        Run a read-only function on every shard in parallel, or on a
+        replica when the customers are not sharded (see
+        ReplicaRouter.read)
+
+        :param func:
+            Function taking a session as parameter
+
+        Returns the list of the results of the shards.
+        '''
+        if shards.is_enabled():
+            return shards.map(func)
+        return [router.read(func)]
+
+    @staticmethod
+    def _merge(results, key, reverse=False):
+        '''
+        Merge the sorted lists returned by the shards into one
+
+        :param results:
+            The lists of the shards
+
+        :param key:
+            Function returning the sort key of an item
+
+        :param reverse:
+            The lists are in descending order
+        '''
+        if len(results) == 1:
+            return results[0]
+        return sorted(chain.from_iterable(results), key=key, reverse=reverse)
+
+    @staticmethod
+    def _merge_key(sort, rows):
+        '''
+        Return the function giving the position of a customer in the
+        list, to merge the lists of the shards. It compares in Python
+        what the databases sorted, the text columns should use a
+        binary collation.
+
+        :param sort:
+            A sort key, see get_customers
+
+        :param rows:
+            The customers are tuples of the values of EXPORT_COLUMNS,
+            otherwise Customer instances
+        '''
+        name = sort.lstrip('-')
+
+        if rows:
+            index = [
+                column for column, _ in CustomerService.EXPORT_COLUMNS
+            ].index(name)
+            return lambda row: (row[index], row[0])
+
+        if name == 'id':
+            return attrgetter('id')
+        return lambda customer: (getattr(customer.data, name), customer.id)
+
+    @staticmethod
+    def _query_customer_list(session, eager=True):
+        '''
+        Return a query on the customers joined to their data, which
+        the filters and the sort keys of the list may use
+
+        :param session:
+            The session to query, see ReplicaRouter.read
+
+        :param eager:
+            Load the CustomerData of each customer from the join
+        '''
+        query = session.query(Customer).join(Customer.data)
+
+        if eager:
+            query = query.options(contains_eager(Customer.data))
+
+        return query
+
+    @staticmethod
+    def _list_key(filters, sort):
+        '''
+        Return the key of a combination in LIST_INDEXES
+
+        :param filters:
+            A dict of filters, see get_customers
+
+        :param sort:
+            A sort key, see get_customers
+        '''
+        names = set()
+        for name, value in (filters or {}).items():
+            if value is not None:
+                if name in ('created_from', 'created_to'):
+                    name = 'created'
+                names.add(name)
+        return (sort.lstrip('-'), tuple(sorted(names)))
+
+    @staticmethod
+    def check_list_options(filters=None, sort='id'):
+        '''
+        Make sure that the customer list can be filtered and sorted
+        this way with an index, raises ValueError otherwise
+
+        :param filters:
+            A dict of filters, see get_customers
+
+        :param sort:
+            A sort key, see get_customers
+        '''
+        key = CustomerService._list_key(filters, sort)
+
+        if key not in CustomerService.LIST_INDEXES:
+            supported = sorted(
+                '%s by %s' % (' and '.join(names) or 'no filter', sort_key)
+                for sort_key, names in CustomerService.LIST_INDEXES
+            )
+            raise ValueError(
+                'Unsupported combination of filters and sort, use: %s.' %
+                ', '.join(supported)
+            )
+
+    @staticmethod
+    def _filter_list(query, filters):
+        '''
+        Apply the filters of the customer list to a query
+
+        :param query:
+            A query joining the customer and customer_data tables
+
+        :param filters:
+            A dict of filters, see get_customers
+        '''
+        filters = filters or {}
+
+        if filters.get('newsletter') is not None:
+            query = query.filter(
+                CustomerData.newsletter == filters['newsletter']
+            )
+        #The soft deleted customers are only listed on demand
+        active = filters.get('active')
+        query = query.filter(Customer.active == (active is not False))
+        if filters.get('email_domain') is not None:
+            query = query.filter(
+                Customer.email_domain == filters['email_domain'].lower()
+            )
+        if filters.get('created_from') is not None:
+            query = query.filter(
+                CustomerData.created >= filters['created_from']
+            )
+        if filters.get('created_to') is not None:
+            query = query.filter(CustomerData.created < filters['created_to'])
+
+        return query
+
+    @staticmethod
+    def _sort_list(query, sort, after=None):
+        '''
+        Apply the sort key of the customer list to a query
+
+        :param query:
+            A query joining the customer and customer_data tables
+
+        :param sort:
+            A sort key, see get_customers
+
+        :param after:
+            The (sorted value, id) of the last customer of the previous
+            page, to start the list after it
+        '''
+        descending = sort.startswith('-')
+        column, tie = CustomerService.LIST_SORTS[sort.lstrip('-')]
+
+        if after is not None:
+            value, last_id = after
+            if column is tie:
+                condition = tie < last_id if descending else tie > last_id
+            elif descending:
+                condition = or_(
+                    column < value,
+                    and_(column == value, tie < last_id)
+                )
+            else:
+                condition = or_(
+                    column > value,
+                    and_(column == value, tie > last_id)
+                )
+            query = query.filter(condition)
+
+        order = [column] if column is tie else [column, tie]
+        if descending:
+            order = [part.desc() for part in order]
+
+        return query.order_by(*order)
+
+    @staticmethod
+    def get_customers(start=0, stop=20, eager=True, filters=None, sort='id'):
         '''
         Return a list of customers
 
@@ -72,6 +1132,21 @@ class CustomerService(object):
         :param stop:
             End index
 
+        :param eager:
+            Load the CustomerData of the customers in the same query,
+            always when the customers are sharded
+
+        :param filters:
+            A dict with any of: newsletter and active (booleans, the
+            active customers are listed unless active is False),
+            email_domain, created_from (included) and created_to
+            (excluded) datetimes. None values are ignored.
+
+        :param sort:
+            'id' (default), 'created' or 'last_name', prefixed with a
+            '-' for the descending order. The combination with the
+            filters must be in LIST_INDEXES, see check_list_options.
+
         Example on how to retrieve the 5 first results ::
 
             CustomerService.get_customers(0, 5)
@@ -79,23 +1154,648 @@ class CustomerService(object):
         Example on how to retrieve the second range of 5 results ::
 
             CustomerService.get_customers(5, 10)
+
+        Example on how to retrieve the latest subscribers ::
+
+            CustomerService.get_customers(
+                0, 5, filters=dict(newsletter=True), sort='-created'
+            )
+
+        The cost of this query grows with the start index, prefer
+        get_customers_after to walk through a large table. When the
+        customers are sharded, each shard returns its first stop
+        customers.
+        '''
+        CustomerService.check_list_options(filters, sort)
+        eager = eager or shards.is_enabled()
+        first = 0 if shards.is_enabled() else start
+
+        def query_customers(session):
+            query = CustomerService._filter_list(
+                CustomerService._query_customer_list(session, eager),
+                filters
+            )
+            return CustomerService._sort_list(query, sort).slice(
+                first,
+                stop
+            ).all()
+
+        return CustomerService._merge(
+            CustomerService._read_all(query_customers),
+            CustomerService._merge_key(sort, rows=False),
+            sort.startswith('-')
+        )[start - first:stop - first]
+
+    @staticmethod
+    def get_customers_after(
+        last_id=None,
+        limit=20,
+        eager=True,
+        filters=None,
+        sort='id',
+        last_value=None
+    ):
+        '''
+        Return a list of customers, using keyset pagination: the cost
+        of a page does not depend on its depth.
+
+        :param last_id:
+            The id of the last customer of the previous page, None to
+            get the first page
+
+        :param limit:
+            Maximum number of customers to return
+
+        :param eager:
+            Load the CustomerData of the customers in the same query,
+            always when the customers are sharded
+
+        :param filters:
+            A dict of filters, see get_customers
+
+        :param sort:
+            A sort key, see get_customers
+
+        :param last_value:
+            The sorted value of the last customer of the previous
+            page, unless sorted by id
+
+        Example on how to retrieve the page after customer 42 ::
+
+            CustomerService.get_customers_after(42, 5)
+        '''
+        CustomerService.check_list_options(filters, sort)
+        after = CustomerService._list_after(sort, last_id, last_value)
+        eager = eager or shards.is_enabled()
+
+        def query_customers(session):
+            query = CustomerService._filter_list(
+                CustomerService._query_customer_list(session, eager),
+                filters
+            )
+            return CustomerService._sort_list(query, sort, after).limit(
+                limit
+            ).all()
+
+        return CustomerService._merge(
+            CustomerService._read_all(query_customers),
+            CustomerService._merge_key(sort, rows=False),
+            sort.startswith('-')
+        )[:limit]
+
+    @staticmethod
+    def _list_after(sort, last_id, last_value):
+        '''
+        Return the position to start a list after, see _sort_list
+
+        :param sort:
+            A sort key, see get_customers
+
+        :param last_id:
+            The id of the last customer of the previous page, or None
+
+        :param last_value:
+            Its sorted value, unless sorted by id
+        '''
+        if last_id is None:
+            return None
+        if sort.lstrip('-') == 'id':
+            return (last_id, last_id)
+        return (last_value, last_id)
+
+    @staticmethod
+    def _query_customer_rows(session):
+        '''
+        Return a query on the customers as tuples of the values of
+        EXPORT_COLUMNS, which skips building any model instance
+
+        :param session:
+            The session to query, see ReplicaRouter.read
+        '''
+        return session.query(
+            *[column for _, column in CustomerService.EXPORT_COLUMNS]
+        ).select_from(Customer).join(Customer.data)
+
+    @staticmethod
+    def get_customer_rows(start=0, stop=20, filters=None, sort='id'):
+        '''
+        Same as get_customers, but return tuples of the values of
+        EXPORT_COLUMNS, to be serialized with customer_row_json
+
+        :param start:
+            Beginning index (0 based)
+
+        :param stop:
+            End index
+
+        :param filters:
+            A dict of filters, see get_customers
+
+        :param sort:
+            A sort key, see get_customers
+        '''
+        CustomerService.check_list_options(filters, sort)
+        first = 0 if shards.is_enabled() else start
+
+        def query_rows(session):
+            query = CustomerService._filter_list(
+                CustomerService._query_customer_rows(session),
+                filters
+            )
+            return CustomerService._sort_list(query, sort).slice(
+                first,
+                stop
+            ).all()
+
+        return CustomerService._merge(
+            CustomerService._read_all(query_rows),
+            CustomerService._merge_key(sort, rows=True),
+            sort.startswith('-')
+        )[start - first:stop - first]
+
+    @staticmethod
+    def get_customer_rows_after(
+        last_id=None,
+        limit=20,
+        filters=None,
+        sort='id',
+        last_value=None
+    ):
+        '''
+        Same as get_customers_after, but return tuples of the values
+        of EXPORT_COLUMNS, to be serialized with customer_row_json
+
+        :param last_id:
+            The id of the last customer of the previous page, None to
+            get the first page
+
+        :param limit:
+            Maximum number of customers to return
+
+        :param filters:
+            A dict of filters, see get_customers
+
+        :param sort:
+            A sort key, see get_customers
+
+        :param last_value:
+            The sorted value of the last customer of the previous
+            page, unless sorted by id
+        '''
+        CustomerService.check_list_options(filters, sort)
+        after = CustomerService._list_after(sort, last_id, last_value)
+
+        def query_rows(session):
+            query = CustomerService._filter_list(
+                CustomerService._query_customer_rows(session),
+                filters
+            )
+            return CustomerService._sort_list(query, sort, after).limit(
+                limit
+            ).all()
+
+        return CustomerService._merge(
+            CustomerService._read_all(query_rows),
+            CustomerService._merge_key(sort, rows=True),
+            sort.startswith('-')
+        )[:limit]
+
+    @staticmethod
+    def _search_candidates(text, dialect):
+        '''
+        Return a select of the ids of the customers whose email, first
+        name, last name or cellphone contains a text, through the
+        search indexes of the database. SQLite before 3.34 has no
+        trigram tokenizer, the LIKE version scans the tables there.
+
+        :param text:
+            The lower case text to search
+
+        :param dialect:
+            The name of the dialect of the database searched
+        '''
+        if dialect == 'sqlite' and SQLITE_TRIGRAM:
+            search = sql.table('customer_search', sql.column('rowid'))
+            return select([search.c.rowid]).where(
+                sql.literal_column('customer_search').match(
+                    '"%s"' % text.replace('"', '""')
+                )
+            )
+
+        #One index scan per column, an OR across the join could not
+        # use them
+        pattern = '%' + _escape_like(text) + '%'
+        return union(
+            select([Customer.id]).where(
+                func.lower(Customer.email).like(pattern, escape='\\')
+            ),
+            select([CustomerData.customer_id]).where(or_(
+                func.lower(CustomerData.first_name).like(
+                    pattern,
+                    escape='\\'
+                ),
+                func.lower(CustomerData.last_name).like(
+                    pattern,
+                    escape='\\'
+                ),
+                CustomerData.cellphone.like(pattern, escape='\\')
+            ))
+        )
+
+    @staticmethod
+    def search_customers(text, after=None, limit=20):
+        '''
+        Return the active customers whose email, first name, last
+        name or cellphone contains a text, case insensitive. They are
+        ranked: 0 for the exact email, 1 when a field starts with the
+        text and 2 for the other matches, then ordered by id.
+
+        :param text:
+            The text to search, at least SEARCH_MIN_LENGTH characters
+
+        :param after:
+            The (rank, id) of the last customer of the previous page,
+            None to get the first page
+
+        :param limit:
+            Maximum number of customers to return
+
+        Returns a list of tuples of the rank followed by the values of
+        EXPORT_COLUMNS.
+
+        Example on how to search a phone number ::
+
+            CustomerService.search_customers('0612')
+        '''
+        text = text.lower()
+        prefix = _escape_like(text) + '%'
+        email = func.lower(Customer.email)
+
+        rank = case([
+            (email == text, 0),
+            (or_(
+                email.like(prefix, escape='\\'),
+                func.lower(CustomerData.first_name).like(
+                    prefix,
+                    escape='\\'
+                ),
+                func.lower(CustomerData.last_name).like(
+                    prefix,
+                    escape='\\'
+                ),
+                CustomerData.cellphone.like(prefix, escape='\\')
+            ), 1)
+        ], else_=2)
+
+        def search(session):
+            candidates = CustomerService._search_candidates(
+                text,
+                session.bind.dialect.name
+            )
+            query = session.query(
+                rank,
+                *[column for _, column in CustomerService.EXPORT_COLUMNS]
+            ).select_from(Customer).join(Customer.data).filter(
+                Customer.id.in_(candidates),
+                Customer.active == True
+            )
+
+            if after is not None:
+                last_rank, last_id = after
+                query = query.filter(or_(
+                    rank > last_rank,
+                    and_(rank == last_rank, Customer.id > last_id)
+                ))
+
+            return query.order_by(rank, Customer.id).limit(limit).all()
+
+        return CustomerService._merge(
+            CustomerService._read_all(search),
+            lambda row: (row[0], row[1])
+        )[:limit]
+
+    @staticmethod
+    def iter_customer_rows(
+        columns=None,
+        newsletter=None,
+        created_from=None,
+        created_to=None
+    ):
+        '''
+        Stream active customer rows ordered by id, as tuples of column
+        values. The rows are fetched EXPORT_BATCH_SIZE at a time
+        through a server side cursor, so the memory used does not
+        depend on the number of customers. When the customers are
+        sharded, the streams of the shards are merged on the id.
+
+        :param columns:
+            Names of the EXPORT_COLUMNS to select, all by default
+
+        :param newsletter:
+            Only the customers with this newsletter flag, if not None
+
+        :param created_from:
+            Only the customers created at or after this datetime
+
+        :param created_to:
+            Only the customers created before this datetime
+
+        Example on how to export the newsletter subscribers ::
+
+            for customer_id, email in CustomerService.iter_customer_rows(
+                    ['id', 'email'], newsletter=True):
+                ...
+        '''
+        available = dict(CustomerService.EXPORT_COLUMNS)
+        if columns is None:
+            columns = [name for name, _ in CustomerService.EXPORT_COLUMNS]
+
+        selected = [available[name] for name in columns]
+        if shards.is_enabled():
+            selected.insert(0, Customer.id)
+
+        def query_rows(session):
+            query = session.query(*selected).select_from(Customer).join(
+                Customer.data
+            ).filter(Customer.active == True)
+
+            if newsletter is not None:
+                query = query.filter(CustomerData.newsletter == newsletter)
+            if created_from is not None:
+                query = query.filter(CustomerData.created >= created_from)
+            if created_to is not None:
+                query = query.filter(CustomerData.created < created_to)
+
+            return query.order_by(Customer.id).execution_options(
+                stream_results=True
+            ).yield_per(CustomerService.EXPORT_BATCH_SIZE)
+
+        if not shards.is_enabled():
+            return router.read(query_rows)
+
+        streams = [query_rows(shard.session) for shard in shards.shards()]
+        return (row[1:] for row in heapq.merge(*streams))
+
+    @staticmethod
+    def get_count_customers(filters=None):
+        '''
+        Returns the total number of active customers
+
+        :param filters:
+            Only count the customers matching these filters, see
+            get_customers
         '''
-        return db.session.query(Customer).slice(start, stop)
+        def count(session):
+            if not CustomerService._list_key(filters, 'id')[1]:
+                return session.query(Customer.id).filter(
+                    Customer.active == True
+                ).count()
+
+            return CustomerService._filter_list(
+                session.query(Customer.id).join(Customer.data),
+                filters
+            ).count()
+
+        return sum(CustomerService._read_all(count))
 
     @staticmethod
-    def get_count_customers():
+    def estimate_count_customers():
         '''
-        Returns the total number of customers
+        Returns the number of customers estimated by the Postgres
+        planner statistics, or None if they are not available (other
+        database, or table never analyzed) on any of the shards.
         '''
-        return db.session.query(Customer.id).count()
+        def estimate_count(session):
+            if session.bind.dialect.name != 'postgresql':
+                return None
+
+            return session.execute(
+                "SELECT reltuples::bigint FROM pg_class "
+                "WHERE relname = :table",
+                dict(table=Customer.__tablename__)
+            ).scalar()
+
+        estimates = CustomerService._read_all(estimate_count)
+
+        if any(estimate is None or estimate <= 0 for estimate in estimates):
+            return None
+
+        return int(sum(estimates))
 
     @staticmethod
-    def delete_customer_by_id(customer_id):
-        customer = CustomerService.get_customer_by_id(customer_id)
+    def count_customers(filters=None):
+        '''
+        Returns the total number of customers using the strategy
+        set in CUSTOMERS_COUNT_MODE, along with the strategy actually
+        used: 'estimated' falls back to 'exact' without statistics.
+        The filtered counts are always exact.
+
+        :param filters:
+            Only count the customers matching these filters, see
+            get_customers
+
+        Example ::
+
+            total, mode = CustomerService.count_customers()
+        '''
+        if CustomerService._list_key(filters, 'id')[1]:
+            return CustomerService.get_count_customers(filters), 'exact'
+
+        mode = count_cache.mode
+
+        if mode == 'estimated':
+            total = CustomerService.estimate_count_customers()
+            if total is not None:
+                return total, mode
+
+        if mode == 'cached':
+            total = count_cache.get()
+            if total is None:
+                total = CustomerService.get_count_customers()
+                count_cache.set(total)
+            return total, mode
+
+        return CustomerService.get_count_customers(), 'exact'
+
+    @staticmethod
+    def delete_customer_by_id(customer_id, soft=None):
+        '''
+        Delete a customer without loading it, see
+        delete_customers_by_ids
+
+        :param customer_id:
+            A customer's id
+
+        :param soft:
+            Only disable the customer (active column), defaults to
+            the CUSTOMERS_SOFT_DELETE setting
+
+        Returns True if the customer has been found and deleted (or
+        disabled, when it was active)
+        '''
+        deleted = CustomerService.delete_customers_by_ids(
+            [customer_id],
+            soft
+        )
+        return customer_id in deleted
+
+    @staticmethod
+    def rebalance_shards(batch_size=1000, dry_run=False):
+        '''
+        Move the customers stored on a shard which does not own their
+        slot, and the id allocators of their slots, to the shard
+        owning it. It must run after a change of SQLALCHEMY_SHARDS,
+        while the writes are stopped: until then the customers not
+        moved yet cannot be found, and the ids of a moved slot could
+        be allocated twice.
+
+        :param batch_size:
+            Number of customers moved per transaction
+
+        :param dry_run:
+            Only count the customers to move
+
+        Returns a dict of the number of customers moved, by (source
+        bind, target bind).
+        '''
+        slot_count = shards.slot_count()
+        moved = {}
+
+        for source in shards.shards():
+            foreign = [
+                slot for slot in range(slot_count)
+                if shards.shard_of_slot(slot) is not source
+            ]
+            if not foreign:
+                continue
+
+            if not dry_run:
+                CustomerService._move_id_slots(source, foreign)
+
+            last_id = 0
+            while True:
+                customer_ids = [
+                    row[0] for row in source.session.query(Customer.id).filter(
+                        (Customer.id % slot_count).in_(foreign),
+                        Customer.id > last_id
+                    ).order_by(Customer.id).limit(batch_size)
+                ]
+                if not customer_ids:
+                    break
+                last_id = customer_ids[-1]
+
+                groups = shards.group(customer_ids, shards.slot_of_id)
+                for target, target_ids in groups:
+                    if not dry_run:
+                        CustomerService._move_customers(
+                            source,
+                            target,
+                            target_ids
+                        )
+                    key = (source.bind, target.bind)
+                    moved[key] = moved.get(key, 0) + len(target_ids)
+
+        return moved
+
+    @staticmethod
+    def _move_id_slots(source, slots):
+        '''
+        Move the id allocators of some slots from a shard to the ones
+        owning them, keeping the highest seq if both have one
+
+        :param source:
+            The Shard storing the allocators
+
+        :param slots:
+            The slots to move
+        '''
+        table = CustomerIdSlot.__table__
+        rows = source.session.execute(
+            select([table.c.slot, table.c.last_seq]).where(
+                table.c.slot.in_(slots)
+            )
+        ).fetchall()
+        if not rows:
+            return
+
+        for target, target_rows in shards.group(rows, lambda row: row[0]):
+            existing = dict(target.session.execute(
+                select([table.c.slot, table.c.last_seq]).where(
+                    table.c.slot.in_([row[0] for row in target_rows])
+                )
+            ).fetchall())
+
+            for slot, last_seq in target_rows:
+                if slot not in existing:
+                    target.session.execute(
+                        table.insert(),
+                        dict(slot=slot, last_seq=last_seq)
+                    )
+                elif existing[slot] < last_seq:
+                    target.session.execute(
+                        table.update().where(
+                            table.c.slot == slot
+                        ).values(last_seq=last_seq)
+                    )
+            target.session.commit()
+
+        source.session.execute(table.delete().where(
+            table.c.slot.in_([row[0] for row in rows])
+        ))
+        source.session.commit()
+
+    @staticmethod
+    def _move_customers(source, target, customer_ids):
+        '''
+        Copy customers and their data from a shard to another in one
+        transaction, then delete them from the first one. The ones
+        already copied by an interrupted run are not copied again.
+
+        :param source:
+            The Shard storing the customers
+
+        :param target:
+            The Shard owning them
+
+        :param customer_ids:
+            The ids of the customers
+        '''
+        customer_table = Customer.__table__
+        data_table = CustomerData.__table__
+        copied = CustomerService._get_existing_ids(
+            target.session,
+            customer_ids
+        )
+        missing = [
+            customer_id for customer_id in customer_ids
+            if customer_id not in copied
+        ]
+
+        if missing:
+            customer_rows = source.session.execute(
+                select([customer_table]).where(
+                    customer_table.c.id.in_(missing)
+                )
+            ).fetchall()
+            #The data gets a new primary key on the target
+            data_rows = source.session.execute(
+                select([
+                    column for column in data_table.c if column.name != 'id'
+                ]).where(data_table.c.customer_id.in_(missing))
+            ).fetchall()
 
-        if customer is not None:
-            db.session.delete(customer)
-            db.session.commit()
-            return True
+            target.session.execute(
+                customer_table.insert(),
+                [dict(row) for row in customer_rows]
+            )
+            if data_rows:
+                target.session.execute(
+                    data_table.insert(),
+                    [dict(row) for row in data_rows]
+                )
+            target.session.commit()
 
-        return False
+        source.session.execute(customer_table.delete().where(
+            customer_table.c.id.in_(customer_ids)
+        ))
+        source.session.commit()
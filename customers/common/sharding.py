@@ -0,0 +1,289 @@
+'''
+Contains the ShardRouter class, which places each customer on one of
+the databases listed in SQLALCHEMY_SHARDS by a hash of its email.
+'''
+
+import zlib
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+from flask import _app_ctx_stack
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+
+def normalize_email(email):
+    '''
+    Return the form of an email address which is hashed, the same as
+    the one compared by the unique index on lower(email)
+
+    :param email:
+        The email address
+    '''
+    return (email or '').lower()
+
+class Shard(object):
+    '''
+    A database holding a part of the customers: its engine and a
+    session per application context.
+    '''
+
+    def __init__(self, bind, engine, session):
+        '''
+        Constructor for the Shard class
+
+        :param bind:
+            The name of the shard in SQLALCHEMY_BINDS, None for the
+            default database
+
+        :param engine:
+            Its engine
+
+        :param session:
+            Its scoped session
+        '''
+        self.bind = bind
+        self.engine = engine
+        self.session = session
+
+class ShardRouter(object):
+    '''
+    Places each customer on one of the SQLALCHEMY_SHARDS (names of
+    SQLALCHEMY_BINDS, None standing for the default database): its
+    email is hashed into one of SHARD_SLOTS slots, slot s belongs to
+    shard s % len(SQLALCHEMY_SHARDS). The ids of the customers of a
+    slot are seq * SHARD_SLOTS + slot, so that a lookup by id or by
+    email goes to a single shard.
+
+    Without SQLALCHEMY_SHARDS, the default database is the only shard
+    and nothing is run in parallel.
+
+    The settings are read from the config of the application of the
+    database, the engines are created on first use.
+    '''
+
+    def __init__(self, db, app=None):
+        '''
+        Constructor for the ShardRouter class
+
+        :param db:
+            The Flask-SQLAlchemy extension of the default database
+
+        :param app:
+            An optional Flask application
+        '''
+        self.db = db
+        self._shards = {}
+        self._pool = None
+        self._lock = Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        '''
+        Set the default settings: SQLALCHEMY_SHARDS and SHARD_SLOTS,
+        and remove the shard sessions at the end of each application
+        context.
+
+        :param app:
+            A Flask application
+        '''
+        app.config.setdefault('SQLALCHEMY_SHARDS', [])
+        app.config.setdefault('SHARD_SLOTS', 256)
+
+        app.teardown_appcontext(self._remove_sessions)
+
+    def reset(self):
+        '''
+        Forget the shards, close their connections and stop the
+        threads, e.g. after the settings changed
+        '''
+        with self._lock:
+            shards, self._shards = self._shards, {}
+            pool, self._pool = self._pool, None
+        for shard in shards.values():
+            if shard.bind is not None:
+                shard.session.remove()
+                shard.engine.dispose()
+        if pool is not None:
+            pool.terminate()
+
+    def is_enabled(self):
+        '''
+        Returns true if the customers are spread across several
+        databases
+        '''
+        return bool(self.db.get_app().config['SQLALCHEMY_SHARDS'])
+
+    def slot_count(self):
+        '''
+        Return the number of slots, SHARD_SLOTS
+        '''
+        return self.db.get_app().config['SHARD_SLOTS']
+
+    def shards(self):
+        '''
+        Return the Shard objects, in the order of SQLALCHEMY_SHARDS
+        '''
+        binds = self.db.get_app().config['SQLALCHEMY_SHARDS'] or [None]
+        shards = []
+
+        with self._lock:
+            for bind in binds:
+                shard = self._shards.get(bind)
+                if shard is None:
+                    shard = self._shards[bind] = self._create_shard(bind)
+                shards.append(shard)
+
+        return shards
+
+    def _create_shard(self, bind):
+        '''
+        Return a new Shard
+
+        :param bind:
+            The name of the shard in SQLALCHEMY_BINDS, or None
+        '''
+        engine = self.db.get_engine(self.db.get_app(), bind)
+        if bind is None:
+            return Shard(bind, engine, self.db.session)
+
+        return Shard(bind, engine, scoped_session(
+            sessionmaker(bind=engine),
+            scopefunc=_app_ctx_stack.__ident_func__
+        ))
+
+    def slot_of_email(self, email):
+        '''
+        Return the slot of a customer by its email address
+
+        :param email:
+            The email address
+        '''
+        digest = zlib.crc32(normalize_email(email).encode('utf-8'))
+        return (digest & 0xffffffff) % self.slot_count()
+
+    def slot_of_id(self, customer_id):
+        '''
+        Return the slot of a customer by its id
+
+        :param customer_id:
+            The id of the customer
+        '''
+        return int(customer_id) % self.slot_count()
+
+    def shard_of_slot(self, slot):
+        '''
+        Return the shard owning a slot
+
+        :param slot:
+            The slot
+        '''
+        shards = self.shards()
+        return shards[slot % len(shards)]
+
+    def for_email(self, email):
+        '''
+        Return the shard of a customer by its email address
+
+        :param email:
+            The email address
+        '''
+        return self.shard_of_slot(self.slot_of_email(email))
+
+    def for_id(self, customer_id):
+        '''
+        Return the shard of a customer by its id
+
+        :param customer_id:
+            The id of the customer
+        '''
+        return self.shard_of_slot(self.slot_of_id(customer_id))
+
+    def group(self, items, slot):
+        '''
+        Split a list by shard
+
+        :param items:
+            The list to split
+
+        :param slot:
+            Function returning the slot of an item, e.g. slot_of_id
+
+        Returns a list of (shard, items of the shard) tuples, in the
+        order of SQLALCHEMY_SHARDS and without the empty ones.
+        '''
+        shards = self.shards()
+        groups = {}
+
+        for item in items:
+            groups.setdefault(slot(item) % len(shards), []).append(item)
+
+        return [(shards[index], groups[index]) for index in sorted(groups)]
+
+    def run(self, calls):
+        '''
+        Run read-only functions on some shards, in parallel when there
+        is more than one
+
+        :param calls:
+            A list of (shard, function taking a session as parameter)
+            tuples
+
+        Returns the list of the results, in the same order.
+
+        A single function runs in the current thread with the session
+        of the shard. Otherwise each one runs in a thread of the pool
+        with a session of its own, closed when it returns: the
+        instances it returns are detached, their relationships must
+        have been loaded.
+        '''
+        if len(calls) <= 1:
+            return [func(shard.session) for shard, func in calls]
+
+        app = self.db.get_app()
+
+        def call(args):
+            shard, func = args
+            with app.app_context():
+                session = Session(bind=shard.engine)
+                try:
+                    return func(session)
+                finally:
+                    session.close()
+
+        return self._get_pool().map(call, calls)
+
+    def map(self, func):
+        '''
+        Run a read-only function on every shard, see run
+
+        :param func:
+            Function taking a session as parameter
+
+        Example ::
+
+            total = sum(shards.map(
+                lambda session: session.query(Customer.id).count()
+            ))
+        '''
+        return self.run([(shard, func) for shard in self.shards()])
+
+    def _get_pool(self):
+        '''
+        Return the thread pool running the functions, with a thread
+        per shard. It is created on first use, so that it is not
+        inherited by forked workers.
+        '''
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(
+                    len(self.db.get_app().config['SQLALCHEMY_SHARDS'])
+                )
+            return self._pool
+
+    def _remove_sessions(self, exception=None):
+        '''
+        Close the shard sessions of the application context
+        '''
+        for shard in list(self._shards.values()):
+            if shard.bind is not None:
+                shard.session.remove()
@@ -3,7 +3,11 @@ This module contains the error blueprint to handle all the
 common HTTP errors.
 '''
 
-from flask import Blueprint, jsonify
+import math
+from flask import Blueprint
+from customers.common.serializers import json_response
+from customers.common.hashing import HashingQueueFull
+from customers.common.limiter import LoginRateLimited
 
 bp = Blueprint('errors', __name__)
 
@@ -20,10 +24,30 @@ def _generic_error(error, message, code):
     :param code:
         The HTTP error code to use
     '''
-    response = jsonify(error=message)
+    response = json_response(error=message)
     response.status_code = code
     return response
 
+def _retry_later(error, message, code):
+    '''
+    Error handler of the rejected requests, telling the client when
+    to retry with the Retry-After header
+
+    :param error:
+        A python error with a retry_after attribute, or a normal HTTP
+        error
+
+    :param message:
+        A custom error message to return
+
+    :param code:
+        The HTTP error code to use
+    '''
+    response = _generic_error(error, message, code)
+    retry_after = getattr(error, 'retry_after', None) or 1
+    response.headers['Retry-After'] = str(int(math.ceil(retry_after)))
+    return response
+
 @bp.app_errorhandler(400)
 def bad_request(error):
     '''
@@ -58,3 +82,48 @@ def page_not_found(error):
     '''
     return _generic_error(error, 'Page not found', 404)
 
+
+@bp.app_errorhandler(412)
+def precondition_failed(error):
+    '''
+    Error handler for 412
+
+    :param error:
+        A python error, is None for a normal HTTP error
+    '''
+    return _generic_error(
+        error,
+        'The resource has been modified in the meantime',
+        412
+    )
+
+@bp.app_errorhandler(429)
+@bp.app_errorhandler(LoginRateLimited)
+def too_many_requests(error):
+    '''
+    Error handler for 429, raised by the failed logins limiter
+
+    :param error:
+        A python error, is None for a normal HTTP error
+    '''
+    return _retry_later(
+        error,
+        'Too many failed logins, please retry later',
+        429
+    )
+
+@bp.app_errorhandler(503)
+@bp.app_errorhandler(HashingQueueFull)
+def service_unavailable(error):
+    '''
+    Error handler for 503, raised when too many password operations
+    are pending
+
+    :param error:
+        A python error, is None for a normal HTTP error
+    '''
+    return _retry_later(
+        error,
+        'The service is overloaded, please retry later',
+        503
+    )
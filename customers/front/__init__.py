@@ -12,6 +12,10 @@ bp.add_url_rule(
     '/register',
     view_func=CustomerAPI.Register.as_view('register')
 )
+bp.add_url_rule(
+    '/login',
+    view_func=CustomerAPI.Login.as_view('login')
+)
 bp.add_url_rule(
     '/profile',
     view_func=CustomerAPI.Profile.as_view('profile')
@@ -2,11 +2,11 @@
 Collection of forms for the customer API
 '''
 
-from flask import g
 from flask_wtf import Form
 from wtforms import StringField, ValidationError, BooleanField
 from wtforms.validators import DataRequired, Email, EqualTo
 from customers.common.services import CustomerService
+from customers.login import authenticate, current_customer
 
 class RegistrationForm(Form):
     '''
@@ -23,13 +23,34 @@ class RegistrationForm(Form):
         :param field:
             Field object, the email string is in field.data
         '''
-        customer = CustomerService.get_customer_by_email(field.data)
-
-        if customer is not None:
+        #The email addresses of the soft deleted customers are taken
+        if CustomerService.get_taken_emails([(field.data or '').lower()]):
             raise ValidationError(
                 'Email address already taken.'
             )
 
+class LoginForm(Form):
+    '''
+    Validators for the login form
+    '''
+    email = StringField('email', validators=[Email()])
+    password = StringField('password', validators=[DataRequired()])
+
+    def validate_password(self, field):
+        '''
+        Custom validator to check the credentials, the authenticated
+        customer is kept in self.customer.
+
+        :param field:
+            Field object, the password string is in field.data
+        '''
+        self.customer = authenticate(self.email.data, field.data)
+
+        if self.customer is None:
+            raise ValidationError(
+                'Invalid email address or password.'
+            )
+
 class ProfileForm(Form):
     '''
     Validators for the profile form
@@ -58,7 +79,7 @@ class PasswordForm(Form):
         :param field:
             Field object, the password string is in field.data
         '''
-        if not g.customer.check_password(field.data):
+        if not current_customer().check_password(field.data):
             raise ValidationError(
                 "The old password is not matching."
             )
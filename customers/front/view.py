@@ -2,13 +2,25 @@
 Customer API
 '''
 
-from flask import jsonify, request, g
+from flask import request, g, current_app, abort
 from flask.views import MethodView
 from customers.common.models.customer import Customer
-from customers.common.services import CustomerService
-from customers.login import requires_auth
+from customers.common.services import CustomerService, VersionConflict
+from customers.common.serializers import json_response
+from customers.common.conditional import(
+    customer_etag,
+    not_modified,
+    expected_version,
+    with_etag
+)
+from customers.login import (
+    requires_auth,
+    current_customer,
+    generate_token
+)
 from customers.front.forms import (
     RegistrationForm,
+    LoginForm,
     ProfileForm,
     PasswordForm
 )
@@ -27,7 +39,7 @@ class Register(MethodView):
         form = RegistrationForm.from_json(request.get_json())
 
         if not form.validate_on_submit():
-            return jsonify(errors=form.errors)
+            return json_response(errors=form.errors)
 
         customer = Customer(
             email=form.email.data,
@@ -36,7 +48,30 @@ class Register(MethodView):
 
         CustomerService.add_customer(customer)
 
-        return jsonify(id=customer.id)
+        return json_response(id=customer.id)
+
+class Login(MethodView):
+    '''
+    Exchange the customer's credentials for a bearer token
+    '''
+
+    def post(self):
+        '''
+        Check the credentials once and return a short-lived signed
+        token, to send in an 'Authorization: Bearer' header instead
+        of the basic auth credentials.
+
+        Returns the token and its lifetime in seconds.
+        '''
+        form = LoginForm.from_json(request.get_json())
+
+        if not form.validate_on_submit():
+            return json_response(errors=form.errors)
+
+        return json_response(
+            token=generate_token(form.customer),
+            expires_in=current_app.config.get('AUTH_TOKEN_MAX_AGE', 900)
+        )
 
 class Profile(MethodView):
     '''
@@ -46,38 +81,97 @@ class Profile(MethodView):
     @requires_auth
     def get(self):
         '''
+        Returns the Customer profile with its ETag, from the customer
+        cache unless it has already been loaded by the authentication.
+        Answers 304 if the If-None-Match header matches.
+        '''
+        customer = g.get('customer')
+        if customer is not None:
+            etag = customer_etag(customer.id, customer.version)
+            return not_modified(etag) or with_etag(
+                json_response(customer=customer.json),
+                etag
+            )
+
+        if request.if_none_match:
+            version = CustomerService.get_customer_version(g.customer_id)
+            if version is not None:
+                response = not_modified(customer_etag(g.customer_id, version))
+                if response is not None:
+                    return response
+
+        record = CustomerService.get_customer_record(g.customer_id)
+        if record is None:
+            abort(401)
+
+        return with_etag(
+            json_response(customer=record['customer']),
+            customer_etag(g.customer_id, record['version'])
+        )
+
+    @staticmethod
+    def _patch(changes):
+        '''
+        Apply changes to the Customer profile with a single UPDATE
+        per table, checking the version sent in the If-Match header
+        if any.
+
+        :param changes:
+            A dict of the profile fields to change
+
         Returns the Customer profile
         '''
-        return jsonify(customer=g.customer.json)
+        try:
+            record = CustomerService.patch_customer(
+                g.customer_id,
+                changes,
+                expected_version(g.customer_id)
+            )
+        except VersionConflict:
+            abort(412)
+
+        if record is None:
+            abort(401)
+
+        return with_etag(
+            json_response(customer=record['customer']),
+            customer_etag(g.customer_id, record['version'])
+        )
 
     @requires_auth
     def put(self):
         '''
-        Update the Customer profile
-
-        TODO: when this get merged and available on pypi :
-        https://github.com/wtforms/wtforms/pull/147/files
+        Update the Customer profile, the fields missing from the
+        json are reset. With an If-Match header, the update is refused
+        with a 412 if the profile has changed.
 
-        Sample::
+        Returns the Customer profile
+        '''
+        form = ProfileForm.from_json(request.get_json())
 
-            form.populate_obj(g.customer.data, partial=False)
+        if not form.validate_on_submit():
+            return json_response(errors=form.errors)
 
-        Also, consider::
+        return Profile._patch(form.data)
 
-            form.patch_data
+    @requires_auth
+    def patch(self):
+        '''
+        Update some fields of the Customer profile, the fields
+        missing from the json are left untouched. With an If-Match
+        header, the update is refused with a 412 if the profile has
+        changed.
 
         Returns the Customer profile
         '''
         form = ProfileForm.from_json(request.get_json())
 
-        if not form.validate_on_submit():
-            return jsonify(errors=form.errors)
-
-        form.populate_obj(g.customer.data)
-
-        CustomerService.update_customer(g.customer)
+        #Here we are not using form.validate_on_submit because it
+        # will only work for PUT and POST request methods.
+        if not form.validate():
+            return json_response(errors=form.errors)
 
-        return jsonify(customer=g.customer.json)
+        return Profile._patch(form.patch_data)
 
 
 class ChangePassword(MethodView):
@@ -97,10 +191,11 @@ class ChangePassword(MethodView):
         #Here we are not using form.validate_on_submit because it
         # will only work for PUT and POST request methods.
         if not form.validate() or not request.method == "PATCH":
-            return jsonify(errors=form.errors)
+            return json_response(errors=form.errors)
 
-        g.customer.set_password(form.password.data)
+        customer = current_customer()
+        customer.set_password(form.password.data)
 
-        CustomerService.update_customer(g.customer)
+        CustomerService.update_customer(customer)
 
-        return jsonify(msg="OK")
+        return json_response(msg="OK")
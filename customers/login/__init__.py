@@ -4,8 +4,47 @@ Part of it from: http://flask.pocoo.org/snippets/8/
 '''
 
 from functools import wraps
-from flask import request, g, abort
+from flask import request, g, abort, current_app, has_request_context
+from itsdangerous import URLSafeTimedSerializer, BadSignature
 from customers.common.services import CustomerService
+from customers.utils import login_limiter
+
+TOKEN_SALT = 'customers-auth-token'
+
+def authenticate(email, password):
+    '''
+    Return the customer matching an email / password combination,
+    None if there is none. A password hashed with an outdated cost
+    factor is hashed again with the current one.
+
+    Raises LoginRateLimited, before any bcrypt operation, when the
+    email address or the client address failed too many logins.
+
+    :param email:
+        The email address of the customer
+
+    :param password:
+        Clear password
+    '''
+    address = None
+    if has_request_context():
+        address = login_limiter.client_address(request)
+
+    login_limiter.check(email, address)
+
+    customer = CustomerService.get_customer_by_email(email)
+
+    if customer is None or not customer.check_password(password):
+        login_limiter.record_failure(email, address)
+        return None
+
+    login_limiter.record_success(email)
+
+    if customer.needs_rehash():
+        customer.set_password(password)
+        CustomerService.update_customer(customer)
+
+    return customer
 
 def check_auth(username, password):
     '''
@@ -18,24 +57,92 @@ def check_auth(username, password):
     :param password:
         The password used in the basic auth field
     '''
-    customer = CustomerService.get_customer_by_email(username)
+    customer = authenticate(username, password)
 
     if customer is not None:
-        if customer.check_password(password):
-            g.customer = customer
-            return True
+        g.customer = customer
+        g.customer_id = customer.id
+        return True
+
+    return False
+
+def current_customer():
+    '''
+    Return the Customer instance of the authenticated customer. When
+    authenticated with a token, it is only loaded on the first call,
+    so the views which only read the profile can use the cached
+    record of g.customer_id instead.
+    '''
+    customer = g.get('customer')
+
+    if customer is None:
+        customer = CustomerService.get_customer_by_id(g.customer_id)
+        if customer is None:
+            abort(401)
+        g.customer = customer
+
+    return customer
+
+def _get_token_serializer():
+    '''
+    Return the serializer used to sign the bearer tokens
+    '''
+    return URLSafeTimedSerializer(
+        current_app.config['SECRET_KEY'],
+        salt=TOKEN_SALT
+    )
+
+def generate_token(customer):
+    '''
+    Generate a signed bearer token for a customer whose password has
+    already been checked. The token embeds the password version of
+    the customer, so changing the password revokes it.
+
+    :param customer:
+        An authenticated Customer instance
+    '''
+    return _get_token_serializer().dumps(dict(
+        id=customer.id,
+        pv=customer.password_version
+    ))
+
+def check_token(token):
+    '''
+    This function is called to check if a bearer token is valid.
+    The signature and the expiration are verified with HMAC only,
+    then the password version of the token is compared to the one of
+    the customer, so that a changed password revokes it. That version
+    comes from the customer cache when CUSTOMER_CACHE_ENABLED is set,
+    otherwise from a query of the password hash of the customer.
+
+    :param token:
+        The token used in the bearer auth field
+    '''
+    try:
+        payload = _get_token_serializer().loads(
+            token,
+            max_age=current_app.config.get('AUTH_TOKEN_MAX_AGE', 900)
+        )
+    except BadSignature:
+        return False
+
+    version = CustomerService.get_password_version(payload.get('id'))
+
+    if version is not None and version == payload.get('pv'):
+        g.customer_id = payload.get('id')
+        return True
 
     return False
 
 def requires_auth(func):
     '''
     Decorator to use for any view which requires an authenticated
-    customer.
+    customer, either with HTTP Basic auth or with a bearer token.
     Example::
 
         @requires_auth
         def view_my_profile(self):
-            return g.customer.data
+            return current_customer().data
 
     :param func:
         The function to call
@@ -46,8 +153,18 @@ def requires_auth(func):
         '''
         The inner decorator
         '''
-        auth = request.authorization
-        if not auth or not check_auth(auth.username, auth.password):
+        header = request.headers.get('Authorization', '')
+
+        if header.startswith('Bearer '):
+            authenticated = check_token(header[len('Bearer '):].strip())
+        else:
+            auth = request.authorization
+            authenticated = auth is not None and check_auth(
+                auth.username,
+                auth.password
+            )
+
+        if not authenticated:
             abort(401)
         return func(*args, **kwargs)
 
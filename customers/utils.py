@@ -5,11 +5,67 @@ constructor. But this time, the app object will be passed once they
 have been initialized here.
 '''
 
+import sqlite3
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.bcrypt import Bcrypt
+from customers.common.cache import (
+    VerificationCache,
+    CountCache,
+    CustomerCache
+)
+from customers.common.hashing import PasswordHasher
+from customers.common.group_commit import GroupCommitWriter
+from customers.common.limiter import LoginLimiter
+from customers.common.metrics import Metrics
+from customers.common.query_monitor import QueryMonitor
+from customers.common.routing import ReplicaRouter
+from customers.common.sharding import ShardRouter
 
 #Database
 db = SQLAlchemy()
 
+#Routing of the reads to the replicas of the database
+router = ReplicaRouter(db)
+
+#Placement of the customers on the shards of the database
+shards = ShardRouter(db)
+
+@event.listens_for(Engine, 'connect')
+def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    '''
+    SQLite ignores the foreign keys, and their ON DELETE CASCADE,
+    unless it is enabled on each connection
+    '''
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+#Batched inserts of the new customers
+group_commit = GroupCommitWriter()
+
 #Bcrypt encryption
 bcrypt = Bcrypt()
+
+#Pool running the bcrypt operations
+hasher = PasswordHasher(bcrypt)
+
+#Password verification cache
+auth_cache = VerificationCache()
+
+#Strategy used to count the customers
+count_cache = CountCache()
+
+#Read-through cache of the serialized customers
+customer_cache = CustomerCache()
+
+#Rate limits of the failed logins
+login_limiter = LoginLimiter()
+
+#Per endpoint latency, SQL and bcrypt measures
+metrics = Metrics(hasher, login_limiter)
+
+#Slow query log and repeated statements detector
+query_monitor = QueryMonitor()
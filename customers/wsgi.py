@@ -0,0 +1,8 @@
+'''
+The application served by gunicorn: `gunicorn customers.wsgi:app`,
+see conf/supervisord.conf and conf/gunicorn.py.
+'''
+
+from customers import create_app
+
+app = create_app()
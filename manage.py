@@ -1,4 +1,4 @@
-from customers import manager
+from customers.cli import create_manager
 
 if __name__ == '__main__':
-    manager.run()
+    create_manager().run()
@@ -0,0 +1,40 @@
+"""Indexes on the customer lookup columns
+
+Revision ID: 1f6e8a2c9d41
+Revises: 4376df45288a
+Create Date: 2026-10-18 10:12:03.418227
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '1f6e8a2c9d41'
+down_revision = '4376df45288a'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    #Functional index, not supported by op.create_index. It will fail
+    # if two customers share an email address with a different case.
+    op.execute(
+        'CREATE UNIQUE INDEX ix_customer_email_lower '
+        'ON customer (lower(email))'
+    )
+    op.create_index(
+        'ix_customer_data_customer_id',
+        'customer_data',
+        ['customer_id'],
+        unique=True
+    )
+    op.create_index(
+        'ix_customer_data_created',
+        'customer_data',
+        ['created']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_customer_data_created', 'customer_data')
+    op.drop_index('ix_customer_data_customer_id', 'customer_data')
+    op.drop_index('ix_customer_email_lower', 'customer')
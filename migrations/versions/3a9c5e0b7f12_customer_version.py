@@ -0,0 +1,27 @@
+"""Version of the customers, for the entity tags
+
+Revision ID: 3a9c5e0b7f12
+Revises: 1f6e8a2c9d41
+Create Date: 2026-10-18 11:02:47.560318
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a9c5e0b7f12'
+down_revision = '1f6e8a2c9d41'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('customer', sa.Column(
+        'version',
+        sa.Integer(),
+        nullable=False,
+        server_default='1'
+    ))
+
+
+def downgrade():
+    op.drop_column('customer', 'version')
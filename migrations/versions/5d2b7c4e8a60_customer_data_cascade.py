@@ -0,0 +1,45 @@
+"""Delete the customer data with its customer
+
+Revision ID: 5d2b7c4e8a60
+Revises: 3a9c5e0b7f12
+Create Date: 2026-10-18 11:48:19.902741
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2b7c4e8a60'
+down_revision = '3a9c5e0b7f12'
+
+from alembic import op
+import sqlalchemy as sa
+
+#Name given by Postgres to the foreign key of the first revision
+FOREIGN_KEY = 'customer_data_customer_id_fkey'
+
+
+def upgrade():
+    #Data left behind by the ORM deletes, which did not cascade
+    op.execute(
+        'DELETE FROM customer_data WHERE customer_id IS NULL '
+        'OR customer_id NOT IN (SELECT id FROM customer)'
+    )
+    op.drop_constraint(FOREIGN_KEY, 'customer_data', type_='foreignkey')
+    op.create_foreign_key(
+        FOREIGN_KEY,
+        'customer_data',
+        'customer',
+        ['customer_id'],
+        ['id'],
+        ondelete='CASCADE'
+    )
+
+
+def downgrade():
+    op.drop_constraint(FOREIGN_KEY, 'customer_data', type_='foreignkey')
+    op.create_foreign_key(
+        FOREIGN_KEY,
+        'customer_data',
+        'customer',
+        ['customer_id'],
+        ['id']
+    )
@@ -0,0 +1,43 @@
+"""Search indexes on the customer email, names and cellphone
+
+Revision ID: 7c3e1f9a2b84
+Revises: 5d2b7c4e8a60
+Create Date: 2026-10-18 16:05:41.902311
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c3e1f9a2b84'
+down_revision = '5d2b7c4e8a60'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    #Trigram indexes, used by LIKE '%text%' on the same expressions.
+    # Creating the extension needs to own the database.
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.execute(
+        'CREATE INDEX ix_customer_email_trgm ON customer '
+        'USING gin (lower(email) gin_trgm_ops)'
+    )
+    op.execute(
+        'CREATE INDEX ix_customer_data_first_name_trgm ON customer_data '
+        'USING gin (lower(first_name) gin_trgm_ops)'
+    )
+    op.execute(
+        'CREATE INDEX ix_customer_data_last_name_trgm ON customer_data '
+        'USING gin (lower(last_name) gin_trgm_ops)'
+    )
+    op.execute(
+        'CREATE INDEX ix_customer_data_cellphone_trgm ON customer_data '
+        'USING gin (cellphone gin_trgm_ops)'
+    )
+
+
+def downgrade():
+    op.drop_index('ix_customer_data_cellphone_trgm', 'customer_data')
+    op.drop_index('ix_customer_data_last_name_trgm', 'customer_data')
+    op.drop_index('ix_customer_data_first_name_trgm', 'customer_data')
+    op.drop_index('ix_customer_email_trgm', 'customer')
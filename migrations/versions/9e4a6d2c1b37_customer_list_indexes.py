@@ -0,0 +1,73 @@
+"""Email domain and indexes of the customer list filters and sort keys
+
+Revision ID: 9e4a6d2c1b37
+Revises: 7c3e1f9a2b84
+Create Date: 2026-10-18 17:21:36.118450
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '9e4a6d2c1b37'
+down_revision = '7c3e1f9a2b84'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column(
+        'customer',
+        sa.Column('email_domain', sa.String(), nullable=True)
+    )
+    op.execute(
+        "UPDATE customer SET email_domain = lower(split_part(email, '@', 2))"
+    )
+
+    op.create_index(
+        'ix_customer_active_id',
+        'customer',
+        ['active', 'id']
+    )
+    op.create_index(
+        'ix_customer_email_domain_id',
+        'customer',
+        ['email_domain', 'id']
+    )
+
+    #The customer id breaks the ties of the created sort
+    op.drop_index('ix_customer_data_created', 'customer_data')
+    op.create_index(
+        'ix_customer_data_created',
+        'customer_data',
+        ['created', 'customer_id']
+    )
+    op.create_index(
+        'ix_customer_data_newsletter_created',
+        'customer_data',
+        ['newsletter', 'created', 'customer_id']
+    )
+    op.create_index(
+        'ix_customer_data_last_name',
+        'customer_data',
+        ['last_name', 'customer_id']
+    )
+    op.create_index(
+        'ix_customer_data_newsletter_last_name',
+        'customer_data',
+        ['newsletter', 'last_name', 'customer_id']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_customer_data_newsletter_last_name', 'customer_data')
+    op.drop_index('ix_customer_data_last_name', 'customer_data')
+    op.drop_index('ix_customer_data_newsletter_created', 'customer_data')
+    op.drop_index('ix_customer_data_created', 'customer_data')
+    op.create_index(
+        'ix_customer_data_created',
+        'customer_data',
+        ['created']
+    )
+    op.drop_index('ix_customer_email_domain_id', 'customer')
+    op.drop_index('ix_customer_active_id', 'customer')
+    op.drop_column('customer', 'email_domain')
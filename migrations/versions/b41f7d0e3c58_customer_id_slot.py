@@ -0,0 +1,27 @@
+"""Allocators of the customer ids of the shards
+
+Revision ID: b41f7d0e3c58
+Revises: 9e4a6d2c1b37
+Create Date: 2026-10-18 19:12:05.734916
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b41f7d0e3c58'
+down_revision = '9e4a6d2c1b37'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table(
+        'customer_id_slot',
+        sa.Column('slot', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('last_seq', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('slot')
+    )
+
+
+def downgrade():
+    op.drop_table('customer_id_slot')
@@ -0,0 +1,30 @@
+"""Customers active on creation, inactive once soft deleted
+
+Revision ID: d7e2a91c4f05
+Revises: b41f7d0e3c58
+Create Date: 2026-10-19 09:41:18.203571
+
+The customers used to be created inactive, so the ones soft deleted
+before this revision cannot be told apart from the others: they are
+activated as well. Delete them again after the upgrade.
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd7e2a91c4f05'
+down_revision = 'b41f7d0e3c58'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+customer = sa.table('customer', sa.column('active', sa.Boolean()))
+
+
+def upgrade():
+    op.execute(customer.update().values(active=True))
+
+
+def downgrade():
+    #The active flags are kept, they only mean more than before
+    pass
@@ -3,12 +3,48 @@ To run these tests you need to create a test database, instructions
 are inside the README.md
 '''
 
-import customers
-from customers.utils import db
+from customers import create_app
+from customers.utils import(
+    db,
+    router,
+    shards,
+    group_commit,
+    hasher,
+    login_limiter,
+    auth_cache,
+    count_cache,
+    customer_cache,
+    metrics,
+    query_monitor
+)
+from customers.common.cache import(
+    LocalCacheBackend,
+    SharedCacheBackend,
+    LocalSharedClient
+)
+from customers.common.services import CustomerService
+from customers.common.query_monitor import RepeatedQueryError
+from customers.common.serializers import customer_row_json
+from customers.common.models.customer import Customer
+from customers.common.models.customer_data import CustomerData
+from customers.commands.import_customers import ImportCustomers
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError, DBAPIError
+from threading import Thread
 import unittest
+import time
+import logging
+import tempfile
+import shutil
+import os
 import json
 import base64
 
+#The test settings apply before any engine is created
+app = create_app('../conf/config_test.cfg')
+
 class CustomersTestCase(unittest.TestCase):
     '''
     Test the customers application
@@ -19,10 +55,9 @@ class CustomersTestCase(unittest.TestCase):
 
     def setUp(self):
         '''
-        Create a test app and init the database
+        Create a test client and init the database
         '''
-        customers.app.config.from_pyfile('../conf/config_test.cfg')
-        self.app = customers.app.test_client()
+        self.app = app.test_client()
         db.create_all()
 
         #Create a customer
@@ -35,10 +70,17 @@ class CustomersTestCase(unittest.TestCase):
         db.session.close()
         db.drop_all()
 
-    def _open(self, url, method, headers=None, data=None):
+    def _open(
+        self,
+        url,
+        method,
+        headers=None,
+        data=None,
+        prefix='customer'
+    ):
         '''
-        Wrapper to make a request using the dummy values for
-        basic auth
+        Wrapper to make a request on the customer API, or on the
+        admin API with prefix='admin/customer'
         '''
         #This will raise a 40x if the content type is set and yet
         # there is no data to send
@@ -47,7 +89,7 @@ class CustomersTestCase(unittest.TestCase):
             content_type = None
 
         return self.app.open(
-            path='/customer/%s' % url,
+            path='/%s/%s' % (prefix, url),
             method=method,
             data=data,
             headers=headers,
@@ -90,6 +132,91 @@ class CustomersTestCase(unittest.TestCase):
             data=data
         )
 
+    @contextmanager
+    def _assert_statement_count(self, expected):
+        '''
+        Context manager asserting the number of SQL statements run
+        inside its block, the statements are listed on failure
+        '''
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'after_cursor_execute', record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', record)
+
+        self.assertEqual(
+            len(statements),
+            expected,
+            '\n\n'.join(statements)
+        )
+
+    def _explain(self, statement, **params):
+        '''
+        Return the Postgres query plan of a statement, as text. The
+        sequential scans are disabled since the test tables are tiny.
+        '''
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('Query plans are only checked on Postgres')
+
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        rows = db.session.execute('EXPLAIN ' + statement, params)
+        return '\n'.join(row[0] for row in rows)
+
+    def _explain_call(self, func, *args, **kwargs):
+        '''
+        Call a function and return the Postgres query plan of the last
+        statement it ran, with the sequential scans disabled
+        '''
+        if db.engine.dialect.name != 'postgresql':
+            self.skipTest('Query plans are only checked on Postgres')
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, *args):
+            statements.append((statement, parameters))
+
+        db.session.execute('SET LOCAL enable_seqscan = off')
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            func(*args, **kwargs)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+        statement, parameters = statements[-1]
+        rows = db.session.connection().execute(
+            'EXPLAIN ' + statement,
+            parameters
+        )
+        return '\n'.join(row[0] for row in rows)
+
+    def _login(self, email=None, password=None):
+        '''
+        Login and return a bearer token
+        '''
+        data = dict(
+            email=email or self.EMAIL,
+            password=password or self.PASSWORD
+        )
+        resp = self._open('login', 'POST', data=json.dumps(data))
+        return json.loads(resp.get_data())['token']
+
+    def _register(self, email, password):
+        '''
+        Register a new customer and return its id
+        '''
+        data = dict(email=email, password=password)
+        resp = self._open(
+            'register',
+            'POST',
+            data=json.dumps(data),
+        )
+        return json.loads(resp.get_data()).get('id')
+
     def _create_dummy_customer(self):
         '''
         Create a dummy customer
@@ -269,5 +396,1373 @@ class CustomersTestCase(unittest.TestCase):
 
         self.assertIsNone(json_data.get('errors'))
 
+    def test_auth_cache(self):
+        '''
+        Test that the verified credentials are cached, and forgotten
+        once the password changes
+        '''
+        enabled = auth_cache.enabled
+        auth_cache.enabled = True
+        auth_cache.reset_stats()
+        try:
+            #First request => bcrypt, second request => cache hit
+            self._open_with_dummy_auth('profile', 'GET')
+            self._open_with_dummy_auth('profile', 'GET')
+
+            self.assertEqual(auth_cache.hits, 1)
+            self.assertEqual(auth_cache.misses, 1)
+
+            #Change the password => the old one is refused
+            data = dict(old_password='test', password='test2', confirm='test2')
+            self._open_with_dummy_auth(
+                'password',
+                'PATCH',
+                data=json.dumps(data)
+            )
+            resp = self._open_with_dummy_auth('profile', 'GET')
+            json_data = json.loads(resp.get_data())
+
+            self.assertIsNotNone(json_data.get('error'))
+
+            #The new one is accepted
+            resp = self._open_with_auth('profile', 'GET', self.EMAIL, 'test2')
+            json_data = json.loads(resp.get_data())
+
+            self.assertIsNotNone(json_data.get('customer'))
+        finally:
+            auth_cache.enabled = enabled
+
+    def test_login_token(self):
+        '''
+        Test that a bearer token can be used instead of basic auth,
+        and that changing the password revokes it
+        '''
+        #Wrong password => failure
+        data = dict(email=self.EMAIL, password='wrong')
+        resp = self._open('login', 'POST', data=json.dumps(data))
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('errors'))
+
+        #Correct credentials => token
+        data = dict(email=self.EMAIL, password=self.PASSWORD)
+        resp = self._open('login', 'POST', data=json.dumps(data))
+        json_data = json.loads(resp.get_data())
+        token = json_data.get('token')
+
+        self.assertIsNotNone(token)
+
+        headers = {'Authorization': 'Bearer ' + token}
+
+        #With the token => success
+        resp = self._open('profile', 'GET', headers=headers)
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('customer'))
+
+        #With a tampered token => failure
+        resp = self._open(
+            'profile',
+            'GET',
+            headers={'Authorization': 'Bearer x' + token}
+        )
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('error'))
+
+        #Change the password => the token is revoked
+        data = dict(old_password='test', password='test2', confirm='test2')
+        self._open(
+            'password',
+            'PATCH',
+            headers=headers,
+            data=json.dumps(data)
+        )
+        resp = self._open('profile', 'GET', headers=headers)
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('error'))
+
+    def test_list_cursor(self):
+        '''
+        Test that the admin customer list can be walked with a cursor
+        '''
+        for index in range(6):
+            self._register('list%d@test.org' % index, 'test')
+
+        ids = []
+        cursor = None
+        while True:
+            resp = self._open(
+                '',
+                'GET',
+                data=json.dumps(dict(cursor=cursor)),
+                prefix='admin/customer'
+            )
+            json_data = json.loads(resp.get_data())
+
+            self.assertIsNone(json_data.get('errors'))
+            ids.extend(customer['id'] for customer in json_data['customers'])
+
+            cursor = json_data.get('next_cursor')
+            if cursor is None:
+                break
+
+        self.assertEqual(ids, list(range(1, 8)))
+
+        #Forged cursor => failure
+        resp = self._open(
+            '',
+            'GET',
+            data=json.dumps(dict(cursor='forged')),
+            prefix='admin/customer'
+        )
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('errors'))
+
+    def test_list_count_mode(self):
+        '''
+        Test that the cached count is reported and invalidated when
+        a customer is added
+        '''
+        count_cache.mode = 'cached'
+        count_cache.invalidate()
+
+        def get_first_page():
+            resp = self._open(
+                '',
+                'GET',
+                data=json.dumps(dict(page=0)),
+                prefix='admin/customer'
+            )
+            return json.loads(resp.get_data())
+
+        try:
+            json_data = get_first_page()
+            self.assertEqual(json_data.get('count_mode'), 'cached')
+            self.assertFalse(json_data.get('approximate'))
+            self.assertEqual(json_data.get('total_pages'), 1)
+
+            #5 new customers => 6 customers => 2 pages
+            for index in range(5):
+                self._register('count%d@test.org' % index, 'test')
+
+            json_data = get_first_page()
+            self.assertEqual(json_data.get('total_pages'), 2)
+        finally:
+            count_cache.mode = 'exact'
+
+    def test_statement_count(self):
+        '''
+        Test that the customer data is not loaded with one query per
+        customer
+        '''
+        for index in range(4):
+            self._register('n%d@test.org' % index, 'test')
+
+        #One query for the count, one for the page
+        with self._assert_statement_count(2):
+            self._open(
+                '',
+                'GET',
+                data=json.dumps(dict(page=0)),
+                prefix='admin/customer'
+            )
+
+        #One query for the page
+        with self._assert_statement_count(1):
+            self._open(
+                '',
+                'GET',
+                data=json.dumps(dict(cursor=None)),
+                prefix='admin/customer'
+            )
+
+        #One query for the customer
+        with self._assert_statement_count(1):
+            self._open('1', 'GET', prefix='admin/customer')
+
+        #One query for the authentication
+        with self._assert_statement_count(1):
+            self._open_with_dummy_auth('profile', 'GET')
+
+    def test_email_case_insensitive(self):
+        '''
+        Test that an email address cannot be registered twice with a
+        different case, and that login ignores the case
+        '''
+        data = dict(email=self.EMAIL.upper(), password='test')
+        resp = self._open('register', 'POST', data=json.dumps(data))
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('errors'))
+
+        resp = self._open_with_auth(
+            'profile',
+            'GET',
+            self.EMAIL.upper(),
+            self.PASSWORD
+        )
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('customer'))
+
+    def test_lookup_indexes(self):
+        '''
+        Test that the lookup queries use the indexes
+        '''
+        plan = self._explain(
+            'SELECT id FROM customer WHERE lower(email) = :email',
+            email=self.EMAIL
+        )
+        self.assertIn('ix_customer_email_lower', plan)
+
+        plan = self._explain(
+            'SELECT id FROM customer_data WHERE customer_id = :id',
+            id=1
+        )
+        self.assertIn('ix_customer_data_customer_id', plan)
+
+        plan = self._explain(
+            'SELECT id FROM customer_data ORDER BY created LIMIT 5'
+        )
+        self.assertIn('ix_customer_data_created', plan)
+
+    def test_import_customers(self):
+        '''
+        Test the bulk import command, the invalid or duplicated rows
+        are written to the error file
+        '''
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'customers.csv')
+
+        with open(path, 'w') as source:
+            source.write(
+                'email,password,first_name,newsletter\n'
+                'import1@test.org,secret,Import,true\n'
+                'import2@test.org,secret,Import,false\n'
+                'IMPORT1@test.org,secret,Duplicate,false\n'
+                '%s,secret,Taken,false\n'
+                'not-an-email,secret,Invalid,false\n'
+                'import3@test.org,,NoPassword,false\n' % self.EMAIL
+            )
+
+        try:
+            with app.app_context():
+                imported, rejected = ImportCustomers().run(
+                    path,
+                    batch_size=2,
+                    workers=1
+                )
+
+            with open(path + '.errors') as errors:
+                lines = [json.loads(line) for line in errors]
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual(imported, 2)
+        self.assertEqual(rejected, 4)
+        self.assertEqual(
+            sorted(line['line'] for line in lines),
+            [4, 5, 6, 7]
+        )
+
+        customer = CustomerService.get_customer_by_email('import1@test.org')
+        self.assertTrue(customer.check_password('secret'))
+        self.assertTrue(customer.data.newsletter)
+        self.assertEqual(customer.data.first_name, 'Import')
+
+    def test_export(self):
+        '''
+        Test the streamed export of the customers
+        '''
+        self._register('export@test.org', 'test')
+
+        #NDJSON, all the columns
+        resp = self._open('export', 'GET', prefix='admin/customer')
+        lines = [json.loads(line) for line in resp.get_data().splitlines()]
+
+        self.assertEqual([line['id'] for line in lines], [1, 2])
+        self.assertEqual(lines[1]['email'], 'export@test.org')
+        self.assertIn('created', lines[1])
+
+        #CSV, selected columns
+        resp = self._open(
+            'export?format=csv&columns=id,email',
+            'GET',
+            prefix='admin/customer'
+        )
+        lines = resp.get_data().splitlines()
+
+        self.assertEqual(lines[0].strip(), 'id,email')
+        self.assertEqual(len(lines), 3)
+
+        #Filter on the newsletter, nobody subscribed
+        resp = self._open(
+            'export?newsletter=true',
+            'GET',
+            prefix='admin/customer'
+        )
+        self.assertEqual(resp.get_data(), '')
+
+        #Unknown column => failure
+        resp = self._open(
+            'export?columns=password',
+            'GET',
+            prefix='admin/customer'
+        )
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data['errors'].get('columns'))
+
+    def test_batch(self):
+        '''
+        Test the batch get, update and delete of customers
+        '''
+        self._register('batch@test.org', 'test')
+
+        def open_batch(method, data):
+            resp = self._open(
+                'batch',
+                method,
+                data=json.dumps(data),
+                prefix='admin/customer'
+            )
+            return json.loads(resp.get_data())
+
+        #Get, one query whatever the number of ids
+        with self._assert_statement_count(1):
+            json_data = open_batch('GET', dict(ids=[2, 1, 42]))
+        results = json_data['results']
+
+        self.assertEqual([result['id'] for result in results], [2, 1, 42])
+        self.assertEqual(results[0]['customer']['email'], 'batch@test.org')
+        self.assertIsNotNone(results[2].get('msg'))
+
+        #Update, the versions with RETURNING then the data FROM VALUES
+        with self._assert_statement_count(2):
+            json_data = open_batch('PUT', dict(customers=[
+                dict(id=1, first_name='One', newsletter=True),
+                dict(id=2, first_name='Two'),
+                dict(id=42, first_name='Unknown'),
+            ]))
+        results = json_data['results']
+
+        self.assertTrue(results[0]['result'])
+        self.assertTrue(results[1]['result'])
+        self.assertIsNotNone(results[2].get('msg'))
+
+        json_data = open_batch('GET', dict(ids=[1, 2]))
+        records = [result['customer'] for result in json_data['results']]
+
+        self.assertEqual(records[0]['data']['first_name'], 'One')
+        self.assertTrue(records[0]['data']['newsletter'])
+        self.assertEqual(records[1]['data']['first_name'], 'Two')
+
+        #Delete
+        json_data = open_batch('DELETE', dict(ids=[2, 42]))
+
+        self.assertEqual(
+            [result['result'] for result in json_data['results']],
+            [True, False]
+        )
+        json_data = open_batch('GET', dict(ids=[2]))
+        self.assertIsNotNone(json_data['results'][0].get('msg'))
+
+        #Too many ids => failure
+        max_size = app.config['BATCH_MAX_SIZE']
+        json_data = open_batch('GET', dict(ids=list(range(max_size + 1))))
+        self.assertIsNotNone(json_data['errors'].get('ids'))
+
+    def test_rehash(self):
+        '''
+        Test that a password hashed with an outdated cost factor is
+        hashed again on login
+        '''
+        rounds = hasher.rounds
+        try:
+            hasher.rounds = 4
+            customer_id = self._register('rehash@test.org', 'test')
+
+            hasher.rounds = 5
+            resp = self._open_with_auth(
+                'profile',
+                'GET',
+                'rehash@test.org',
+                'test'
+            )
+            json_data = json.loads(resp.get_data())
+        finally:
+            hasher.rounds = rounds
+
+        self.assertIsNotNone(json_data.get('customer'))
+
+        customer = CustomerService.get_customer_by_id(customer_id)
+        self.assertTrue(customer.password.startswith('$2a$05$'))
+        self.assertTrue(customer.check_password('test'))
+        self.assertGreater(hasher.stats()['operations'], 0)
+
+    def test_customer_cache(self):
+        '''
+        Test the read-through customer cache with both backends, and
+        its invalidation
+        '''
+        backends = [
+            LocalCacheBackend(),
+            SharedCacheBackend(LocalSharedClient()),
+        ]
+
+        for backend in backends:
+            customer_cache.enabled = True
+            customer_cache.backend = backend
+            customer_cache.reset_stats()
+            try:
+                self._check_customer_cache()
+            finally:
+                customer_cache.enabled = False
+
+    def _check_customer_cache(self):
+        '''
+        Read the same customer several times with the customer cache
+        enabled, then update it
+        '''
+        #First read => miss, then no query at all
+        self._open('1', 'GET', prefix='admin/customer')
+        with self._assert_statement_count(0):
+            resp = self._open('1', 'GET', prefix='admin/customer')
+        json_data = json.loads(resp.get_data())
+
+        self.assertEqual(json_data['customer']['email'], self.EMAIL)
+        self.assertEqual(customer_cache.stats()['hit_ratio'], 0.5)
+
+        #Profile with a token => no query either
+        data = dict(email=self.EMAIL, password=self.PASSWORD)
+        resp = self._open('login', 'POST', data=json.dumps(data))
+        headers = {
+            'Authorization': 'Bearer ' + json.loads(resp.get_data())['token']
+        }
+        with self._assert_statement_count(0):
+            self._open('profile', 'GET', headers=headers)
+
+        #Update => the next read is fresh
+        data = dict(first_name='Cached')
+        self._open(
+            '1',
+            'PUT',
+            data=json.dumps(data),
+            prefix='admin/customer'
+        )
+        resp = self._open('profile', 'GET', headers=headers)
+        json_data = json.loads(resp.get_data())
+
+        self.assertEqual(json_data['customer']['data']['first_name'], 'Cached')
+
+        #Password change => the token is refused
+        data = dict(old_password='test', password='test2', confirm='test2')
+        self._open(
+            'password',
+            'PATCH',
+            headers=headers,
+            data=json.dumps(data)
+        )
+        resp = self._open('profile', 'GET', headers=headers)
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('error'))
+
+        #Restore the password for the next backend
+        data = dict(old_password='test2', password='test', confirm='test')
+        self._open_with_auth(
+            'password',
+            'PATCH',
+            self.EMAIL,
+            'test2',
+            data=json.dumps(data)
+        )
+
+    def test_etag(self):
+        '''
+        Test the conditional GET and PUT on the customer resources
+        '''
+        resp = self._open('1', 'GET', prefix='admin/customer')
+        etag = resp.headers.get('ETag')
+
+        self.assertIsNotNone(etag)
+
+        #Not modified => 304, without loading the customer data
+        with self._assert_statement_count(1):
+            resp = self._open(
+                '1',
+                'GET',
+                headers={'If-None-Match': etag},
+                prefix='admin/customer'
+            )
+        self.assertEqual(resp.status_code, 304)
+
+        resp = self._open_with_auth('profile', 'GET', self.EMAIL, 'test')
+        self.assertEqual(resp.headers.get('ETag'), etag)
+
+        #Update with the current ETag => success, new ETag
+        resp = self._open(
+            '1',
+            'PUT',
+            headers={'If-Match': etag},
+            data=json.dumps(dict(first_name='New')),
+            prefix='admin/customer'
+        )
+        new_etag = resp.headers.get('ETag')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(new_etag, etag)
+
+        #Update with the previous ETag => 412
+        resp = self._open(
+            '1',
+            'PUT',
+            headers={'If-Match': etag},
+            data=json.dumps(dict(first_name='Old')),
+            prefix='admin/customer'
+        )
+        self.assertEqual(resp.status_code, 412)
+
+        #Modified => full response
+        resp = self._open(
+            '1',
+            'GET',
+            headers={'If-None-Match': etag},
+            prefix='admin/customer'
+        )
+        json_data = json.loads(resp.get_data())
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json_data['customer']['data']['first_name'], 'New')
+
+    def test_patch_profile(self):
+        '''
+        Test the partial update of the profile, with a version check
+        '''
+        data = dict(first_name='John', cellphone='123')
+        resp = self._open_with_dummy_auth(
+            'profile',
+            'PUT',
+            data=json.dumps(data)
+        )
+        etag = resp.headers.get('ETag')
+
+        #Only the first name changes: one query for the token, one
+        # update per table
+        headers = {
+            'Authorization': 'Bearer ' + self._login(),
+            'If-Match': etag
+        }
+        with self._assert_statement_count(3):
+            resp = self._open(
+                'profile',
+                'PATCH',
+                headers=headers,
+                data=json.dumps(dict(first_name='Jack'))
+            )
+        json_data = json.loads(resp.get_data())
+        customer_data = json_data['customer']['data']
+
+        self.assertEqual(customer_data['first_name'], 'Jack')
+        self.assertEqual(customer_data['cellphone'], '123')
+        self.assertNotEqual(resp.headers.get('ETag'), etag)
+
+        #Without If-Match => always applied
+        resp = self._open_with_dummy_auth(
+            'profile',
+            'PATCH',
+            data=json.dumps(dict(first_name='Joe'))
+        )
+        self.assertEqual(resp.status_code, 200)
+
+        #Outdated If-Match => 412
+        resp = self._open(
+            '1',
+            'PATCH',
+            headers={'If-Match': etag},
+            data=json.dumps(dict(first_name='Joe')),
+            prefix='admin/customer'
+        )
+        self.assertEqual(resp.status_code, 412)
+
+        #Unknown customer
+        resp = self._open(
+            '42',
+            'PATCH',
+            data=json.dumps(dict(first_name='Joe')),
+            prefix='admin/customer'
+        )
+        json_data = json.loads(resp.get_data())
+
+        self.assertIsNotNone(json_data.get('msg'))
+
+    def test_delete(self):
+        '''
+        Test that deleting a customer deletes its data with a single
+        statement, and that a soft delete disables it
+        '''
+        customer_id = self._register('delete@test.org', 'test')
+
+        #Soft delete => cannot login, hidden from the lookups and list
+        self.assertTrue(
+            CustomerService.delete_customer_by_id(customer_id, soft=True)
+        )
+        self.assertFalse(
+            CustomerService.delete_customer_by_id(customer_id, soft=True)
+        )
+        resp = self._open_with_auth(
+            'profile',
+            'GET',
+            'delete@test.org',
+            'test'
+        )
+        self.assertEqual(resp.status_code, 401)
+        self.assertIsNone(CustomerService.get_customer_by_id(customer_id))
+        self.assertIsNone(
+            CustomerService.get_customer_by_email('delete@test.org')
+        )
+        self.assertNotIn(
+            customer_id,
+            [customer['id'] for customer in self._list()['customers']]
+        )
+        self.assertEqual(
+            [customer['id'] for customer in
+             self._list(active=False)['customers']],
+            [customer_id]
+        )
+        self.assertEqual(CustomerService.get_count_customers(), 1)
+        db.session.close()
+
+        #Hard delete => customer and data gone
+        with self._assert_statement_count(1):
+            resp = self._open(
+                str(customer_id),
+                'DELETE',
+                prefix='admin/customer'
+            )
+        self.assertTrue(json.loads(resp.get_data())['result'])
+
+        self.assertIsNone(CustomerService.get_customer_by_id(customer_id))
+        self.assertEqual(
+            db.session.query(CustomerData).filter(
+                CustomerData.customer_id == customer_id
+            ).count(),
+            0
+        )
+
+        #Unknown customer
+        resp = self._open(str(customer_id), 'DELETE', prefix='admin/customer')
+        self.assertFalse(json.loads(resp.get_data())['result'])
+
+    def test_serialization(self):
+        '''
+        Test that the customers serialized from rows are the same as
+        the ones serialized from the models, and the compact output
+        '''
+        self._register('serialize@test.org', 'test')
+
+        raw_customers = CustomerService.get_customers(0, 10)
+        rows = CustomerService.get_customer_rows(0, 10)
+        self.assertEqual(
+            [customer_row_json(row) for row in rows],
+            [customer.json for customer in raw_customers]
+        )
+
+        app.config['JSON_COMPACT'] = True
+        try:
+            resp = self._open(
+                '',
+                'GET',
+                data=json.dumps(dict()),
+                prefix='admin/customer'
+            )
+            body = resp.get_data(as_text=True)
+            self.assertNotIn('\n', body)
+            self.assertNotIn(': ', body)
+            self.assertEqual(len(json.loads(body)['customers']), 2)
+
+            app.config['JSON_COMPACT'] = False
+            resp = self._open(
+                '',
+                'GET',
+                data=json.dumps(dict()),
+                prefix='admin/customer'
+            )
+            self.assertIn('\n', resp.get_data(as_text=True))
+        finally:
+            app.config.pop('JSON_COMPACT')
+
+    def test_metrics(self):
+        '''
+        Test that the requests are measured per endpoint and exposed
+        in the Prometheus text format
+        '''
+        #Disabled => not found
+        resp = self._open('metrics', 'GET', prefix='admin/customer')
+        self.assertEqual(resp.status_code, 404)
+
+        metrics.reset()
+        metrics.enable()
+        auth_cache.invalidate(self.EMAIL)
+        try:
+            self._open_with_dummy_auth('profile', 'GET')
+            resp = self._open('metrics', 'GET', prefix='admin/customer')
+        finally:
+            metrics.disable()
+
+        self.assertEqual(resp.status_code, 200)
+        body = resp.get_data(as_text=True)
+        label = 'endpoint="front.profile"'
+
+        self.assertIn(
+            'customers_request_duration_seconds_count{%s} 1' % label,
+            body
+        )
+        self.assertIn(
+            'customers_requests_total{%s,status="200"} 1' % label,
+            body
+        )
+        self.assertIn(
+            'customers_bcrypt_operations_total{%s} 1' % label,
+            body
+        )
+        self.assertIn('customers_sql_statements_count{%s} 1' % label, body)
+        self.assertIn(
+            'customers_sql_statements_bucket{%s,le="100"} 1' % label,
+            body
+        )
+
+    def test_query_monitor(self):
+        '''
+        Test that the slow statements are logged and the repeated
+        ones detected
+        '''
+        self._register('monitor@test.org', 'test')
+
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        app.logger.addHandler(handler)
+        settings = dict(
+            (key, app.config[key]) for key in
+            ('SLOW_QUERY_MS', 'QUERY_REPEAT_LIMIT', 'QUERY_REPEAT_MODE')
+        )
+        app.config['SLOW_QUERY_MS'] = 0
+        app.config['QUERY_REPEAT_LIMIT'] = 1
+        try:
+            #Lazy loads of the customer data => same statement twice
+            with app.test_request_context():
+                raw_customers = CustomerService.get_customers_after(
+                    limit=10,
+                    eager=False
+                )
+                with self.assertRaises(RepeatedQueryError):
+                    [customer.data for customer in raw_customers]
+
+            db.session.rollback()
+
+            app.config['QUERY_REPEAT_MODE'] = 'warn'
+            with app.test_request_context():
+                [
+                    customer.data for customer in
+                    CustomerService.get_customers_after(
+                        limit=10,
+                        eager=False
+                    )
+                ]
+        finally:
+            app.logger.removeHandler(handler)
+            app.config.update(settings)
+
+        messages = [record.getMessage() for record in records]
+        self.assertTrue(any(
+            message.startswith('Slow query') and
+            'CustomerService.get_customers_after' in message
+            for message in messages
+        ))
+        self.assertTrue(any(
+            message.startswith('Statement run more than 1 times')
+            for message in messages
+        ))
+
+    def test_query_monitor_outside_app(self):
+        '''
+        Test that the statements run outside of an application context
+        are logged, and that neither they nor the failed ones leave
+        their start time on the connection
+        '''
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger('customers.common.query_monitor')
+        logger.addHandler(handler)
+        slow_query_ms = query_monitor.slow_query_ms
+        query_monitor.slow_query_ms = 0
+        try:
+            with db.engine.connect() as conn:
+                conn.execute('SELECT 1')
+                with self.assertRaises(DBAPIError):
+                    conn.execute('SELECT * FROM missing_table')
+                self.assertEqual(conn.info.get('query_started'), [])
+        finally:
+            logger.removeHandler(handler)
+            query_monitor.slow_query_ms = slow_query_ms
+
+        self.assertTrue(any(
+            record.getMessage().startswith('Slow query')
+            for record in records
+        ))
+
+    def _search(self, text, cursor=None):
+        '''
+        Search the customers and return the json response
+        '''
+        url = 'search?q=%s' % text
+        if cursor is not None:
+            url += '&cursor=%s' % cursor
+        resp = self._open(url, 'GET', prefix='admin/customer')
+        return json.loads(resp.get_data())
+
+    def test_search(self):
+        '''
+        Test that the customers can be searched by email, name and
+        cellphone, ranked and paginated with a cursor
+        '''
+        alice_id = self._register('alice.martin@test.org', 'test')
+        bob_id = self._register('bob@test.org', 'test')
+        CustomerService.patch_customer(
+            bob_id,
+            dict(last_name='Martin', cellphone='0612345678')
+        )
+        db.session.close()
+
+        #Prefix of the last name first, then substring of the email
+        json_data = self._search('MARTIN')
+        self.assertIsNone(json_data.get('errors'))
+        self.assertEqual(
+            [customer['id'] for customer in json_data['customers']],
+            [bob_id, alice_id]
+        )
+        self.assertIsNone(json_data['next_cursor'])
+
+        #Exact email and cellphone
+        json_data = self._search('bob@test.org')
+        self.assertEqual(json_data['customers'][0]['id'], bob_id)
+        json_data = self._search('2345')
+        self.assertEqual(
+            [customer['id'] for customer in json_data['customers']],
+            [bob_id]
+        )
+
+        #Wildcards are matched literally
+        self.assertEqual(self._search('%25%25%25')['customers'], [])
+
+        #One customer per page
+        CustomerService.SEARCH_RESULTS_PER_PAGE = 1
+        try:
+            ids = []
+            cursor = None
+            while True:
+                json_data = self._search('martin', cursor)
+                ids.extend(
+                    customer['id'] for customer in json_data['customers']
+                )
+                cursor = json_data['next_cursor']
+                if cursor is None:
+                    break
+        finally:
+            CustomerService.SEARCH_RESULTS_PER_PAGE = 20
+        self.assertEqual(ids, [bob_id, alice_id])
+
+        #Too short text or forged cursor => failure
+        self.assertIsNotNone(self._search('ma').get('errors'))
+        self.assertIsNotNone(
+            self._search('martin', 'forged').get('errors')
+        )
+
+    def _list(self, **params):
+        '''
+        Get the admin customer list and return the json response
+        '''
+        resp = self._open(
+            '',
+            'GET',
+            data=json.dumps(params),
+            prefix='admin/customer'
+        )
+        return json.loads(resp.get_data())
+
+    def test_list_filters(self):
+        '''
+        Test that the admin customer list can be filtered and sorted,
+        and that the combinations without an index are rejected
+        '''
+        alice_id = self._register('alice@example.org', 'test')
+        bob_id = self._register('bob@Example.org', 'test')
+        CustomerService.patch_customer(
+            alice_id,
+            dict(last_name='Zed', newsletter=True)
+        )
+        CustomerService.patch_customer(
+            bob_id,
+            dict(last_name='Adams', newsletter=True)
+        )
+        db.session.close()
+
+        json_data = self._list(email_domain='EXAMPLE.org', page=0)
+        self.assertIsNone(json_data.get('errors'))
+        self.assertEqual(
+            [customer['id'] for customer in json_data['customers']],
+            [alice_id, bob_id]
+        )
+        self.assertEqual(json_data['total_pages'], 1)
+
+        json_data = self._list(newsletter=True, sort='last_name')
+        self.assertEqual(
+            [customer['id'] for customer in json_data['customers']],
+            [bob_id, alice_id]
+        )
+
+        #Walk the newest customers first, one per page
+        CustomerService.RESULTS_PER_PAGE = 1
+        try:
+            ids = []
+            cursor = None
+            while True:
+                json_data = self._list(sort='-created', cursor=cursor)
+                self.assertIsNone(json_data.get('errors'))
+                ids.extend(
+                    customer['id'] for customer in json_data['customers']
+                )
+                cursor = json_data['next_cursor']
+                if cursor is None:
+                    break
+        finally:
+            CustomerService.RESULTS_PER_PAGE = 5
+        self.assertEqual(ids, [bob_id, alice_id, 1])
+
+        #No index for these => failure
+        self.assertIsNotNone(
+            self._list(newsletter=True, sort='id').get('errors')
+        )
+        self.assertIsNotNone(
+            self._list(active=False, sort='created').get('errors')
+        )
+        self.assertIsNotNone(self._list(sort='email').get('errors'))
+        self.assertIsNotNone(self._list(active='maybe').get('errors'))
+
+    def test_list_filters_plans(self):
+        '''
+        Test that each supported combination of filters and sort key
+        of the admin customer list uses its index
+        '''
+        values = dict(
+            newsletter=True,
+            active=False,
+            email_domain='test.org',
+            created=datetime(2015, 1, 1)
+        )
+
+        for (sort, names), index in CustomerService.LIST_INDEXES.items():
+            filters = dict(
+                (name, values[name]) for name in names if name != 'created'
+            )
+            if 'created' in names:
+                filters['created_from'] = values['created']
+
+            for prefix in ('', '-'):
+                plan = self._explain_call(
+                    CustomerService.get_customer_rows,
+                    0,
+                    5,
+                    filters=filters,
+                    sort=prefix + sort
+                )
+                self.assertIn(index, plan, plan)
+
+    def test_replica_routing(self):
+        '''
+        Test that the reads go to the replicas round-robin, skip the
+        unreachable ones and go to the primary after a write
+        '''
+        directory = tempfile.mkdtemp()
+        binds = app.config.get('SQLALCHEMY_BINDS')
+        app.config['SQLALCHEMY_BINDS'] = dict(
+            (name, 'sqlite:///%s' % os.path.join(directory, name + '.db'))
+            for name in ('replica1', 'replica2')
+        )
+        app.config['SQLALCHEMY_REPLICAS'] = [
+            'replica1',
+            'replica2'
+        ]
+        router.reset()
+
+        try:
+            with app.app_context():
+                #Different number of customers on each replica
+                for size, replica in zip((3, 4), router.replicas()):
+                    Customer.__table__.create(bind=replica.engine)
+                    replica.engine.execute(Customer.__table__.insert(), [
+                        dict(email='replica%d@test.org' % index)
+                        for index in range(size)
+                    ])
+
+                self.assertEqual(
+                    set([
+                        CustomerService.get_count_customers(),
+                        CustomerService.get_count_customers()
+                    ]),
+                    set([3, 4])
+                )
+
+            #Read your own writes => primary
+            with app.test_request_context():
+                CustomerService.add_customer(Customer('rw@test.org', 'test'))
+                self.assertEqual(CustomerService.get_count_customers(), 2)
+
+            #Unreachable replica => ejected
+            app.config['SQLALCHEMY_BINDS']['replica2'] = \
+                'sqlite:///%s' % os.path.join(directory, 'missing', 'x.db')
+            router.reset()
+            with app.app_context():
+                counts = [
+                    CustomerService.get_count_customers() for _ in range(4)
+                ]
+                self.assertEqual(counts, [3, 3, 3, 3])
+                self.assertFalse(
+                    router.replicas()[1].is_healthy(time.time())
+                )
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.config['SQLALCHEMY_REPLICAS'] = []
+            router.reset()
+            shutil.rmtree(directory)
+
+    def _placement(self):
+        '''
+        Return the customers of every shard, as a dict of the email
+        to the (id, shard) of the customer
+        '''
+        return dict(
+            (email, (customer_id, shard))
+            for shard in shards.shards()
+            for customer_id, email in shard.session.query(
+                Customer.id,
+                Customer.email
+            )
+        )
+
+    def test_sharding(self):
+        '''
+        Test that the customers are placed on the shard of their email
+        with unique ids, found on a single shard by id or by email,
+        listed, counted and exported across the shards and moved by
+        the rebalancing
+        '''
+        directory = tempfile.mkdtemp()
+        binds = app.config.get('SQLALCHEMY_BINDS')
+        app.config['SQLALCHEMY_BINDS'] = dict(
+            (name, 'sqlite:///%s' % os.path.join(directory, name + '.db'))
+            for name in ('shard1', 'shard2', 'shard3')
+        )
+        app.config['SQLALCHEMY_SHARDS'] = ['shard1', 'shard2']
+        shards.reset()
+
+        emails = ['shard%d@test.org' % index for index in range(12)]
+        statements = []
+
+        def recorder(bind):
+            def record(conn, cursor, statement, *args):
+                statements.append(bind)
+            return record
+
+        try:
+            with app.test_request_context():
+                for shard in shards.shards():
+                    db.metadata.create_all(bind=shard.engine)
+                CustomerService.add_customers([
+                    dict(email=email, password='hashed')
+                    for email in emails[1:]
+                ])
+            self._register(emails[0], 'test')
+
+            with app.test_request_context():
+                placement = self._placement()
+                self.assertEqual(sorted(placement), sorted(emails))
+                self.assertEqual(
+                    len(set(shard for _, shard in placement.values())),
+                    2
+                )
+                ids = sorted(
+                    customer_id for customer_id, _ in placement.values()
+                )
+                self.assertEqual(len(set(ids)), len(emails))
+
+                for shard in shards.shards():
+                    event.listen(
+                        shard.engine,
+                        'after_cursor_execute',
+                        recorder(shard.bind)
+                    )
+                for email, (customer_id, shard) in placement.items():
+                    del statements[:]
+                    customer = CustomerService.get_customer_by_id(
+                        customer_id
+                    )
+                    self.assertEqual(customer.email, email)
+                    customer = CustomerService.get_customer_by_email(
+                        email.upper()
+                    )
+                    self.assertEqual(customer.id, customer_id)
+                    self.assertEqual(statements, [shard.bind] * 2)
+
+                #Lists, count, search and export across the shards
+                self.assertEqual(CustomerService.get_count_customers(), 12)
+                self.assertEqual(
+                    [row[0] for row in CustomerService.get_customer_rows(
+                        5,
+                        10
+                    )],
+                    ids[5:10]
+                )
+                self.assertEqual(
+                    [customer.id for customer in
+                     CustomerService.get_customers_after(ids[2], 4)],
+                    ids[3:7]
+                )
+                self.assertEqual(
+                    [row[1] for row in
+                     CustomerService.search_customers('shard1')],
+                    sorted(
+                        placement[email][0] for email in
+                        ('shard1@test.org', 'shard10@test.org',
+                         'shard11@test.org')
+                    )
+                )
+                self.assertEqual(
+                    [row[0] for row in
+                     CustomerService.iter_customer_rows(['id'])],
+                    ids
+                )
+
+            listed = []
+            page = self._list()
+            listed.extend(customer['id'] for customer in page['customers'])
+            while page['next_cursor']:
+                page = self._list(cursor=page['next_cursor'])
+                listed.extend(
+                    customer['id'] for customer in page['customers']
+                )
+            self.assertEqual(listed, ids)
+
+            resp = self._open_with_auth('profile', 'GET', emails[0], 'test')
+            self.assertEqual(resp.status_code, 200)
+
+            #A third shard takes some of the slots
+            app.config['SQLALCHEMY_SHARDS'].append('shard3')
+            shards.reset()
+            with app.test_request_context():
+                db.metadata.create_all(bind=shards.shards()[2].engine)
+
+                moved = CustomerService.rebalance_shards(batch_size=2)
+                self.assertTrue(sum(moved.values()) > 0)
+                self.assertEqual(CustomerService.rebalance_shards(), {})
+
+                placement = self._placement()
+                self.assertEqual(sorted(placement), sorted(emails))
+                for email, (customer_id, shard) in placement.items():
+                    self.assertIs(shards.for_email(email), shard)
+                    self.assertEqual(
+                        CustomerService.get_customer_by_id(customer_id).email,
+                        email
+                    )
+
+                #The ids allocators moved with their slots
+                CustomerService.add_customers([
+                    dict(email='shard%d@test.org' % index, password='hashed')
+                    for index in range(12, 24)
+                ])
+                placement = self._placement()
+                self.assertEqual(
+                    len(set(customer_id for customer_id, _ in
+                            placement.values())),
+                    24
+                )
+                self.assertEqual(
+                    CustomerService.delete_customers_by_ids(ids[:3]),
+                    set(ids[:3])
+                )
+                self.assertEqual(CustomerService.get_count_customers(), 21)
+        finally:
+            app.config['SQLALCHEMY_BINDS'] = binds
+            app.config['SQLALCHEMY_SHARDS'] = []
+            shards.reset()
+            shutil.rmtree(directory)
+
+    def test_hashing_queue_full(self):
+        '''
+        Test that the password operations are shed with a 503 when
+        the hashing queue is full, while the other endpoints are
+        still served
+        '''
+        slots = hasher.pool_size + hasher.queue_size
+        timeout = hasher.timeout
+        shed = hasher.stats()['shed']
+
+        for _ in range(slots):
+            hasher._slots.acquire()
+        hasher.timeout = 0
+        try:
+            resp = self._open(
+                'register',
+                'POST',
+                data=json.dumps(dict(email='shed@test.org', password='x'))
+            )
+            self.assertEqual(resp.status_code, 503)
+            self.assertEqual(resp.headers['Retry-After'], '1')
+
+            resp = self._open('1', 'GET', prefix='admin/customer')
+            self.assertEqual(resp.status_code, 200)
+        finally:
+            hasher.timeout = timeout
+            for _ in range(slots):
+                hasher._slots.release()
+
+        self.assertEqual(hasher.stats()['shed'], shed + 1)
+        self.assertIsNone(CustomerService.get_customer_by_email(
+            'shed@test.org'
+        ))
+
+    def test_login_limiter(self):
+        '''
+        Test that the failed logins are limited per email address and
+        per client address, and counted in the metrics
+        '''
+        config = app.config
+        config['LOGIN_LIMIT_ENABLED'] = True
+        config['LOGIN_LIMIT_PER_EMAIL'] = 3
+        config['LOGIN_LIMIT_PER_ADDRESS'] = 5
+        login_limiter.backend = LocalCacheBackend(100, 300)
+        login_limiter.reset_stats()
+        auth_cache.invalidate(self.EMAIL)
+        try:
+            for _ in range(3):
+                resp = self._open_with_auth(
+                    'profile', 'GET', self.EMAIL, 'wrong'
+                )
+                self.assertEqual(resp.status_code, 401)
+
+            #Limited per email, even with the right password
+            resp = self._open_with_dummy_auth('profile', 'GET')
+            self.assertEqual(resp.status_code, 429)
+            self.assertGreater(int(resp.headers['Retry-After']), 0)
+
+            #Limited per address once it failed 5 times
+            for _ in range(2):
+                resp = self._open_with_auth(
+                    'profile', 'GET', 'other@test.org', 'wrong'
+                )
+                self.assertEqual(resp.status_code, 401)
+            resp = self._open_with_auth(
+                'profile', 'GET', 'third@test.org', 'wrong'
+            )
+            self.assertEqual(resp.status_code, 429)
+
+            #A successful login refills the bucket of its email, the
+            # address comes from the header set by the proxy
+            config['LOGIN_LIMIT_PROXY_HEADER'] = 'X-Real-IP'
+            with app.app_context():
+                login_limiter.record_success(self.EMAIL)
+            resp = self._open('profile', 'GET', headers={
+                'Authorization': 'Basic ' + base64.b64encode(
+                    self.EMAIL + ':' + self.PASSWORD
+                ),
+                'X-Real-IP': '10.0.0.2'
+            })
+            self.assertEqual(resp.status_code, 200)
+
+            self.assertEqual(
+                login_limiter.stats(),
+                dict(allowed=6, shed=2)
+            )
+
+            metrics.enable()
+            try:
+                resp = self._open('metrics', 'GET', prefix='admin/customer')
+            finally:
+                metrics.disable()
+            self.assertIn(
+                'customers_admission_total'
+                '{limiter="login",outcome="shed"} 2',
+                resp.get_data(as_text=True)
+            )
+        finally:
+            config['LOGIN_LIMIT_ENABLED'] = False
+            config['LOGIN_LIMIT_PROXY_HEADER'] = None
+            config['LOGIN_LIMIT_PER_EMAIL'] = 5
+            config['LOGIN_LIMIT_PER_ADDRESS'] = 50
+            login_limiter.reset_stats()
+
+    def test_group_commit(self):
+        '''
+        Test that the customers added by concurrent threads are
+        inserted in one transaction, each thread getting its id or
+        its own error
+        '''
+        rounds = hasher.rounds
+        hasher.rounds = 4
+        try:
+            added = [
+                Customer(email=email, password='test')
+                for email in ['group%d@test.org' % index for index in
+                              range(4)] + [self.EMAIL.upper()]
+            ]
+        finally:
+            hasher.rounds = rounds
+
+        errors = {}
+
+        def add(customer):
+            with app.app_context():
+                try:
+                    CustomerService.add_customer(customer)
+                except IntegrityError as error:
+                    errors[customer.email] = error
+
+        stats = group_commit.stats()
+        settings = group_commit.max_delay, group_commit.max_rows
+        group_commit.enabled = True
+        group_commit.max_delay = 5.0
+        group_commit.max_rows = len(added)
+        try:
+            threads = [
+                Thread(target=add, args=(customer,)) for customer in added
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            group_commit.enabled = False
+            group_commit.max_delay, group_commit.max_rows = settings
+
+        #The duplicate email failed the batch, inserted again row by row
+        self.assertEqual(list(errors), [self.EMAIL.upper()])
+        self.assertEqual(group_commit.stats()['batches'],
+                         stats['batches'] + 1)
+        self.assertEqual(group_commit.stats()['retries'],
+                         stats['retries'] + len(added))
+
+        for customer in added[:-1]:
+            self.assertIsNotNone(customer.id)
+            self.assertEqual(
+                CustomerService.get_customer_by_id(customer.id).email,
+                customer.email
+            )
+        self.assertEqual(CustomerService.get_count_customers(), 5)
+
 if __name__ == '__main__':
     unittest.main()